@@ -0,0 +1,455 @@
+import asyncio
+import itertools
+import random
+import struct
+from threading import Lock, Thread, current_thread
+from time import perf_counter
+
+from .cip_driver import CONNECTED_LENGTH_OFFSET, CONNECTED_REPLY_OFFSET, \
+    CONNECTION_SIZE_LARGE, CONNECTION_SIZE_STANDARD, CommError, DataError, \
+    EMBEDDED_SERVICE_ERROR, GET_ATTRIBUTE_SINGLE, MESSAGE_ROUTER_PATH, \
+    MULTIPLE_SERVICE_PACKET, REPLY_DATA_TOO_LARGE, SEND_RR_DATA, \
+    SEND_UNIT_DATA, SERVICE_NOT_SUPPORTED, SERVICE_REPLY_SIZE, \
+    SET_ATTRIBUTE_SINGLE, SUCCESS, ServiceError, \
+    UNCONNECTED_LENGTH_OFFSET, UNCONNECTED_PACKET_SIZE, \
+    UNCONNECTED_REPLY_OFFSET, \
+    build_forward_close, build_forward_open, build_multi, check_sizes, \
+    encode_path, \
+    build_request, expand_path, multi_status, parse_multi, \
+    parse_service_reply, plan_attribute_lists, split_multi, \
+    unpack_attribute_lists
+from .connection_pool import DEFAULT_PORT
+from .metrics import Metrics
+
+
+# encapsulation header: command, length, session handle, status,
+# sender context and options
+HEADER = struct.Struct('<HHII8sI')
+NOP = 0x00
+REGISTER_SESSION = 0x65
+UNREGISTER_SESSION = 0x66
+# common packet format item type IDs
+NULL_ADDRESS_ITEM = 0x00
+CONNECTED_ADDRESS_ITEM = 0xA1
+CONNECTED_DATA_ITEM = 0xB1
+UNCONNECTED_DATA_ITEM = 0xB2
+
+_loop = None
+_loop_thread = None
+_loop_lock = Lock()
+
+
+def get_event_loop():
+    """ The event loop shared by all AsyncCIPDrivers
+
+    It runs forever in its own daemon thread, started on first use.
+    """
+    global _loop, _loop_thread
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            _loop_thread = Thread(
+                target=_loop.run_forever, name='CIPDriver', daemon=True)
+            _loop_thread.start()
+    return _loop
+
+
+def in_event_loop():
+    return current_thread() is _loop_thread
+
+
+class AsyncCIPDriver(object):
+    """ asyncio EtherNet/IP explicit messaging client
+
+    Has the same blocking interface as CIPDriver, so it can be used from
+    the connection pool, plus async_ coroutine variants that must be
+    awaited on the loop from get_event_loop(). Up to window requests are
+    outstanding on the session at once, replies are matched to requests
+    by the sender context, or by the sequence count when connected.
+    """
+
+    def __init__(self, timeout=10.0, window=16):
+        self.attribs = {'port': DEFAULT_PORT}
+        self.timeout = timeout
+        self.window = window
+        self.max_packet_size = UNCONNECTED_PACKET_SIZE
+        self._loop = get_event_loop()
+        self._reader = None
+        self._writer = None
+        self._receiver = None
+        self._semaphore = None
+        self._session = 0
+        self._status = (0, '')
+        # general status of the last failed request
+        self._service_status = SUCCESS
+        # sender context or sequence count -> future for the reply
+        self._pending = {}
+        self._contexts = itertools.count(1)
+        self._sequence = random.randrange(0x10000)
+        self._target_cid = None
+        self._connection_serial = None
+        self._connection_path = None
+        # encode, rtt and decode time of each request and CIP status codes
+        self.metrics = Metrics()
+
+    def __getitem__(self, key):
+        return self.attribs[key]
+
+    def __setitem__(self, key, value):
+        self.attribs[key] = value
+
+    # blocking interface, the same as CIPDriver
+
+    def open(self, ip_address):
+        return self._run(self.async_open(ip_address))
+
+    def close(self):
+        if in_event_loop():
+            # can not block the loop waiting for itself
+            self._loop.create_task(self.async_close())
+        else:
+            self._run(self.async_close())
+
+    def is_connected(self):
+        return self._writer is not None and not self._writer.is_closing()
+
+    def nop(self):
+        self._run(self._send(NOP, b''))
+
+    def get_status(self):
+        return self._status
+
+    def open_connection(self, large=True, route=b''):
+        return self._run(self.async_open_connection(large, route))
+
+    def get_attribute_single(self, clss, inst, attr=None,
+                             raise_errors=False):
+        return self._run_single(
+            self.async_get_attribute_single(clss, inst, attr), raise_errors)
+
+    def set_attribute_single(self, data, clss, inst, attr=None,
+                             raise_errors=False):
+        return self._run_single(
+            self.async_set_attribute_single(data, clss, inst, attr),
+            raise_errors)
+
+    def get_attribute_multi(self, paths, sizes=None, lists=False):
+        return self._run(self.async_get_attribute_multi(paths, sizes, lists))
+
+    def set_attribute_multi(self, items):
+        return self._run(self.async_set_attribute_multi(items))
+
+    def generic_service(self, service, clss, inst, attr=None, data=b'',
+                        raise_errors=False):
+        return self._run_single(
+            self.async_generic_service(service, clss, inst, attr, data),
+            raise_errors)
+
+    def generic_service_multi(self, items):
+        return self._run(self.async_generic_service_multi(items))
+
+    # coroutines
+
+    async def async_open(self, ip_address):
+        if self.is_connected():
+            return True
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(ip_address, self.attribs['port']),
+            self.timeout)
+        self._semaphore = asyncio.Semaphore(self.window)
+        # register the session before replies are matched to requests
+        self._writer.write(self._header(REGISTER_SESSION, 4))
+        self._writer.write(struct.pack('<HH', 1, 0))  # protocol version
+        reply = await asyncio.wait_for(self._read(), self.timeout)
+        if HEADER.unpack_from(reply)[3] != SUCCESS:
+            self._status = (13, "Session not registered")
+            await self.async_close()
+            return False
+        self._session = HEADER.unpack_from(reply)[2]
+        self._receiver = self._loop.create_task(self._receive())
+        return True
+
+    async def async_close(self):
+        if self._writer is None:
+            return
+        try:
+            if self._target_cid is not None:
+                await self._forward_close()
+            if self._session:
+                await self._send(UNREGISTER_SESSION, b'')
+        except Exception:
+            # the session is already broken
+            pass
+        if self._receiver is not None:
+            self._receiver.cancel()
+        self._writer.close()
+        self._reader = self._writer = self._receiver = None
+        self._session = 0
+        self._fail_pending(CommError('connection closed'))
+
+    async def async_open_connection(self, large=True, route=b''):
+        """ Open a class 3 connection, see CIPDriver.open_connection """
+        if self._target_cid is not None:
+            return True
+        if large:
+            if await self._forward_open(True, route):
+                return True
+            if self._service_status != SERVICE_NOT_SUPPORTED:
+                return False
+        return await self._forward_open(False, route)
+
+    async def async_get_attribute_single(self, clss, inst, attr=None):
+        """ Get an attribute, raises ServiceError if the target fails the
+        request
+        """
+        path = encode_path(clss, inst, attr)
+        return bytes(await self._request(
+            build_request(GET_ATTRIBUTE_SINGLE, path)))
+
+    async def async_set_attribute_single(self, data, clss, inst, attr=None):
+        """ Set an attribute, raises ServiceError if the target fails the
+        request
+        """
+        path = encode_path(clss, inst, attr)
+        await self._request(build_request(SET_ATTRIBUTE_SINGLE, path, data))
+        return True
+
+    async def async_get_attribute_multi(self, paths, sizes=None,
+                                        lists=False):
+        """ Get many attributes with pipelined Multiple Service Packets
+
+        Returns (values, statuses), see CIPDriver.get_attribute_multi.
+        """
+        if sizes is None:
+            sizes = [None] * len(paths)
+        requests, reply_sizes, plan = plan_attribute_lists(
+            paths, sizes, self.max_packet_size, lists)
+        values, statuses = unpack_attribute_lists(
+            paths, sizes, plan,
+            await self._request_services(requests, reply_sizes))
+        # attributes of a list reply that did not match the sizes
+        indexes = [i for i, status in enumerate(statuses) if status is None]
+        if indexes:
+            requests, reply_sizes, plan = plan_attribute_lists(
+                [paths[i] for i in indexes], [sizes[i] for i in indexes],
+                self.max_packet_size, False)
+            replies = await self._request_services(requests, reply_sizes)
+            for index, (status, data) in zip(indexes, replies):
+                statuses[index] = multi_status(status)
+                values[index] = data if status == SUCCESS else False
+        return check_sizes(values, statuses, sizes)
+
+    async def async_set_attribute_multi(self, items):
+        """ Set many attributes with pipelined Multiple Service Packets
+
+        Returns (results, statuses), see CIPDriver.set_attribute_multi.
+        """
+        requests = [
+            build_request(SET_ATTRIBUTE_SINGLE,
+                          encode_path(*expand_path(path)), data)
+            for data, path in items]
+        values, statuses = await self._request_multi(
+            requests, [SERVICE_REPLY_SIZE] * len(requests))
+        return [value is not False for value in values], statuses
+
+    async def async_generic_service(self, service, clss, inst, attr=None,
+                                    data=b''):
+        """ Send any service to a path, returns the reply data and raises
+        ServiceError if the target fails the request
+        """
+        return bytes(await self._request(build_request(
+            service, encode_path(clss, inst, attr), data)))
+
+    async def async_generic_service_multi(self, items):
+        """ Send many services with pipelined Multiple Service Packets
+
+        Returns (values, statuses), see CIPDriver.generic_service_multi.
+        """
+        requests = [
+            build_request(service, encode_path(*expand_path(path)), data)
+            for service, path, data in items]
+        return await self._request_multi(requests)
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(
+            coroutine, self._loop).result()
+
+    def _run_single(self, coroutine, raise_errors):
+        """ The result of a single request, or False if the target fails
+        it and raise_errors is False
+        """
+        try:
+            return self._run(coroutine)
+        except ServiceError:
+            if raise_errors:
+                raise
+            return False
+
+    def _header(self, command, length, context=b'\x00' * 8):
+        return HEADER.pack(command, length, self._session, 0, context, 0)
+
+    async def _send(self, command, data, context=b'\x00' * 8):
+        if not self.is_connected():
+            raise CommError('not connected')
+        self._writer.write(self._header(command, len(data), context) + data)
+        await self._writer.drain()
+
+    async def _read(self):
+        header = await self._reader.readexactly(HEADER.size)
+        length = HEADER.unpack(header)[1]
+        return header + await self._reader.readexactly(length)
+
+    async def _receive(self):
+        """ Match replies to outstanding requests until the session ends """
+        try:
+            while True:
+                reply = await self._read()
+                if HEADER.unpack_from(reply)[0] == SEND_UNIT_DATA:
+                    key = reply[44:46]
+                else:
+                    key = HEADER.unpack_from(reply)[4]
+                future = self._pending.pop(key, None)
+                if future is not None and not future.done():
+                    future.set_result(reply)
+        except Exception as e:
+            self._fail_pending(CommError(e))
+            if self._writer is not None:
+                self._writer.close()
+
+    def _fail_pending(self, exc):
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(exc)
+        self._pending.clear()
+
+    async def _request(self, message_request, connected=True):
+        """ Send a Message Router request and return the reply data """
+        if not self.is_connected():
+            raise CommError('not connected')
+        async with self._semaphore:
+            started = perf_counter()
+            future = self._loop.create_future()
+            if connected and self._target_cid is not None:
+                self._sequence = (self._sequence + 1) % 0x10000
+                key = struct.pack('<H', self._sequence)
+                data = key + message_request
+                command = SEND_UNIT_DATA
+                items = struct.pack(
+                    '<IHHHH4sHH', 0, 0, 2, CONNECTED_ADDRESS_ITEM, 4,
+                    self._target_cid, CONNECTED_DATA_ITEM, len(data))
+                context = b'\x00' * 8
+            else:
+                key = context = struct.pack('<Q', next(self._contexts))
+                data = message_request
+                command = SEND_RR_DATA
+                items = struct.pack(
+                    '<IHHHHHH', 0, 10, 2, NULL_ADDRESS_ITEM, 0,
+                    UNCONNECTED_DATA_ITEM, len(data))
+            self._pending[key] = future
+            sent = perf_counter()
+            try:
+                await self._send(command, items + data, context)
+                reply = await asyncio.wait_for(future, self.timeout)
+            except asyncio.TimeoutError:
+                raise CommError('request timed out')
+            finally:
+                self._pending.pop(key, None)
+        received = perf_counter()
+        try:
+            return self._reply_data(reply, command)
+        finally:
+            self.metrics.increment('requests')
+            self.metrics.record('encode', sent - started)
+            self.metrics.record('rtt', received - sent)
+            self.metrics.record('decode', perf_counter() - received)
+
+    def _reply_data(self, reply, command):
+        status = HEADER.unpack_from(reply)[3]
+        if status != SUCCESS:
+            self._status = (3, "reply status:{0}".format(status))
+            raise DataError(self._status[1])
+        if command == SEND_UNIT_DATA:
+            # the data item length is followed by the sequence count
+            length_offset = CONNECTED_LENGTH_OFFSET
+            offset = CONNECTED_REPLY_OFFSET
+        else:
+            length_offset = UNCONNECTED_LENGTH_OFFSET
+            offset = UNCONNECTED_REPLY_OFFSET
+        data_length = struct.unpack_from('<H', reply, length_offset)[0]
+        # a view, the data of each service is only copied once
+        reply = memoryview(reply)[offset:length_offset + 2 + data_length]
+        status, data = parse_service_reply(reply)
+        self.metrics.status(status)
+        if reply[0] & 0x7F == MULTIPLE_SERVICE_PACKET and \
+                status == EMBEDDED_SERVICE_ERROR:
+            # per-service status is checked by parse_multi
+            return data
+        if status != SUCCESS:
+            self._service_status = status
+            self._status = multi_status(status)
+            raise ServiceError(self._status[1], status)
+        return data
+
+    async def _request_multi(self, requests, reply_sizes=None):
+        values = []
+        statuses = []
+        for status, data in await self._request_services(
+                requests, reply_sizes):
+            statuses.append(multi_status(status))
+            values.append(data if status == SUCCESS else False)
+        return values, statuses
+
+    async def _request_services(self, requests, reply_sizes=None):
+        """ Send requests in pipelined Multiple Service Packets and return
+        the (general status, data) of each reply, see
+        CIPDriver._send_services
+        """
+        batches = list(
+            split_multi(requests, self.max_packet_size, reply_sizes))
+        replies = await asyncio.gather(*[
+            self._request(build_multi(batch)) for batch in batches],
+            return_exceptions=True)
+        for reply in replies:
+            if isinstance(reply, Exception) and \
+                    not isinstance(reply, ServiceError):
+                raise reply
+        results = []
+        for batch, data in zip(batches, replies):
+            if isinstance(data, ServiceError) and \
+                    data.status == REPLY_DATA_TOO_LARGE and len(batch) > 1:
+                half = len(batch) // 2
+                for part in (batch[:half], batch[half:]):
+                    results.extend(await self._request_services(
+                        part, [0] * len(part)))
+                continue
+            if isinstance(data, ServiceError):
+                # the target failed the whole Multiple Service Packet
+                results.extend([(data.status, b'')] * len(batch))
+                continue
+            for status, data in parse_multi(data, len(batch)):
+                self.metrics.status(status)
+                results.append((status, bytes(data)))
+        return results
+
+    async def _forward_open(self, large, route):
+        self._connection_serial = random.randrange(0x10000)
+        self._connection_path = bytes(route) + MESSAGE_ROUTER_PATH
+        message_request = build_forward_open(
+            large, self._connection_serial, self._connection_path)
+        try:
+            data = await self._request(message_request, connected=False)
+        except DataError:
+            return False
+        self._target_cid = bytes(data[:4])
+        # the sequence count is part of the connection size
+        if large:
+            self.max_packet_size = CONNECTION_SIZE_LARGE - 2
+        else:
+            self.max_packet_size = CONNECTION_SIZE_STANDARD - 2
+        return True
+
+    async def _forward_close(self):
+        self._target_cid = None
+        self.max_packet_size = UNCONNECTED_PACKET_SIZE
+        await self._request(build_forward_close(
+            self._connection_serial, self._connection_path), connected=False)
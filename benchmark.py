@@ -0,0 +1,256 @@
+""" Benchmarks of the drivers and blocks against an in-process EIPSimulator
+
+Run from the directory containing the block collection, for example:
+
+    python -m eip_messages.benchmark --requests 2000 --latency 0.0005
+
+Reports the requests per second, the p50 and p99 latency in milliseconds,
+the memory blocks still allocated after the run per request, which grows
+if requests leak or caches grow, and the peak memory traced while running.
+CPython does not count transient allocations, the peak is the closest
+measure. The simulator runs in the same process, so both include its
+allocations. Results can be saved with --json and later runs compared to
+them with --compare, which exits with status 1 if any benchmark regressed
+by more than --tolerance.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import sys
+import tracemalloc
+import unittest
+from collections import OrderedDict
+from time import perf_counter
+
+from .async_cip_driver import AsyncCIPDriver, get_event_loop
+from .cip_driver import CIPDriver
+from .eip_get_attribute_block import EIPGetAttribute
+from .eip_set_attribute_block import EIPSetAttribute
+from .simulator import EIPSimulator
+from nio import Signal
+from nio.testing.block_test_case import NIOBlockTestCase
+
+
+# paths read by each benchmark, and by each list of signals processed by
+# the block benchmarks
+PATHS = [[1, 1, attribute] for attribute in range(1, 101)]
+ATTRIBUTES = {tuple(path): bytes(4) for path in PATHS}
+# unconnected requests outstanding in the pipelined benchmarks
+PIPELINE_WINDOW = 4
+# worker processes owning the sessions of the block benchmarks using them
+WORKER_PROCESSES = 2
+# fraction of the requests to trace for the peak memory
+TRACED = 0.1
+
+
+def measure(name, call, calls, requests_per_call=1):
+    """ Time calls of call() and return a dict of the results """
+    call()  # warm up connections and caches
+    gc.collect()
+    blocks = sys.getallocatedblocks()
+    latencies = []
+    start = perf_counter()
+    for _ in range(calls):
+        call_start = perf_counter()
+        call()
+        latencies.append(perf_counter() - call_start)
+    seconds = perf_counter() - start
+    gc.collect()
+    retained = sys.getallocatedblocks() - blocks
+    tracemalloc.start()
+    for _ in range(max(int(calls * TRACED), 1)):
+        call()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    latencies.sort()
+    requests = calls * requests_per_call
+    return OrderedDict([
+        ('name', name),
+        ('requests', requests),
+        ('requests_per_second', requests / seconds),
+        ('p50_ms', percentile(latencies, 0.5) * 1000),
+        ('p99_ms', percentile(latencies, 0.99) * 1000),
+        ('retained_blocks_per_request', retained / requests),
+        ('peak_kib', peak / 1024),
+    ])
+
+
+def percentile(values, fraction):
+    """ The value at fraction of the sorted values """
+    return values[int(fraction * (len(values) - 1))]
+
+
+def driver_benchmarks(simulator, requests):
+    results = []
+    driver = CIPDriver()
+    driver['port'] = simulator.port
+    driver.open('127.0.0.1')
+    try:
+        results.append(measure(
+            'driver get_attribute_single',
+            lambda: driver.get_attribute_single(1, 1, 1), requests))
+        results.append(measure(
+            'driver get_attribute_multi',
+            lambda: driver.get_attribute_multi(PATHS),
+            max(requests // len(PATHS), 1), len(PATHS)))
+        results.append(measure(
+            'driver get_attribute_multi listed',
+            lambda: driver.get_attribute_multi(
+                PATHS, sizes=[4] * len(PATHS), lists=True),
+            max(requests // len(PATHS), 1), len(PATHS)))
+        driver.open_connection()
+        results.append(measure(
+            'driver get_attribute_single connected',
+            lambda: driver.get_attribute_single(1, 1, 1), requests))
+    finally:
+        driver.close()
+    driver = CIPDriver(window=PIPELINE_WINDOW)
+    driver['port'] = simulator.port
+    driver.open('127.0.0.1')
+    try:
+        results.append(measure(
+            'driver get_attribute_multi pipelined',
+            lambda: driver.get_attribute_multi(PATHS),
+            max(requests // len(PATHS), 1), len(PATHS)))
+    finally:
+        driver.close()
+    driver = AsyncCIPDriver()
+    driver['port'] = simulator.port
+    driver.open('127.0.0.1')
+
+    async def pipelined():
+        await asyncio.gather(*[
+            driver.async_get_attribute_single(*path) for path in PATHS])
+    try:
+        results.append(measure(
+            'async driver get_attribute_single pipelined',
+            lambda: asyncio.run_coroutine_threadsafe(
+                pipelined(), get_event_loop()).result(),
+            max(requests // len(PATHS), 1), len(PATHS)))
+    finally:
+        driver.close()
+    return results
+
+
+class BlockBenchmarks(NIOBlockTestCase):
+    """ Runs the blocks in nio's test environment, see block_benchmarks """
+
+    simulator = None
+    requests = 0
+    results = []
+
+    def _measure(self, name, block, config, signals):
+        config = dict(config, host='127.0.0.1', port=self.simulator.port)
+        self.configure_block(block, config)
+        block.start()
+        try:
+            self.results.append(measure(
+                name,
+                lambda: block.process_signals(signals),
+                max(self.requests // len(signals), 1), len(signals)))
+        finally:
+            block.stop()
+        # notified signals are not kept between benchmarks
+        self.notified_signals.clear()
+
+    def test_get_attribute(self):
+        signals = [Signal({'attribute': path[2]}) for path in PATHS]
+        config = {'path': {'attribute_num': '{{ $attribute }}'}}
+        self._measure(
+            'EIPGetAttribute', EIPGetAttribute(), config, signals)
+        self._measure(
+            'EIPGetAttribute batch', EIPGetAttribute(),
+            dict(config, batch=True), signals)
+        self._measure(
+            'EIPGetAttribute worker processes', EIPGetAttribute(),
+            dict(config, worker_processes=WORKER_PROCESSES), signals)
+
+    def test_set_attribute(self):
+        signals = [Signal({'attribute': path[2]}) for path in PATHS]
+        config = {
+            'path': {'attribute_num': '{{ $attribute }}'},
+            'value': '{{ bytes(4) }}',
+        }
+        self._measure(
+            'EIPSetAttribute', EIPSetAttribute(), config, signals)
+        self._measure(
+            'EIPSetAttribute batch', EIPSetAttribute(),
+            dict(config, batch=True), signals)
+
+
+def block_benchmarks(simulator, requests):
+    BlockBenchmarks.simulator = simulator
+    BlockBenchmarks.requests = requests
+    BlockBenchmarks.results = []
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(BlockBenchmarks)
+    outcome = unittest.TextTestRunner(stream=sys.stderr, verbosity=0).run(
+        suite)
+    if not outcome.wasSuccessful():
+        raise RuntimeError('Block benchmarks failed')
+    return BlockBenchmarks.results
+
+
+def compare(results, baseline, tolerance):
+    """ Return a message for each benchmark slower than in baseline """
+    regressions = []
+    for result in results:
+        previous = baseline.get(result['name'])
+        if previous is None:
+            continue
+        if result['requests_per_second'] < \
+                previous['requests_per_second'] * (1 - tolerance):
+            regressions.append('{}: {:.0f} requests/s, was {:.0f}'.format(
+                result['name'], result['requests_per_second'],
+                previous['requests_per_second']))
+        if result['p99_ms'] > previous['p99_ms'] * (1 + tolerance):
+            regressions.append('{}: p99 {:.3f} ms, was {:.3f}'.format(
+                result['name'], result['p99_ms'], previous['p99_ms']))
+    return regressions
+
+
+def report(results):
+    print('{:<45} {:>10} {:>9} {:>9} {:>9} {:>9}'.format(
+        'benchmark', 'req/s', 'p50 ms', 'p99 ms', 'blk/req', 'peak KiB'))
+    for result in results:
+        print('{:<45} {:>10.0f} {:>9.3f} {:>9.3f} {:>9.2f} {:>9.1f}'.format(
+            result['name'], result['requests_per_second'], result['p50_ms'],
+            result['p99_ms'], result['retained_blocks_per_request'],
+            result['peak_kib']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=1000,
+                        help='requests per benchmark')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='simulated reply latency in seconds')
+    parser.add_argument('--json', help='save the results to this file')
+    parser.add_argument('--compare', help='results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='largest allowed fraction slower than --compare')
+    parser.add_argument('--no-blocks', action='store_true',
+                        help='only benchmark the drivers')
+    args = parser.parse_args(argv)
+    with EIPSimulator(
+            latency=args.latency, attributes=ATTRIBUTES) as simulator:
+        results = driver_benchmarks(simulator, args.requests)
+        if not args.no_blocks:
+            results.extend(block_benchmarks(simulator, args.requests))
+    report(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({result['name']: result for result in results}, f,
+                      indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,66 @@
+from numbers import Number
+from threading import Lock
+from time import monotonic
+
+
+class ChangeFilter(object):
+    """ Report by exception, keeps the last reported value of each key
+
+    A value is reported if it is the first for its key, if it differs from
+    the last reported value by more than deadband, or if nothing has been
+    reported for heartbeat seconds. Numbers, and lists of numbers of the
+    same length, are compared with the deadband, any other values are
+    reported when they are not equal.
+    """
+
+    def __init__(self, deadband=0, heartbeat=None):
+        self.deadband = deadband
+        self.heartbeat = heartbeat
+        self._lock = Lock()
+        # key -> (last reported value, monotonic time it was reported)
+        self._values = {}
+        self.reported = 0
+        self.suppressed = 0
+
+    def report(self, key, value):
+        """ Return True if value should be reported for key """
+        now = monotonic()
+        with self._lock:
+            last = self._values.get(key)
+            if last is None or self._changed(last[0], value) or \
+                    self.heartbeat is not None and \
+                    now - last[1] >= self.heartbeat:
+                self._values[key] = (value, now)
+                self.reported += 1
+                return True
+            self.suppressed += 1
+            return False
+
+    def stats(self):
+        with self._lock:
+            return {
+                'reported': self.reported,
+                'suppressed': self.suppressed,
+                'values': len(self._values),
+            }
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+            self.reported = 0
+            self.suppressed = 0
+
+    def _changed(self, last, value):
+        if _is_number(last) and _is_number(value):
+            return abs(value - last) > self.deadband
+        if isinstance(last, list) and isinstance(value, list) and \
+                len(last) == len(value) and \
+                all(map(_is_number, last)) and all(map(_is_number, value)):
+            return any(
+                abs(new - old) > self.deadband
+                for old, new in zip(last, value))
+        return last != value
+
+
+def _is_number(value):
+    return isinstance(value, Number) and not isinstance(value, bool)
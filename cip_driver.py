@@ -1,76 +1,1286 @@
+import itertools
+import logging
+import random
+from collections import OrderedDict, namedtuple
+from functools import lru_cache, wraps
+from threading import BoundedSemaphore, Condition, Lock, RLock, local
+from time import perf_counter
+
 from pycomm.cip.cip_base import *
 
+from .metrics import Metrics
+
+
+GET_ATTRIBUTE_ALL = 0x01
+GET_ATTRIBUTE_LIST = 0x03
+SET_ATTRIBUTE_LIST = 0x04
+GET_ATTRIBUTE_SINGLE = 0x0E
+SET_ATTRIBUTE_SINGLE = 0x10
+INITIATE_UPLOAD = 0x4B
+UPLOAD_TRANSFER = 0x4F
+MULTIPLE_SERVICE_PACKET = 0x0A
+FORWARD_OPEN_SERVICE = 0x54
+LARGE_FORWARD_OPEN_SERVICE = 0x5B
+FORWARD_CLOSE_SERVICE = 0x4E
+SERVICE_NOT_SUPPORTED = 0x08
+# encapsulation commands
+SEND_RR_DATA = 0x6F
+SEND_UNIT_DATA = 0x70
+# general status of a Multiple Service Packet reply when any of the
+# embedded services failed, the per-service status is in the reply
+EMBEDDED_SERVICE_ERROR = 0x1E
+# general status of a Get_Attribute_List reply when any of the attributes
+# failed, the per-attribute status is in the reply
+ATTRIBUTE_LIST_ERROR = 0x0A
+# general status of a fragment of a reply that is followed by more
+PARTIAL_TRANSFER = 0x06
+# general status of a reply that does not fit in the message
+REPLY_DATA_TOO_LARGE = 0x11
+# status of an attribute whose reply does not match its expected size
+INVALID_REPLY = 0x22
+# service, reserved, general status and additional status size of a
+# Message Router reply
+SERVICE_REPLY_SIZE = 4
+# reply size assumed for a request whose reply size is not known, the
+# reply header and up to 32 bytes of data
+DEFAULT_REPLY_SIZE = SERVICE_REPLY_SIZE + 32
+# service, reserved, status, additional status size and attribute count
+ATTRIBUTE_LIST_REPLY_SIZE = 6
+# File Object, uploads are at most 255 bytes per Upload_Transfer
+FILE_CLASS = 0x37
+FILE_TRANSFER_SIZE = 255
+# Upload_Transfer packet types
+LAST_PACKET = 2
+FIRST_AND_LAST_PACKET = 3
+# Message Router object, instance 1
+MESSAGE_ROUTER_PATH = bytes([0x20, 0x02, 0x24, 0x01])
+# Connection Manager object, instance 1
+CONNECTION_MANAGER_PATH = bytes([0x20, 0x06, 0x24, 0x01])
+# largest message router request accepted over UCMM
+UNCONNECTED_PACKET_SIZE = 504
+# connection sizes include the 2 byte sequence count
+CONNECTION_SIZE_STANDARD = 504
+CONNECTION_SIZE_LARGE = 4002
+# point to point, low priority, variable size connection parameters
+CONNECTION_PARAMS_STANDARD = 0x4200
+CONNECTION_PARAMS_LARGE = 0x42000000
+# class 3, server, application triggered
+TRANSPORT_CLASS_3 = 0xA3
+# class 1, client, cyclic
+TRANSPORT_CLASS_1 = 0x01
+# point to point, scheduled priority, fixed size I/O connection parameters
+CONNECTION_PARAMS_IO = 0x4800
+# Assembly object path segments, the configuration instance is followed by
+# the O->T and T->O connection points
+ASSEMBLY_CLASS = 0x04
+CONNECTION_POINT_SEGMENT = 0x2C
+# O->T connection point of an input only connection on many targets
+INPUT_ONLY_CONNECTION_POINT = 198
+ORIGINATOR_VENDOR_ID = 0x1009
+ORIGINATOR_SERIAL = 0x71190910
+# 1 second requested packet interval, in microseconds
+CONNECTED_RPI = 1000000
+# most encoded paths and request frames kept for reuse
+REQUEST_CACHE_SIZE = 1024
+# offsets of the fields patched into a cached frame
+SESSION_OFFSET = 4
+CONTEXT_OFFSET = 12
+SEQUENCE_OFFSET = 44
+# offsets of the data item length and the Message Router reply in
+# unconnected and connected replies, the connected data item starts with
+# the sequence count
+UNCONNECTED_LENGTH_OFFSET = 38
+UNCONNECTED_REPLY_OFFSET = 40
+CONNECTED_LENGTH_OFFSET = 42
+CONNECTED_REPLY_OFFSET = 46
+# an encapsulation header and the largest encapsulated data
+RECEIVE_BUFFER_SIZE = HEADER_SIZE + 0xFFFF
+
+
+class ServiceError(DataError):
+    """ The target replied to a request with a CIP error status, the
+    session is still usable
+    """
+
+    def __init__(self, message, status=None):
+        super(ServiceError, self).__init__(message)
+        # the CIP general status
+        self.status = status
+
+    def __reduce__(self):
+        # raised in worker processes and pickled back to the block
+        return ServiceError, (str(self), self.status)
+
+
+def build_path(clss, inst, attr=None):
+    """ Build the EPATH for a class, instance and optional attribute """
+    if 65535 > inst > 255:
+        inst_header = [0x25, 0x00]
+        inst = struct.pack('<H', inst)
+    elif inst > 65535:
+        inst_header = [0x26, 0x00]
+        inst = struct.pack('<I', inst)
+    else:
+        inst_header = [0x24]
+        inst = [inst]
+    path = [0x20, clss]
+    path.extend(inst_header)
+    path.extend(list(inst))
+    if attr != None:
+        path.extend([0x30, attr])
+    return path
+
+
+@lru_cache(maxsize=REQUEST_CACHE_SIZE)
+def encode_path(clss, inst, attr=None):
+    """ The EPATH from build_path as bytes, cached """
+    return bytes(build_path(clss, inst, attr))
+
+
+def expand_path(path):
+    """ Return [class, instance, attribute] for a path of 2 or 3 items """
+    path = list(path)
+    if len(path) < 3:
+        path.append(None)
+    return path
+
+
+def build_request(service, path, data=b''):
+    """ Build a Message Router request """
+    return b''.join([
+        bytes([service]),
+        bytes([len(path) // 2]),  # the Request Path Size length in words
+        bytes(path),
+        bytes(data),
+    ])
+
+
+def build_frame(message_request, cid=None):
+    """ Build an encapsulated SendRRData frame, or SendUnitData frame for
+    the connection cid
+
+    The session handle, sender context and the sequence count of a
+    connected request are left as zeros to be patched in when sending.
+    """
+    if cid is None:
+        command = ENCAPSULATION_COMMAND['send_rr_data']
+        packet = build_common_packet_format(
+            DATA_ITEM['Unconnected'],
+            message_request,
+            ADDRESS_ITEM['UCMM'],)
+    else:
+        command = ENCAPSULATION_COMMAND['send_unit_data']
+        packet = build_common_packet_format(
+            DATA_ITEM['Connected'],
+            bytes(2) + message_request,
+            ADDRESS_ITEM['Connection Based'],
+            addr_data=cid,)
+    # command and length followed by session handle, status, sender
+    # context and options
+    return command + pack_uint(len(packet)) + bytes(20) + packet
+
+
+@lru_cache(maxsize=REQUEST_CACHE_SIZE)
+def build_cached_frame(service, clss, inst, attr=None, cid=None):
+    """ build_frame for a request with no data, cached """
+    message_request = build_request(service, encode_path(clss, inst, attr))
+    return build_frame(message_request, cid)
+
+
+def build_multi(requests):
+    """ Build a Multiple Service Packet request """
+    message_request = [
+        bytes([MULTIPLE_SERVICE_PACKET]),
+        bytes([len(MESSAGE_ROUTER_PATH) // 2]),
+        MESSAGE_ROUTER_PATH,
+        struct.pack('<H', len(requests)),  # number of services
+    ]
+    # offsets are relative to the number of services field
+    offset = 2 + 2 * len(requests)
+    for request in requests:
+        message_request.append(struct.pack('<H', offset))
+        offset += len(request)
+    message_request.extend(requests)
+    return b''.join(message_request)
+
+
+def split_multi(requests, max_packet_size, reply_sizes=None):
+    """ Group requests into batches whose request and reply each fit in
+    one packet
+
+    reply_sizes is an optional list with the size of the Message Router
+    reply to each request, or None where it is not known, then
+    DEFAULT_REPLY_SIZE is assumed.
+    """
+    # service, path size, 4 byte path and service count
+    header_size = 8
+    # reply header and service count
+    reply_header_size = SERVICE_REPLY_SIZE + 2
+    if reply_sizes is None:
+        reply_sizes = [None] * len(requests)
+    batch = []
+    size = header_size
+    reply_size = reply_header_size
+    for request, expected in zip(requests, reply_sizes):
+        # each request and reply adds a 2 byte offset and its own length
+        request_size = 2 + len(request)
+        expected = 2 + (DEFAULT_REPLY_SIZE if expected is None else expected)
+        if batch and (size + request_size > max_packet_size or
+                      reply_size + expected > max_packet_size):
+            yield batch
+            batch = []
+            size = header_size
+            reply_size = reply_header_size
+        batch.append(request)
+        size += request_size
+        reply_size += expected
+    if batch:
+        yield batch
+
+
+def parse_service_reply(reply):
+    """ Return (general status, data) of a Message Router reply """
+    # service, reserved, general status, additional status size in
+    # words followed by the additional status and the reply data
+    status = reply[2]
+    data_start = 4 + 2 * reply[3]
+    return status, reply[data_start:]
+
+
+def parse_multi(data, count):
+    """ Return (general status, data) of each service in the data of a
+    Multiple Service Packet reply
+    """
+    offsets = list(struct.unpack_from('<{}H'.format(count), data, 2))
+    offsets.append(len(data))
+    replies = []
+    for start, end in zip(offsets, offsets[1:]):
+        replies.append(parse_service_reply(data[start:end]))
+    return replies
+
+
+def multi_status(status):
+    """ (error group, error message) for the status of one service """
+    if status == SUCCESS:
+        return (SUCCESS, '')
+    return (3, SERVICE_STATUS.get(status, hex(status)))
+
+
+def build_attribute_list(attributes):
+    """ Request data of a Get_Attribute_List for a list of attribute IDs
+    """
+    return struct.pack(
+        '<{}H'.format(len(attributes) + 1), len(attributes), *attributes)
+
+
+def parse_attribute_list(data, attributes, sizes):
+    """ Return (status, data) of each attribute in the data of a
+    Get_Attribute_List reply
+
+    The reply does not include the size of each attribute, sizes is the
+    size in bytes of each attribute requested. If the reply does not
+    match them, the attribute that does not and every attribute after it
+    are None, to be read again on their own.
+    """
+    replies = []
+    offset = 2
+    for expected, size in zip(attributes, sizes):
+        if offset + 4 > len(data) or \
+                struct.unpack_from('<H', data, offset)[0] != expected:
+            # the last attribute with data was not the size expected
+            break
+        status = struct.unpack_from('<H', data, offset + 2)[0]
+        offset += 4
+        if status != SUCCESS:
+            # no data follows a failed attribute
+            replies.append((status, None))
+            continue
+        if offset + size > len(data):
+            replies.append(None)
+            break
+        replies.append((status, data[offset:offset + size]))
+        offset += size
+    else:
+        if offset == len(data):
+            return replies
+    if replies and replies[-1] is not None:
+        # the reply lost its alignment after the last attribute with data
+        while replies and replies[-1][0] != SUCCESS:
+            replies.pop()
+        if replies:
+            replies[-1] = None
+    return replies + [None] * (len(attributes) - len(replies))
+
+
+def plan_attribute_lists(paths, sizes, max_packet_size, lists=True):
+    """ Plan the requests to get the attributes at paths
+
+    If lists is True, attributes of the same instance whose size is known
+    are read together with Get_Attribute_List requests, each with a reply
+    that fits in a Multiple Service Packet of max_packet_size, the others
+    with Get_Attribute_Single. Returns the Message Router requests, their
+    expected reply sizes for split_multi and, for each request, the
+    indexes of the paths it reads and whether it is a Get_Attribute_List.
+    """
+    paths = [expand_path(path) for path in paths]
+    # (class, instance) -> indexes of the paths that can be listed
+    instances = OrderedDict()
+    for index, (path, size) in enumerate(zip(paths, sizes)):
+        if lists and path[2] is not None and size is not None:
+            instances.setdefault(tuple(path[:2]), []).append(index)
+    # the Multiple Service Packet reply header, service count and offset
+    max_reply_size = max_packet_size - SERVICE_REPLY_SIZE - 4
+    requests = []
+    reply_sizes = []
+    plan = []
+    listed = set()
+    for (clss, inst), indexes in instances.items():
+        chunks = []
+        reply_size = max_reply_size
+        for index in indexes:
+            # attribute ID, status and data
+            attribute_size = 4 + sizes[index]
+            if reply_size + attribute_size > max_reply_size:
+                chunks.append([])
+                reply_size = ATTRIBUTE_LIST_REPLY_SIZE
+            chunks[-1].append(index)
+            reply_size += attribute_size
+        for chunk in chunks:
+            if len(chunk) < 2:
+                continue
+            requests.append(build_request(
+                GET_ATTRIBUTE_LIST, encode_path(clss, inst),
+                build_attribute_list([paths[i][2] for i in chunk])))
+            reply_sizes.append(ATTRIBUTE_LIST_REPLY_SIZE + sum(
+                4 + sizes[i] for i in chunk))
+            plan.append((chunk, True))
+            listed.update(chunk)
+    for index, path in enumerate(paths):
+        if index not in listed:
+            requests.append(
+                build_request(GET_ATTRIBUTE_SINGLE, encode_path(*path)))
+            reply_sizes.append(None if sizes[index] is None
+                               else SERVICE_REPLY_SIZE + sizes[index])
+            plan.append(([index], False))
+    return requests, reply_sizes, plan
+
+
+def unpack_attribute_lists(paths, sizes, plan, replies):
+    """ Return the values and statuses of paths from the (general
+    status, data) reply to each request of plan_attribute_lists
+
+    The status of an attribute whose list reply did not match the sizes
+    is None, it must be read again with Get_Attribute_Single. Values are
+    not copied from the replies.
+    """
+    values = [False] * len(paths)
+    statuses = [None] * len(paths)
+    for (indexes, is_list), (status, data) in zip(plan, replies):
+        if is_list and status in (SUCCESS, ATTRIBUTE_LIST_ERROR):
+            attributes = [expand_path(paths[i])[2] for i in indexes]
+            results = zip(indexes, parse_attribute_list(
+                data, attributes, [sizes[i] for i in indexes]))
+        else:
+            results = [(index, (status, data)) for index in indexes]
+        for index, reply in results:
+            if reply is None:
+                continue
+            status, data = reply
+            statuses[index] = multi_status(status)
+            if status == SUCCESS:
+                values[index] = data
+    return values, statuses
+
+
+def check_sizes(values, statuses, sizes):
+    """ Fail each value that is not the size expected, with the
+    INVALID_REPLY status
+    """
+    for index, size in enumerate(sizes):
+        if size is not None and values[index] is not False and \
+                len(values[index]) != size:
+            values[index] = False
+            statuses[index] = multi_status(INVALID_REPLY)
+    return values, statuses
+
+
+def build_forward_open(large, serial, connection_path):
+    """ Build a (Large) Forward_Open request for a class 3 connection """
+    if large:
+        service = LARGE_FORWARD_OPEN_SERVICE
+        params = struct.pack(
+            '<I', CONNECTION_PARAMS_LARGE | CONNECTION_SIZE_LARGE)
+    else:
+        service = FORWARD_OPEN_SERVICE
+        params = struct.pack(
+            '<H', CONNECTION_PARAMS_STANDARD | CONNECTION_SIZE_STANDARD)
+    return b''.join([
+        bytes([service]),
+        bytes([len(CONNECTION_MANAGER_PATH) // 2]),
+        CONNECTION_MANAGER_PATH,
+        bytes([0x0A, 0x05]),  # priority / time tick, timeout ticks
+        struct.pack('<II',
+                    0,  # O->T connection ID, chosen by the target
+                    random.randrange(1, 0x100000000)),  # T->O ID
+        struct.pack('<HHI', serial, ORIGINATOR_VENDOR_ID, ORIGINATOR_SERIAL),
+        bytes([0x01, 0x00, 0x00, 0x00]),  # timeout multiplier, reserved
+        struct.pack('<I', CONNECTED_RPI),  # O->T RPI
+        params,
+        struct.pack('<I', CONNECTED_RPI),  # T->O RPI
+        params,
+        bytes([TRANSPORT_CLASS_3]),
+        bytes([len(connection_path) // 2]),
+        connection_path,
+    ])
+
+
+ForwardOpenReply = namedtuple(
+    'ForwardOpenReply', ['o_t_cid', 't_o_cid', 'serial', 'o_t_api', 't_o_api'])
+
+
+def logical_segment(segment, value):
+    """ An 8 bit logical segment, or 16 bit if value does not fit """
+    if value <= 0xFF:
+        return bytes([segment, value])
+    return bytes([segment | 0x01, 0x00]) + struct.pack('<H', value)
+
+
+def build_io_path(config_instance, output_point, input_point):
+    """ Build the Assembly connection path of an I/O connection """
+    return b''.join([
+        bytes([0x20, ASSEMBLY_CLASS]),
+        logical_segment(0x24, config_instance),
+        logical_segment(CONNECTION_POINT_SEGMENT, output_point),
+        logical_segment(CONNECTION_POINT_SEGMENT, input_point),
+    ])
+
+
+def build_io_forward_open(serial, t_o_cid, connection_path, rpi,
+                          o_t_size, t_o_size, timeout_multiplier=1):
+    """ Build a Forward_Open request for a class 1 I/O connection
+
+    rpi is in microseconds for both directions, sizes are in bytes and
+    include the 2 byte sequence count.
+    """
+    return b''.join([
+        bytes([FORWARD_OPEN_SERVICE]),
+        bytes([len(CONNECTION_MANAGER_PATH) // 2]),
+        CONNECTION_MANAGER_PATH,
+        bytes([0x0A, 0x05]),  # priority / time tick, timeout ticks
+        struct.pack('<II',
+                    0,  # O->T connection ID, chosen by the target
+                    t_o_cid),
+        struct.pack('<HHI', serial, ORIGINATOR_VENDOR_ID, ORIGINATOR_SERIAL),
+        bytes([timeout_multiplier, 0x00, 0x00, 0x00]),
+        struct.pack('<IH', rpi, CONNECTION_PARAMS_IO | o_t_size),
+        struct.pack('<IH', rpi, CONNECTION_PARAMS_IO | t_o_size),
+        bytes([TRANSPORT_CLASS_1]),
+        bytes([len(connection_path) // 2]),
+        connection_path,
+    ])
+
+
+def parse_forward_open_reply(data):
+    """ Return the ForwardOpenReply in the data of a Forward_Open reply """
+    o_t_cid, t_o_cid, serial = struct.unpack_from('<IIH', data)
+    o_t_api, t_o_api = struct.unpack_from('<II', data, 16)
+    return ForwardOpenReply(o_t_cid, t_o_cid, serial, o_t_api, t_o_api)
+
+
+def build_forward_close(serial, connection_path):
+    """ Build a Forward_Close request """
+    return b''.join([
+        bytes([FORWARD_CLOSE_SERVICE]),
+        bytes([len(CONNECTION_MANAGER_PATH) // 2]),
+        CONNECTION_MANAGER_PATH,
+        bytes([0x0A, 0x05]),  # priority / time tick, timeout ticks
+        struct.pack('<HHI', serial, ORIGINATOR_VENDOR_ID, ORIGINATOR_SERIAL),
+        bytes([len(connection_path) // 2, 0]),
+        connection_path,
+    ])
+
+
+def locked(method):
+    """ Serialize calls on a driver shared by several blocks """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def pipelined(method):
+    """ Like locked, but unconnected requests of a driver with a window
+    are sent by each thread without waiting for the others
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.window > 1 and not self._target_is_connected:
+            return method(self, *args, **kwargs)
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
 
 class CIPDriver(Base):
+    """ Blocking CIP driver
 
-    def __init__(self):
+    window is the most requests outstanding at a time on the session, from
+    a call that needs more than one, such as Multiple Service Packets split
+    into several requests, and from get_attribute_single,
+    set_attribute_single and generic_service called by several threads.
+    Each request has a sender context of its own and replies are matched
+    to requests by it, in any order. The default of 1 waits for each reply
+    before sending the next request.
+    """
+
+    def __init__(self, window=1):
         super(CIPDriver, self).__init__()
+        self.window = max(window, 1)
 
         self._buffer = {}
         self._get_template_in_progress = False
+        self._lock = RLock()
+        # with a window, sender context -> (reply, when it was received) of
+        # each request sent, None until its reply arrives. The caller that
+        # is reading hands each reply to the caller it belongs to.
+        self._pending = {}
+        self._contexts = itertools.count(1)
+        self._slots = BoundedSemaphore(self.window)
+        self._arrived = Condition()
+        self._reading = False
+        self._send_lock = Lock()
+        self._connection_serial = None
+        self._connection_size = None
+        self._connection_path = None
+        self.max_packet_size = UNCONNECTED_PACKET_SIZE
+        # replies are received into this buffer and _reply is a view of
+        # it, valid until the next request
+        self._receive_buffer = bytearray(RECEIVE_BUFFER_SIZE)
+        self._receive_view = memoryview(self._receive_buffer)
+        # encode, rtt and decode time of each request and CIP status codes
+        self.metrics = Metrics()
+        # round trip of the last request of each thread
+        self._round_trips = local()
+        # when the current request, or batch of a request, started
+        self._started = perf_counter()
         self.__version__ = '0.2'
 
-    def get_attribute_single(self, clss, inst, attr=None):
+    def open(self, ip_address):
+        opened = super(CIPDriver, self).open(ip_address)
+        if opened and self.window > 1:
+            # send pipelined requests without waiting for earlier ACKs
+            self._socket().setsockopt(
+                socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return opened
+
+    def _socket(self):
+        """ The session's TCP socket, kept private by pycomm's Base """
+        return self._Base__sock.sock
+
+    def round_trip(self):
+        """ Seconds from sending the last request of the calling thread
+        until its reply was received, None before its first request
+        """
+        return getattr(self._round_trips, 'last', None)
+
+    @staticmethod
+    def cache_info():
+        """ Hits, misses and size of the encoded path and frame caches """
+        return {
+            'paths': encode_path.cache_info(),
+            'frames': build_cached_frame.cache_info(),
+        }
+
+    @pipelined
+    def get_attribute_single(self, clss, inst, attr=None, copy=True,
+                             raise_errors=False):
+        """ Get an attribute, or False if the request fails
+
+        The reply data is returned as bytes. If copy is False it is a
+        memoryview of the receive buffer instead, only valid until the next
+        request on this driver. If raise_errors is True a failed request
+        raises ServiceError, with its status, instead of returning False.
+        """
         self.clear()
-        path = self._get_path(clss, inst, attr)
-        message_request = [
-            bytes([0x0E]),  # get attribute single service
-            bytes([len(path) // 2]),  # the Request Path Size length in words
-            bytes(path),  # the request path
-        ]
-        packet = build_common_packet_format(
-            DATA_ITEM['Unconnected'],
-            b''.join(message_request),
-            ADDRESS_ITEM['UCMM'],)
-        if not self.send_rr_data(packet):
-            logger.warning(self._status)
-            raise DataError("send_rr_data failed")
-        if self._status[0] == SUCCESS:
-            # Unconnected Data Item Length
-            data_length = unpack_uint(self._reply[38:40])
-            # first 4 bytes indicate service and status
-            reply_length = data_length - 4
-            return self._reply[-reply_length:]
-        else:
+        try:
+            data = self._send_frame(build_cached_frame(
+                GET_ATTRIBUTE_SINGLE, clss, inst, attr, self._cid()))
+        except ServiceError:
+            if raise_errors:
+                raise
             return False
+        return bytes(data) if copy else data
 
-    def set_attribute_single(self, data, clss, inst, attr=None):
+    @pipelined
+    def set_attribute_single(self, data, clss, inst, attr=None,
+                             raise_errors=False):
+        """ Set an attribute, True on success, see get_attribute_single
+        for raise_errors
+        """
         self.clear()
         path = self._get_path(clss, inst, attr)
-        message_request = [
-            bytes([0x10]),  # set attribute single service
-            bytes([len(path) // 2]),  # the Request Path Size length in word
-            bytes(path),  # the request path
-            bytes(data),  # data to write, two bytes per word
-        ]
-        packet = build_common_packet_format(
-            DATA_ITEM['Unconnected'],
-            b''.join(message_request),
-            ADDRESS_ITEM['UCMM'],)
-        if not self.send_rr_data(packet):
-            logger.warning(self._status)
-            raise DataError("send_rr_data failed")
-        if self._status[0] == SUCCESS:
+        # data to write, two bytes per word
+        try:
+            self._send_request(
+                build_request(SET_ATTRIBUTE_SINGLE, path, data))
+        except ServiceError:
+            if raise_errors:
+                raise
+            return False
+        return True
+
+    @locked
+    def get_attribute_multi(self, paths, copy=True, sizes=None, lists=False):
+        """ Get many attributes using Multiple Service Packet requests
+
+        paths is a list of (class, instance[, attribute]) sequences. Returns
+        (values, statuses), a list with the reply data for each path, in
+        order, or False for each path that failed, and a list with the
+        (error group, error message) of each. Reply data is only returned
+        as memoryviews if
+        copy is False, lists is False and all the paths fit in a single
+        request, see get_attribute_single.
+
+        sizes is an optional list with the size in bytes of each
+        attribute, or None if it is not known. Packets are split so their
+        replies fit, and a reply of another size fails that attribute with
+        the INVALID_REPLY status. If lists is True, attributes of the same
+        instance with known sizes are read with one Get_Attribute_List
+        request instead of one request each.
+        """
+        if sizes is None:
+            sizes = [None] * len(paths)
+        requests, reply_sizes, plan = plan_attribute_lists(
+            paths, sizes, self.max_packet_size, lists)
+        values, statuses = unpack_attribute_lists(
+            paths, sizes, plan,
+            self._send_services(requests, copy or lists, reply_sizes))
+        # attributes of a list reply that did not match the sizes
+        indexes = [i for i, status in enumerate(statuses) if status is None]
+        if indexes:
+            requests, reply_sizes, plan = plan_attribute_lists(
+                [paths[i] for i in indexes], [sizes[i] for i in indexes],
+                self.max_packet_size, False)
+            for index, (status, data) in zip(
+                    indexes, self._send_services(requests, True, reply_sizes)):
+                statuses[index] = multi_status(status)
+                values[index] = data if status == SUCCESS else False
+        return check_sizes(values, statuses, sizes)
+
+    @locked
+    def get_attribute_list(self, clss, inst, attributes, sizes):
+        """ Get attributes of one instance with Get_Attribute_List
+
+        sizes is the size in bytes of each attribute. Returns (values,
+        statuses) like get_attribute_multi.
+        """
+        self.clear()
+        request = build_request(
+            GET_ATTRIBUTE_LIST, self._get_path(clss, inst, None),
+            build_attribute_list(attributes))
+        try:
+            data = self._send_request(request)
+        except ServiceError as e:
+            if e.status != ATTRIBUTE_LIST_ERROR:
+                return [False] * len(sizes), \
+                    [multi_status(e.status)] * len(sizes)
+            data = self._reply_data()[1]
+        replies = parse_attribute_list(data, attributes, sizes)
+        values = [
+            bytes(reply[1]) if reply is not None and reply[0] == SUCCESS
+            else False for reply in replies]
+        statuses = [
+            None if reply is None else multi_status(reply[0])
+            for reply in replies]
+        for index, reply in enumerate(replies):
+            if reply is not None:
+                continue
+            # the reply did not match the sizes, read it on its own
+            try:
+                values[index] = bytes(self._send_request(build_request(
+                    GET_ATTRIBUTE_SINGLE,
+                    self._get_path(clss, inst, attributes[index]))))
+                statuses[index] = multi_status(SUCCESS)
+            except ServiceError as e:
+                statuses[index] = multi_status(e.status)
+        return check_sizes(values, statuses, sizes)
+
+    @pipelined
+    def generic_service(self, service, clss, inst, attr=None, data=b'',
+                        copy=True, raise_errors=False):
+        """ Send any service to a path, with optional request data
+
+        Returns the reply data, or False if the target fails the request.
+        See get_attribute_single for copy and raise_errors.
+        """
+        self.clear()
+        try:
+            reply = self._send_request(build_request(
+                service, self._get_path(clss, inst, attr), data))
+        except ServiceError:
+            if raise_errors:
+                raise
+            return False
+        return bytes(reply) if copy else reply
+
+    @locked
+    def generic_service_multi(self, items):
+        """ Send many services using Multiple Service Packet requests
+
+        items is a list of (service, path, data) with path as in
+        get_attribute_multi. Returns (values, statuses), a list with the
+        reply data of each service, in order, or False for each one that
+        failed, and the status of each.
+        """
+        requests = [
+            build_request(service, self._get_path(*expand_path(path)), data)
+            for service, path, data in items]
+        return self._send_multi(requests)
+
+    @locked
+    def set_attribute_multi(self, items):
+        """ Set many attributes using Multiple Service Packet requests
+
+        items is a list of (data, path) pairs, with path as in
+        get_attribute_multi. Returns (results, statuses), a list with True
+        for each attribute that was set, in order, or False for each one
+        that failed, and the status of each.
+        """
+        requests = [
+            build_request(SET_ATTRIBUTE_SINGLE,
+                          self._get_path(*expand_path(path)), data)
+            for data, path in items]
+        values, statuses = self._send_multi(
+            requests, copy=False,
+            reply_sizes=[SERVICE_REPLY_SIZE] * len(requests))
+        return [value is not False for value in values], statuses
+
+    @locked
+    def open_connection(self, large=True, route=b''):
+        """ Open a class 3 connection to the Message Router
+
+        Once connected, all requests are sent as connected messages with
+        SendUnitData. A Large Forward_Open is tried first if large is True,
+        falling back to a standard Forward_Open if the target does not
+        support it. route is an optional port segment path to prepend to
+        the Message Router path, such as bytes([0x01, slot]) to reach a
+        controller in the backplane.
+        """
+        if self._target_is_connected:
             return True
+        if self._session == 0:
+            self._status = (4, "A session need to be registered before to "
+                               "call open_connection.")
+            raise CommError("A session need to be registered before to "
+                            "call open_connection.")
+        if large:
+            if self._forward_open(True, route):
+                return True
+            if self._reply_status() != SERVICE_NOT_SUPPORTED:
+                return False
+        return self._forward_open(False, route)
+
+    @locked
+    def open_io_connection(self, connection_path, rpi, input_size,
+                           output_size=0, timeout_multiplier=1):
+        """ Open a class 1 I/O connection with a Forward_Open
+
+        connection_path is from build_io_path, with an optional route
+        prepended, rpi is in microseconds and input_size and output_size
+        are the T->O and O->T data sizes in bytes. Returns a
+        ForwardOpenReply with the actual connection IDs and packet
+        intervals, and the connection serial number to close it with, or
+        False if the connection is refused.
+        """
+        self.clear()
+        serial = random.randrange(0x10000)
+        message_request = build_io_forward_open(
+            serial, random.randrange(1, 0x100000000), connection_path, rpi,
+            output_size + 2, input_size + 2, timeout_multiplier)
+        try:
+            # I/O connections are opened unconnected
+            data = self._send_frame(build_frame(message_request))
+        except DataError:
+            return False
+        return parse_forward_open_reply(data)
+
+    @locked
+    def close_io_connection(self, serial, connection_path):
+        """ Close an I/O connection opened with open_io_connection """
+        self.clear()
+        try:
+            self._send_frame(build_frame(
+                build_forward_close(serial, connection_path)))
+        except DataError:
+            return False
+        return True
+
+    def read_fragmented(self, service, clss, inst, attr=None, data=b'',
+                        before_request=None):
+        """ Yield the reply data of a service read in fragments
+
+        The service is sent with data followed by the UDINT byte offset of
+        the next fragment until the target replies without the partial
+        transfer status. Each fragment is yielded as bytes when it is
+        received, raises ServiceError if the target fails a request.
+        before_request, if given, is called before each request is sent.
+        """
+        data = bytes(data)
+        offset = 0
+        while True:
+            status, fragment = self._fragment(
+                service, clss, inst, attr, data + struct.pack('<I', offset),
+                before_request)
+            yield fragment
+            if status != PARTIAL_TRANSFER:
+                return
+            if not fragment:
+                raise DataError('Partial transfer without data')
+            offset += len(fragment)
+
+    def upload_file(self, instance, transfer_size=FILE_TRANSFER_SIZE,
+                    before_request=None):
+        """ Yield the contents of a File Object instance
+
+        The file is uploaded with Initiate_Upload and Upload_Transfer, in
+        transfers of at most transfer_size bytes, each yielded as bytes
+        when it is received. Raises DataError if the file's checksum or
+        size do not match, or ServiceError if the target fails a request.
+        before_request, if given, is called before each request is sent.
+        """
+        _, reply = self._fragment(
+            INITIATE_UPLOAD, FILE_CLASS, instance, None,
+            bytes([min(transfer_size, FILE_TRANSFER_SIZE)]), before_request)
+        file_size = struct.unpack_from('<I', reply)[0]
+        number = 0
+        size = 0
+        total = 0
+        while True:
+            _, reply = self._fragment(
+                UPLOAD_TRANSFER, FILE_CLASS, instance, None, bytes([number]),
+                before_request)
+            if reply[0] != number:
+                raise DataError('Upload_Transfer reply for transfer {}, '
+                                'expected {}'.format(reply[0], number))
+            last = reply[1] in (LAST_PACKET, FIRST_AND_LAST_PACKET)
+            data = reply[2:-2] if last else reply[2:]
+            size += len(data)
+            total += sum(data)
+            if last:
+                checksum = struct.unpack_from('<H', reply, len(reply) - 2)[0]
+                if (total + checksum) & 0xFFFF:
+                    raise DataError('File checksum does not match')
+                if size != file_size:
+                    raise DataError('Uploaded {} bytes of a {} byte '
+                                    'file'.format(size, file_size))
+            yield data
+            if last:
+                return
+            number = (number + 1) & 0xFF
+
+    def _fragment(self, service, clss, inst, attr, data,
+                  before_request=None):
+        if before_request is not None:
+            before_request()
+        return self._send_fragment(build_request(
+            service, self._get_path(clss, inst, attr), data))
+
+    @locked
+    def _send_fragment(self, message_request):
+        """ Return (general status, reply data) of a request, a partial
+        transfer is not an error
+        """
+        self.clear()
+        try:
+            reply = self._send_request(message_request)
+        except ServiceError as e:
+            if e.status != PARTIAL_TRANSFER:
+                raise
+            return e.status, bytes(self._reply_data()[1])
+        return SUCCESS, bytes(reply)
+
+    @locked
+    def nop(self):
+        with self._send_lock:
+            return super(CIPDriver, self).nop()
+
+    @locked
+    def forward_close(self):
+        """ Close the connection opened with open_connection
+
+        Called by close(), does nothing if there is no open connection.
+        """
+        if not self._target_is_connected:
+            return True
+        # send the Forward_Close unconnected
+        self._target_is_connected = False
+        self.max_packet_size = UNCONNECTED_PACKET_SIZE
+        message_request = build_forward_close(
+            self._connection_serial, self._connection_path)
+        try:
+            self._send_request(message_request)
+        except DataError:
+            self._status = (5, "forward_close returned False")
+            logger.warning(self._status)
+            return False
+        return True
+
+    def _forward_open(self, large, route):
+        self._connection_serial = random.randrange(0x10000)
+        self._connection_path = bytes(route) + MESSAGE_ROUTER_PATH
+        if large:
+            self._connection_size = CONNECTION_SIZE_LARGE
         else:
+            self._connection_size = CONNECTION_SIZE_STANDARD
+        message_request = build_forward_open(
+            large, self._connection_serial, self._connection_path)
+        try:
+            data = self._send_request(message_request)
+        except DataError:
             return False
+        self._target_cid = bytes(data[:4])
+        self._target_is_connected = True
+        # the sequence count is part of the connection size
+        self.max_packet_size = self._connection_size - 2
+        return True
+
+    def _send_request(self, message_request):
+        """ Send a Message Router request and return the reply data
+
+        The request is sent connected if a connection is open, otherwise
+        it is sent unconnected through UCMM.
+        """
+        return self._send_frame(build_frame(message_request, self._cid()))
+
+    def clear(self):
+        super(CIPDriver, self).clear()
+        self._started = perf_counter()
+
+    def _send_frame(self, frame):
+        """ Send a frame from build_frame and return the reply data
+
+        The time since the request started is recorded as encode, the time
+        until the reply is received as rtt and the time to check the reply
+        as decode.
+        """
+        frame = bytearray(frame)
+        frame[SESSION_OFFSET:SESSION_OFFSET + 4] = pack_dint(self._session)
+        if self._target_is_connected:
+            frame[SEQUENCE_OFFSET:SEQUENCE_OFFSET + 2] = \
+                pack_uint(self._get_sequence())
+        if self.window > 1:
+            return self._send_windowed(frame)
+        frame[CONTEXT_OFFSET:CONTEXT_OFFSET + 8] = self.attribs['context']
+        self._message = bytes(frame)
+        sent = perf_counter()
+        self._send()
+        self._receive()
+        return self._reply_result(sent, perf_counter())
+
+    def _reply_result(self, sent, received):
+        """ Return the data of the reply just received, raise
+        ServiceError if the target failed the request
+        """
+        try:
+            if not self._check_reply():
+                logger.warning(self._status)
+                if self._service_failed():
+                    raise ServiceError(self._status[1], self._reply_status())
+                if self._target_is_connected:
+                    raise DataError("send_unit_data failed")
+                raise DataError("send_rr_data failed")
+            status, data = self._reply_data()
+        finally:
+            self._record(sent, received)
+        return data
+
+    def _record(self, sent, received):
+        """ Record the timing and status of the request just sent """
+        done = perf_counter()
+        self.metrics.increment('requests')
+        self.metrics.record('encode', sent - self._started)
+        self.metrics.record('rtt', received - sent)
+        self.metrics.record('decode', done - received)
+        self._round_trips.last = received - sent
+        try:
+            self.metrics.status(self._reply_status())
+        except IndexError:
+            # an encapsulation error without a Message Router reply
+            pass
+        # the next batch of the request starts now
+        self._started = done
+
+    def _cid(self):
+        """ The connection to send requests on, None if unconnected """
+        if self._target_is_connected:
+            return self._target_cid
+        return None
+
+    def _send_multi(self, requests, copy=True, reply_sizes=None):
+        """ Return the (values, statuses) of requests """
+        values = []
+        statuses = []
+        for status, data in self._send_services(
+                requests, copy, reply_sizes):
+            statuses.append(multi_status(status))
+            values.append(data if status == SUCCESS else False)
+        return values, statuses
+
+    def _send_services(self, requests, copy=True, reply_sizes=None):
+        """ Send requests in Multiple Service Packets and return the
+        (general status, data) of each reply
+
+        See split_multi for reply_sizes. A packet whose reply is still too
+        large is sent again in two halves.
+        """
+        self.clear()
+        replies = []
+        batches = list(
+            split_multi(requests, self.max_packet_size, reply_sizes))
+        # views of an earlier reply do not survive the next request
+        copy = copy or len(batches) > 1
+        for batch, data in zip(batches, self._send_batches(batches)):
+            if isinstance(data, ServiceError) and \
+                    data.status == REPLY_DATA_TOO_LARGE and len(batch) > 1:
+                half = len(batch) // 2
+                for part in (batch[:half], batch[half:]):
+                    replies.extend(self._send_services(
+                        part, reply_sizes=[0] * len(part)))
+                continue
+            if isinstance(data, ServiceError):
+                # the target failed the whole Multiple Service Packet
+                replies.extend([(data.status, b'')] * len(batch))
+                continue
+            for status, data in parse_multi(data, len(batch)):
+                self.metrics.status(status)
+                replies.append((status, bytes(data) if copy else data))
+        return replies
+
+    def _send_batches(self, batches):
+        """ Send each batch in a Multiple Service Packet and return the
+        reply data of each, or the ServiceError it failed with
+        """
+        message_requests = [build_multi(batch) for batch in batches]
+        if self.window > 1 and len(batches) > 1 and \
+                not self._target_is_connected:
+            return self._send_pipelined(message_requests)
+        return self._send_each(message_requests)
+
+    def _send_each(self, message_requests):
+        for message_request in message_requests:
+            try:
+                yield self._send_request(message_request)
+            except ServiceError as e:
+                yield e
+
+    def _send_pipelined(self, message_requests):
+        """ Send unconnected requests with up to window outstanding
+
+        Returns the reply data of each request as bytes, in order, or the
+        ServiceError the target failed it with. Replies may arrive in any
+        order, each is matched to its request by the sender context.
+        """
+        results = [None] * len(message_requests)
+        # sender context -> (index of the request, when it was sent)
+        pending = {}
+        sent = 0
+        try:
+            while sent < len(message_requests) or pending:
+                # only wait for a slot of the window with no reply to wait
+                # for, the slots may be taken by other threads
+                while sent < len(message_requests) and \
+                        self._slots.acquire(blocking=not pending):
+                    frame = bytearray(build_frame(message_requests[sent]))
+                    frame[SESSION_OFFSET:SESSION_OFFSET + 4] = \
+                        pack_dint(self._session)
+                    context, request_sent = self._submit(frame)
+                    pending[context] = (sent, request_sent)
+                    sent += 1
+                context, reply, received = self._await_reply(list(pending))
+                index, request_sent = pending.pop(context)
+                self._reply = memoryview(reply)
+                # requests overlap, the encode time ends at the earliest send
+                self._started = min(self._started, request_sent)
+                try:
+                    results[index] = bytes(
+                        self._reply_result(request_sent, received))
+                except ServiceError as e:
+                    results[index] = e
+        except Exception:
+            # read the replies still on their way, so they do not hold
+            # slots of the window
+            self._drain(pending)
+            raise
+        return results
+
+    def _send_windowed(self, frame):
+        """ Send a frame from build_frame in a slot of the window and
+        return the reply data, see _send_frame
+        """
+        self._slots.acquire()
+        context, sent = self._submit(frame)
+        _, reply, received = self._await_reply([context])
+        with self._lock:
+            self._reply = memoryview(reply)
+            # requests overlap, the encode time ends at the earliest send
+            self._started = min(self._started, sent)
+            return self._reply_result(sent, received)
+
+    def _submit(self, frame):
+        """ Send a frame with a sender context of its own and return
+        (sender context, when it was sent)
+
+        The caller holds a slot of the window, it is released when the
+        reply arrives.
+        """
+        with self._arrived:
+            context = struct.pack('<Q', next(self._contexts))
+            self._pending[context] = None
+        frame[CONTEXT_OFFSET:CONTEXT_OFFSET + 8] = context
+        try:
+            with self._send_lock:
+                self._message = bytes(frame)
+                sent = perf_counter()
+                self._send()
+        except Exception:
+            with self._arrived:
+                del self._pending[context]
+            self._slots.release()
+            raise
+        return context, sent
+
+    def _await_reply(self, contexts):
+        """ Wait for the reply to any of contexts and return (sender
+        context, reply, when it was received)
+
+        If no other caller is reading, the next reply is received for
+        whichever caller it belongs to.
+        """
+        with self._arrived:
+            while True:
+                for context in contexts:
+                    arrived = self._pending[context]
+                    if arrived is None:
+                        continue
+                    del self._pending[context]
+                    if isinstance(arrived, Exception):
+                        raise arrived
+                    return (context,) + arrived
+                if self._reading:
+                    self._arrived.wait()
+                else:
+                    self._receive_pending()
+
+    def _receive_pending(self):
+        """ Receive the next reply and hand it to the request it belongs
+        to, called with _arrived held
+
+        If receiving fails, or the reply has an unknown sender context,
+        every request waiting for a reply fails and the socket is closed,
+        the replies still on their way can not be told apart.
+        """
+        self._reading = True
+        self._arrived.release()
+        try:
+            reply = bytes(self._receive_reply())
+            failure = None
+        except Exception as e:
+            failure = e
+        received = perf_counter()
+        self._arrived.acquire()
+        self._reading = False
+        self._arrived.notify_all()
+        if failure is None:
+            context = reply[CONTEXT_OFFSET:CONTEXT_OFFSET + 8]
+            if context in self._pending and self._pending[context] is None:
+                self._pending[context] = (reply, received)
+                self._slots.release()
+                return
+            failure = DataError('Reply with an unknown sender context')
+        for context, arrived in self._pending.items():
+            if arrived is None:
+                self._pending[context] = failure
+                self._slots.release()
+        try:
+            self._socket().close()
+        except Exception:
+            # the session is closed already
+            pass
+
+    def _drain(self, contexts):
+        """ Wait for the replies to contexts and drop them """
+        for context in contexts:
+            try:
+                self._await_reply([context])
+            except Exception:
+                # the session failed, the caller raises already
+                pass
+
+    def _receive(self):
+        """ Receive a reply into the receive buffer without copying it """
+        self._reply = self._receive_reply()
+
+    def _receive_reply(self):
+        """ Receive a reply into the receive buffer and return a view of
+        it, valid until the next reply is received
+        """
+        sock = self._socket()
+        view = self._receive_view
+        received = 0
+        length = HEADER_SIZE
+        try:
+            while received < length:
+                count = sock.recv_into(view[received:length])
+                if count == 0:
+                    raise CommError("socket connection broken.")
+                received += count
+                if received == HEADER_SIZE:
+                    # the header is complete, receive the encapsulated data
+                    length += struct.unpack_from(
+                        '<H', self._receive_buffer, 2)[0]
+        except socket.error as e:
+            raise CommError(e)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(print_bytes_msg(
+                bytes(view[:length]), '----------- RECEIVE -----------'))
+        return view[:length]
+
+    def _reply_command(self):
+        return struct.unpack_from('<H', self._reply)[0]
+
+    def _reply_offsets(self):
+        """ Offsets of the data item length and the Message Router reply
+        in _reply
+        """
+        if self._reply_command() == SEND_UNIT_DATA:
+            return CONNECTED_LENGTH_OFFSET, CONNECTED_REPLY_OFFSET
+        return UNCONNECTED_LENGTH_OFFSET, UNCONNECTED_REPLY_OFFSET
+
+    def _reply_data(self):
+        """ Return (general status, data) of the message router reply, data
+        is a memoryview of _reply
+        """
+        length_offset, offset = self._reply_offsets()
+        data_length = struct.unpack_from('<H', self._reply, length_offset)[0]
+        reply = self._reply[offset:length_offset + 2 + data_length]
+        return parse_service_reply(reply)
+
+    def _service_failed(self):
+        """ True if the last reply was a CIP error status rather than an
+        encapsulation error
+        """
+        return self._reply is not None and \
+            struct.unpack_from('<I', self._reply, 8)[0] == SUCCESS and \
+            self._reply_command() in (SEND_RR_DATA, SEND_UNIT_DATA)
+
+    def _reply_status(self):
+        if self._reply is None:
+            return None
+        return self._reply[self._reply_offsets()[1] + 2]
 
     def _get_path(self, clss, inst, attr):
-        if 65535 > inst > 255:
-            inst_header = [0x25, 0x00]
-            inst = struct.pack('<H', inst)
-        elif inst > 65535:
-            inst_header = [0x26, 0x00]
-            inst = struct.pack('<I', inst)
-        else:
-            inst_header = [0x24]
-            inst = [inst]
-        path = [0x20, clss]
-        path.extend(inst_header)
-        path.extend(list(inst))
-        if attr != None:
-            path.extend([0x30, attr])
-        return path
+        return encode_path(clss, inst, attr)
 
     def _check_reply(self):
         """ check the reply message for error
@@ -82,27 +1292,37 @@ class CIPDriver(Base):
                 self._status = (3, '{} without reply'.format(
                     REPLAY_INFO[unpack_dint(self._message[:2])]))
                 return False
-            # Get the type of command
-            typ = unpack_uint(self._reply[:2])
+            # Get the type of command and the encapsulation status
+            typ, _, _, status = struct.unpack_from('<HHII', self._reply)
 
             # Encapsulation status check
-            if unpack_dint(self._reply[8:12]) != SUCCESS:
+            if status != SUCCESS:
                 self._status = (3, "{0} reply status:{1}".format(
-                    REPLAY_INFO[typ],
-                    SERVICE_STATUS[unpack_dint(self._reply[8:12])]))
+                    REPLAY_INFO[typ], SERVICE_STATUS[status]))
                 return False
 
             # Command Specific Status check
-            if typ == unpack_uint(ENCAPSULATION_COMMAND["send_rr_data"]):
-                status = unpack_usint(self._reply[42:43])
-                if status != SUCCESS:
-                    status_msg = "send_rr_data reply:{0} - Extend status:{1}"
-                    self._status = (3, status_msg.format(
-                        SERVICE_STATUS[status],
-                        get_extended_status(self._reply, 42)))
-                    return False
-                else:
-                    return True
-            return True
+            if typ == SEND_RR_DATA:
+                command = "send_rr_data"
+            elif typ == SEND_UNIT_DATA:
+                command = "send_unit_data"
+            else:
+                return True
+            offset = self._reply_offsets()[1]
+            status = self._reply[offset + 2]
+            service = self._reply[offset] & 0x7F
+            if service == MULTIPLE_SERVICE_PACKET and \
+                    status == EMBEDDED_SERVICE_ERROR:
+                # per-service status is checked by _parse_multi
+                return True
+            if status != SUCCESS:
+                status_msg = "{0} reply:{1} - Extend status:{2}"
+                self._status = (3, status_msg.format(
+                    command,
+                    SERVICE_STATUS.get(status, hex(status)),
+                    get_extended_status(self._reply, offset + 2)))
+                return False
+            else:
+                return True
         except Exception as e:
             raise DataError(e)
@@ -0,0 +1,143 @@
+import struct
+import sys
+from array import array
+from enum import Enum
+
+
+class DataType(Enum):
+    RAW = 'RAW'
+    BOOL = 'BOOL'
+    SINT = 'SINT'
+    INT = 'INT'
+    DINT = 'DINT'
+    LINT = 'LINT'
+    USINT = 'USINT'
+    UINT = 'UINT'
+    UDINT = 'UDINT'
+    ULINT = 'ULINT'
+    REAL = 'REAL'
+    LREAL = 'LREAL'
+    SHORT_STRING = 'SHORT_STRING'
+    STRING = 'STRING'
+    STRUCT = 'STRUCT'
+
+
+# struct format of each elementary data type, CIP data is little endian
+FORMATS = {
+    DataType.BOOL: '?',
+    DataType.SINT: 'b',
+    DataType.INT: 'h',
+    DataType.DINT: 'i',
+    DataType.LINT: 'q',
+    DataType.USINT: 'B',
+    DataType.UINT: 'H',
+    DataType.UDINT: 'I',
+    DataType.ULINT: 'Q',
+    DataType.REAL: 'f',
+    DataType.LREAL: 'd',
+}
+# size of the length prefix of each string type
+STRING_LENGTHS = {
+    DataType.SHORT_STRING: struct.Struct('<B'),
+    DataType.STRING: struct.Struct('<H'),
+}
+STRING_ENCODING = 'latin-1'
+# array typecodes with the same meaning as each struct format, the first
+# one of the same size is used
+_TYPECODES = {
+    'b': 'b', 'B': 'B', 'h': 'h', 'H': 'H', 'i': 'il', 'I': 'IL',
+    'q': 'ql', 'Q': 'QL', 'f': 'f', 'd': 'd',
+}
+
+
+def compile_decoder(data_type, is_array=False, layout=''):
+    """ Compile a function decoding reply data of data_type
+
+    Returns None for RAW data, which is not decoded. Arrays of elementary
+    types are decoded to lists with array, structures are decoded to
+    lists of their members with a layout of struct format characters, in
+    little endian unless the layout starts with a byte order character.
+    The decoders raise ValueError or struct.error if the data does not
+    match the type.
+    """
+    data_type = DataType(data_type)
+    if data_type is DataType.RAW:
+        return None
+    if data_type in STRING_LENGTHS:
+        return _string_decoder(STRING_LENGTHS[data_type], is_array)
+    if data_type is DataType.STRUCT:
+        if not layout:
+            raise ValueError('STRUCT data requires a layout')
+        if layout[0] not in '@=<>!':
+            layout = '<' + layout
+        return _struct_decoder(struct.Struct(layout), is_array)
+    fmt = FORMATS[data_type]
+    if is_array:
+        return _array_decoder(fmt)
+    element = struct.Struct('<' + fmt)
+    return lambda data: element.unpack_from(data)[0]
+
+
+def data_size(data_type, is_array=False, layout=''):
+    """ The size in bytes of data of data_type, or None if it is not
+    fixed, such as RAW data, strings and arrays
+    """
+    data_type = DataType(data_type)
+    if is_array or data_type is DataType.RAW or data_type in STRING_LENGTHS:
+        return None
+    if data_type is DataType.STRUCT:
+        if not layout:
+            return None
+        if layout[0] not in '@=<>!':
+            layout = '<' + layout
+        return struct.calcsize(layout)
+    return struct.calcsize('<' + FORMATS[data_type])
+
+
+def _array_decoder(fmt):
+    size = struct.calcsize('<' + fmt)
+    for typecode in _TYPECODES.get(fmt, ''):
+        if array(typecode).itemsize == size:
+            break
+    else:
+        # no array type of the same size, such as BOOL
+        element = struct.Struct('<' + fmt)
+        return lambda data: [
+            value for value, in element.iter_unpack(data)]
+
+    def decode(data):
+        values = array(typecode)
+        values.frombytes(data)
+        if sys.byteorder != 'little':
+            values.byteswap()
+        return values.tolist()
+    return decode
+
+
+def _struct_decoder(layout, is_array):
+    if is_array:
+        return lambda data: [
+            list(values) for values in layout.iter_unpack(data)]
+    return lambda data: list(layout.unpack_from(data))
+
+
+def _string_decoder(length, is_array):
+    def decode_one(data, offset):
+        size, = length.unpack_from(data, offset)
+        start = offset + length.size
+        if start + size > len(data):
+            raise ValueError('string is longer than the data')
+        value = bytes(data[start:start + size]).decode(STRING_ENCODING)
+        return value, start + size
+
+    if not is_array:
+        return lambda data: decode_one(data, 0)[0]
+
+    def decode(data):
+        values = []
+        offset = 0
+        while offset < len(data):
+            value, offset = decode_one(data, offset)
+            values.append(value)
+        return values
+    return decode
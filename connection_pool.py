@@ -0,0 +1,159 @@
+from collections import defaultdict
+from threading import Lock
+
+from pycomm.cip.cip_base import CommError
+
+
+DEFAULT_PORT = 44818
+
+
+class ConnectionPool(object):
+    """ Process-wide pool of CIPDriver sessions
+
+    Sessions are shared by every block connecting to the same host and
+    port, up to max_sessions per host, and each is closed when the last
+    block borrowing it checks it back in. A broken session is retired: it
+    is no longer shared, and is closed when its last borrower checks it
+    in. A session that fails to open is closed and never shared.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        # (host, port, connected, asynchronous, window, kind) ->
+        #     list of [driver, borrower count]
+        self._sessions = defaultdict(list)
+        # [driver, borrower count] of sessions retired while borrowed
+        self._retired = []
+        # serializes opening sessions to the same host without blocking
+        # checkouts for other hosts, key -> [lock, checkouts using it],
+        # dropped with the key's last session
+        self._host_locks = {}
+
+    def checkout(self, factory, host, port=DEFAULT_PORT, connected=False,
+                 max_sessions=1, asynchronous=False, window=1,
+                 kind='CIP'):
+        """ Borrow an open session to host:port
+
+        A new session is created with factory() and opened if there are
+        fewer than max_sessions to this host, otherwise the healthy session
+        with the fewest borrowers is shared. Sessions used for connected
+        messaging are not shared with unconnected ones, asynchronous
+        sessions are not shared with blocking ones, and sessions are only
+        shared by blocks pipelining the same window of requests and
+        creating the same kind of driver with factory. Raises CommError if
+        a new session cannot be opened.
+        """
+        key = (host, port, connected, asynchronous, window, kind)
+        with self._lock:
+            host_lock = self._host_locks.setdefault(key, [Lock(), 0])
+            host_lock[1] += 1
+        try:
+            with host_lock[0]:
+                return self._checkout(factory, key, max_sessions)
+        finally:
+            with self._lock:
+                host_lock[1] -= 1
+                self._prune(key)
+
+    def _checkout(self, factory, key, max_sessions):
+        host, port = key[:2]
+        for entry in self._entries(key):
+            if not self._healthy(entry[0]):
+                self._retire(key, entry[0])
+        with self._lock:
+            sessions = self._sessions[key]
+            if len(sessions) >= max(max_sessions, 1):
+                entry = min(sessions, key=lambda entry: entry[1])
+                entry[1] += 1
+                return entry[0]
+        driver = factory()
+        driver['port'] = port
+        if not driver.open(host):
+            # the session was not registered, it is not shared
+            status = driver.get_status()
+            self._close(driver)
+            raise CommError('Unable to open a session to {}: {}'.format(
+                host, status))
+        with self._lock:
+            self._sessions[key].append([driver, 1])
+        return driver
+
+    def checkin(self, driver, discard=False):
+        """ Return a borrowed session to the pool
+
+        The session is closed when it has no more borrowers. If discard is
+        True the session is assumed broken and is retired, if it has not
+        been already, so it is not shared again. It is only closed when the
+        other borrowers using it check it in too, after their next request
+        fails.
+        """
+        with self._lock:
+            for key, sessions in [
+                    *self._sessions.items(), (None, self._retired)]:
+                entry = next(
+                    (entry for entry in sessions if entry[0] is driver),
+                    None)
+                if entry is not None:
+                    break
+            else:
+                return
+            entry[1] -= 1
+            if discard and sessions is not self._retired:
+                sessions.remove(entry)
+                self._retired.append(entry)
+                self._prune(key)
+                sessions = self._retired
+            if entry[1] > 0:
+                return
+            sessions.remove(entry)
+            retired = sessions is self._retired
+            if not retired:
+                self._prune(key)
+        if retired:
+            self._close(driver)
+        else:
+            driver.close()
+
+    def _entries(self, key):
+        with self._lock:
+            return list(self._sessions.get(key, ()))
+
+    def _retire(self, key, driver):
+        with self._lock:
+            for entry in self._sessions.get(key, ()):
+                if entry[0] is driver:
+                    self._sessions[key].remove(entry)
+                    self._retired.append(entry)
+                    self._prune(key)
+                    return
+
+    def _prune(self, key):
+        """ Forget a key without sessions, and its lock unless a checkout
+        is using it, called with _lock held
+        """
+        if self._sessions.get(key):
+            return
+        self._sessions.pop(key, None)
+        host_lock = self._host_locks.get(key)
+        if host_lock is not None and not host_lock[1]:
+            del self._host_locks[key]
+
+    def _healthy(self, driver):
+        if not driver.is_connected():
+            return False
+        try:
+            # a NOP has no reply but fails if the socket is broken
+            driver.nop()
+        except Exception:
+            return False
+        return True
+
+    def _close(self, driver):
+        try:
+            driver.close()
+        except Exception:
+            # the session is already broken
+            pass
+
+
+connection_pool = ConnectionPool()
@@ -0,0 +1,84 @@
+import random
+from threading import Lock
+from time import monotonic
+
+
+# seconds to wait after the second consecutive failure to reach a host,
+# doubled after every further failure up to MAX_BACKOFF
+INITIAL_BACKOFF = 0.5
+MAX_BACKOFF = 30.0
+# fraction of each wait that is random, so that blocks and hosts do not
+# reconnect in lockstep
+JITTER = 0.5
+
+
+class HostDown(Exception):
+    """ The host is down and not due to be retried yet """
+
+
+class ConnectionState(object):
+    """ Whether a host is up, and when to try connecting to it again
+
+    The first reconnect after a transport failure is immediate. After that
+    the host is down, requests to it fail fast and one reconnect is allowed
+    each backoff, growing exponentially with jitter until it succeeds.
+    """
+
+    def __init__(self, initial=INITIAL_BACKOFF, maximum=MAX_BACKOFF,
+                 jitter=JITTER):
+        self.initial = initial
+        self.maximum = maximum
+        self.jitter = jitter
+        # consecutive failures
+        self.failures = 0
+        self.fast_failed = 0
+        self._retry_at = 0.0
+        self._lock = Lock()
+
+    @property
+    def up(self):
+        return self.failures == 0
+
+    def attempt(self):
+        """ True if a connection may be attempted now, False to fail fast
+
+        While the host is down, other callers fail fast until the attempt
+        succeeds or fails.
+        """
+        with self._lock:
+            now = monotonic()
+            if now < self._retry_at:
+                self.fast_failed += 1
+                return False
+            if self.failures:
+                self._retry_at = now + self._backoff()
+            return True
+
+    def succeeded(self):
+        with self._lock:
+            self.failures = 0
+            self._retry_at = 0.0
+
+    def failed(self):
+        """ Record a transport failure, returns the seconds until the host
+        is retried
+        """
+        with self._lock:
+            self.failures += 1
+            delay = self._backoff() if self.failures > 1 else 0.0
+            self._retry_at = monotonic() + delay
+            return delay
+
+    def stats(self):
+        with self._lock:
+            return {
+                'up': self.failures == 0,
+                'failures': self.failures,
+                'fast_failed': self.fast_failed,
+                'retry_in': max(self._retry_at - monotonic(), 0.0),
+            }
+
+    def _backoff(self):
+        delay = min(
+            self.initial * 2 ** max(self.failures - 2, 0), self.maximum)
+        return delay * (1 - self.jitter * random.random())
@@ -0,0 +1,155 @@
+import ipaddress
+import socket
+import struct
+from collections import namedtuple
+from itertools import count
+from time import monotonic
+
+from .cip_driver import CONTEXT_OFFSET
+
+
+# encapsulation command of ListIdentity, sent over UDP to the EtherNet/IP
+# port of every target at once
+LIST_IDENTITY = 0x63
+# encapsulation header: command, length, session handle, status, sender
+# context and options
+HEADER = struct.Struct('<HHII8sI')
+# the CIP Identity item of a ListIdentity reply: item count, item type and
+# length, encapsulation protocol version, the target's socket address in
+# network byte order, then the Identity object's attributes
+IDENTITY_ITEM = 0x0C
+IDENTITY_HEADER = struct.Struct('<HHHH')
+SOCKET_ADDRESS = struct.Struct('>hHI8s')
+IDENTITY = struct.Struct('<HHHBBHI')
+ENCAPSULATION_VERSION = 1
+# most addresses swept with unicast requests, a /16 network
+MAX_TARGETS = 0x10000
+# largest UDP datagram
+BUFFER_SIZE = 0x10000
+
+Identity = namedtuple('Identity', [
+    'ip', 'port', 'vendor', 'device_type', 'product_code', 'revision',
+    'status', 'serial', 'product_name', 'state'])
+
+_contexts = count(1)
+
+
+def build_list_identity(context=bytes(8)):
+    return HEADER.pack(LIST_IDENTITY, 0, 0, 0, context, 0)
+
+
+def build_identity_item(identity):
+    """ Build the encapsulated data of the ListIdentity reply of a target
+    with identity
+    """
+    name = identity.product_name.encode()
+    major, minor = identity.revision
+    item = struct.pack('<H', ENCAPSULATION_VERSION) + SOCKET_ADDRESS.pack(
+        socket.AF_INET, identity.port,
+        int(ipaddress.IPv4Address(identity.ip)), bytes(8)) + IDENTITY.pack(
+        identity.vendor, identity.device_type, identity.product_code,
+        major, minor, identity.status, identity.serial) + \
+        bytes([len(name)]) + name + bytes([identity.state])
+    return struct.pack('<HHH', 1, IDENTITY_ITEM, len(item)) + item
+
+
+def parse_identity_reply(packet, address=None):
+    """ Return the Identity in a ListIdentity reply, or None if it is not
+    one
+
+    The target's own socket address is used unless it is 0.0.0.0, such as
+    from a target that does not know its address, then address, the IP
+    the reply came from.
+    """
+    try:
+        command, _, _, status, _, _ = HEADER.unpack_from(packet)
+        if command != LIST_IDENTITY or status:
+            return None
+        offset = HEADER.size
+        items, item_type, _, _ = IDENTITY_HEADER.unpack_from(packet, offset)
+        if not items or item_type != IDENTITY_ITEM:
+            return None
+        offset += IDENTITY_HEADER.size
+        _, port, ip, _ = SOCKET_ADDRESS.unpack_from(packet, offset)
+        offset += SOCKET_ADDRESS.size
+        vendor, device_type, product_code, major, minor, device_status, \
+            serial = IDENTITY.unpack_from(packet, offset)
+        offset += IDENTITY.size
+        name_length = packet[offset]
+        name = bytes(packet[offset + 1:offset + 1 + name_length])
+        state = packet[offset + 1 + name_length]
+    except (struct.error, IndexError):
+        return None
+    ip = str(ipaddress.IPv4Address(ip))
+    if ip == '0.0.0.0' and address is not None:
+        ip = address
+    return Identity(
+        ip, port, vendor, device_type, product_code, (major, minor),
+        device_status, serial, name.decode('ascii', 'replace'), state)
+
+
+def targets(address):
+    """ The addresses to send ListIdentity to: a broadcast address or host
+    as is, every host of a network such as 192.168.1.0/24
+    """
+    if '/' not in address:
+        return [address]
+    network = ipaddress.ip_network(address, strict=False)
+    if network.num_addresses > MAX_TARGETS:
+        raise ValueError('{} has more than {} addresses'.format(
+            address, MAX_TARGETS))
+    return [str(host) for host in network.hosts()] or \
+        [str(network.network_address)]
+
+
+def discover(address='255.255.255.255', port=44818, timeout=1.0):
+    """ Return the Identity of every target replying to ListIdentity
+    within timeout seconds, in the order they replied
+
+    address is a broadcast address, a host, or a network whose hosts are
+    each sent a unicast request, see targets(). Requests are sent from
+    one UDP socket, so a sweep takes one round trip, not one per host. A
+    sweep returns as soon as every host has replied.
+    """
+    hosts = targets(address)
+    context = struct.pack('<Q', next(_contexts))
+    request = build_list_identity(context)
+    # a target may reply more than once to a repeated or broadcast
+    # request, keep its first reply
+    identities = {}
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        for host in hosts:
+            try:
+                sock.sendto(request, (host, port))
+            except OSError:
+                # no route to this host, the others may still reply
+                pass
+        # hosts of a sweep yet to reply, a single request may be a
+        # broadcast answered by any number of targets
+        pending = set(hosts) if len(hosts) > 1 else None
+        deadline = monotonic() + timeout
+        while pending is None or pending:
+            wait = deadline - monotonic()
+            if wait <= 0:
+                break
+            sock.settimeout(wait)
+            try:
+                packet, (ip, _) = sock.recvfrom(BUFFER_SIZE)
+            except socket.timeout:
+                break
+            except OSError:
+                # an ICMP error from an earlier request
+                continue
+            if packet[CONTEXT_OFFSET:CONTEXT_OFFSET + 8] != context:
+                continue
+            identity = parse_identity_reply(packet, ip)
+            if identity is None or ip in identities:
+                continue
+            identities[ip] = identity
+            if pending is not None:
+                pending.discard(ip)
+    finally:
+        sock.close()
+    return list(identities.values())
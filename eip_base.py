@@ -0,0 +1,536 @@
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from threading import Event, Lock
+from time import perf_counter
+
+from .async_cip_driver import get_event_loop
+from .cip_driver import ServiceError
+from .connection_pool import DEFAULT_PORT, connection_pool
+from .connection_state import ConnectionState, HostDown
+from .metrics import Metrics
+from .poll_scheduler import PollScheduler
+from .rate_limiter import Priority, rate_limiters
+from .worker_pool import RemoteDriver, worker_pools
+from nio import Block, Signal
+from nio.block.mixins import EnrichSignals, Retry
+from nio.block.terminals import DEFAULT_TERMINAL, output
+from nio.command import command
+from nio.properties import BoolProperty, FloatProperty, IntProperty, \
+    ObjectProperty, Property, PropertyHolder, SelectProperty, \
+    StringProperty, TimeDeltaProperty
+
+
+def is_expression(value):
+    """ Whether a property value is a signal expression, by the raw value
+    it was configured with
+    """
+    return value._property.is_expression(value.value)
+
+
+def make_path(class_id, instance_num, attribute_num=None):
+    path = [class_id, instance_num]
+    if attribute_num is not None:
+        path.append(int(attribute_num))
+    return path
+
+
+class ObjectPath(PropertyHolder):
+
+    class_id = IntProperty(title='Class ID', default=1, order=0)
+    instance_num = IntProperty(title='Instance', default=1, order=1)
+    attribute_num = Property(
+        title='Attribute', default=None, allow_none=True, order=2)
+
+
+@command('metrics_snapshot')
+@output('metrics', label='Metrics')
+@output(DEFAULT_TERMINAL, default=True, label='Default')
+class EIPBase(EnrichSignals, Retry, Block):
+    """ Base block for explicit messages to one or more EtherNet/IP hosts
+
+    Incoming signals are grouped by host, each host is handled in its own
+    lane and lanes for different hosts run concurrently. Outgoing signals
+    are notified in the same order as the incoming signals.
+
+    Only transport failures reconnect, CIP service errors fail just the
+    request. A host that can not be reached backs off, see
+    ConnectionState, and signals for it are dropped without waiting.
+    """
+
+    host = StringProperty(title='Hostname', default='localhost', order=0)
+    path = ObjectProperty(ObjectPath, title='CIP Object Path',  order=1)
+    batch = BoolProperty(
+        title='Batch Requests', default=False, advanced=True, order=10)
+    connected = BoolProperty(
+        title='Connected Messaging', default=False, advanced=True, order=11)
+    port = IntProperty(
+        title='Port', default=DEFAULT_PORT, advanced=True, order=12)
+    sessions = IntProperty(
+        title='Sessions per Host', default=1, advanced=True, order=13)
+    concurrency = IntProperty(
+        title='Concurrent Hosts', default=8, advanced=True, order=14)
+    asynchronous = BoolProperty(
+        title='Asynchronous Requests', default=False, advanced=True,
+        order=15)
+    metrics_interval = TimeDeltaProperty(
+        title='Metrics Interval', default=None, allow_none=True,
+        advanced=True, order=16)
+    pipeline_window = IntProperty(
+        title='Pipeline Window', default=1, advanced=True, order=17)
+    worker_processes = IntProperty(
+        title='Worker Processes', default=0, advanced=True, order=18)
+    rate_limit = FloatProperty(
+        title='Rate Limit', default=0, advanced=True, order=30)
+    priority = SelectProperty(
+        Priority, title='Priority', default=Priority.READ, advanced=True,
+        order=31)
+
+    def __init__(self):
+        super().__init__()
+        # host -> CIPDriver borrowed from the connection pool
+        self.cnxns = {}
+        self._cnxns_lock = Lock()
+        # host -> ConnectionState
+        self._states = {}
+        self._path_getter = None
+        self._executor = None
+        # request latency per host and path, retries and reconnects
+        self.metrics = Metrics()
+        self._metrics_scheduler = None
+        # WorkerPool owning the sessions, if worker_processes is set
+        self._workers = None
+        # host -> RateLimiter shared with other blocks, if rate_limit is set
+        self._limiters = {}
+        # Future of the last asynchronous call to process_signals, each
+        # call notifies after the one before it
+        self._last_async = None
+        self._async_lock = Lock()
+        # set by stop, ends retries
+        self._stopping = Event()
+
+    @property
+    def cnxn(self):
+        """ The connection to host, if it is not a signal expression """
+        try:
+            return self.cnxns.get(self.host())
+        except Exception:
+            return None
+
+    def execute_with_retry(self, execute_method, host, *args,
+                           throttle=True, **kwargs):
+        """ Make a request with the Retry mixin, each attempt waits for
+        the rate limiter of host unless throttle is False, for a method
+        that waits for it before each of its requests
+
+        Every blocking request is made here. The mixin makes a backoff
+        strategy for each call, so lanes of different hosts retrying at the
+        same time do not use up or reset each other's retries. Retries end
+        when the block stops.
+        """
+        results = []
+
+        @wraps(execute_method)
+        def attempt(host, *args, **kwargs):
+            if throttle:
+                self._throttle(host)
+            results.append(execute_method(host, *args, **kwargs))
+            return results[-1]
+        super().execute_with_retry(
+            attempt, host, *args, stop_retry_event=self._stopping, **kwargs)
+        if not results:
+            raise RuntimeError(
+                'Stopped retrying {}, the block is stopping'.format(host))
+        return results[-1]
+
+    def before_retry(self, host, *args, **kwargs):
+        if self._stopping.is_set():
+            # the mixin stops retrying, do not reconnect
+            return
+        self.metrics.increment('retries')
+        self._slow_down(host)
+        self._disconnect(host, discard=True)
+        if not self._ensure_connected(host):
+            # stop retrying until the host is due to be retried
+            raise HostDown(host)
+
+    def configure(self, context):
+        super().configure(context)
+        self._path_getter = self._compile_path(self.path())
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(self.concurrency(), 1))
+        if self._worker_processes() > 0:
+            self._workers = worker_pools.checkout(self._worker_processes())
+        if self.metrics_interval() is not None:
+            self._metrics_scheduler = PollScheduler(
+                self._notify_metrics,
+                [(self.metrics_interval().total_seconds(), None)],
+                logger=self.logger)
+        try:
+            host = self.host()
+        except Exception:
+            # host is a signal expression, connect when signals arrive
+            return
+        # join the host's rate limit before any block sends requests
+        self._limiter(host)
+        self._ensure_connected(host, reconnect=False)
+
+    def process_signals(self, signals):
+        # host -> indexes of the signals for that host, in order
+        lanes = OrderedDict()
+        for index, signal in enumerate(signals):
+            lanes.setdefault(self.host(signal), []).append(index)
+        if self._asynchronous():
+            # connect from this thread, the requests are made on the event
+            # loop and signals are notified when they are all done
+            for host in lanes:
+                self._ensure_connected(host)
+            with self._async_lock:
+                self._last_async = asyncio.run_coroutine_threadsafe(
+                    self._process_async(signals, lanes, self._last_async),
+                    get_event_loop())
+            return
+        if len(lanes) == 1:
+            host, indexes = lanes.popitem()
+            results = [(indexes, self._process_lane(host, signals))]
+        else:
+            futures = []
+            for host, indexes in lanes.items():
+                lane_signals = [signals[index] for index in indexes]
+                futures.append((indexes, self._executor.submit(
+                    self._process_lane, host, lane_signals)))
+            results = [(indexes, future.result())
+                       for indexes, future in futures]
+        self._notify_results(len(signals), results)
+
+    async def _process_async(self, signals, lanes, previous=None):
+        """ Make the requests of one call to process_signals, and notify
+        their results once the previous call, the Future previous, has
+        notified, so signals are notified in the order they arrived
+
+        Failed requests are not retried, a transport failure drops the
+        session and the next signals for its host reconnect.
+        """
+        try:
+            results = await asyncio.gather(*[
+                self._process_lane_async(
+                    host, [signals[index] for index in indexes])
+                for host, indexes in lanes.items()])
+        except Exception:
+            self.logger.exception('Asynchronous requests failed')
+            results = None
+        if previous is not None:
+            # _process_async never raises, its exceptions are logged
+            await asyncio.wrap_future(previous)
+        if results is None:
+            return
+        try:
+            self._notify_results(
+                len(signals), list(zip(lanes.values(), results)))
+        except Exception:
+            self.logger.exception('Unable to notify asynchronous results')
+
+    def _notify_results(self, count, results):
+        """ Notify lane results, a list of (indexes, lane signals), in the
+        order of the incoming signals
+        """
+        outgoing_signals = [None] * count
+        for indexes, lane_signals in results:
+            for index, signal in zip(indexes, lane_signals):
+                outgoing_signals[index] = signal
+        outgoing_signals = [
+            signal for signal in outgoing_signals if signal is not None]
+        if outgoing_signals:
+            self.notify_signals(outgoing_signals)
+
+    def start(self):
+        super().start()
+        self._stopping.clear()
+        if self._metrics_scheduler is not None:
+            self._metrics_scheduler.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._metrics_scheduler is not None:
+            self._metrics_scheduler.stop()
+        for host in list(self.cnxns):
+            self._disconnect(host)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        if self._workers is not None:
+            worker_pools.checkin(self._workers)
+            self._workers = None
+        super().stop()
+
+    def metrics_snapshot(self):
+        """ The block's metrics and the metrics of each connection
+
+        Connections are shared by all blocks using the same host, so their
+        metrics include the requests of every block.
+        """
+        return {
+            'block': self.metrics.snapshot(),
+            'connections': {
+                host: cnxn.metrics.snapshot()
+                for host, cnxn in list(self.cnxns.items())},
+            'hosts': {
+                host: state.stats()
+                for host, state in list(self._states.items())},
+            'rate_limits': {
+                host: limiter.stats()
+                for host, limiter in list(self._limiters.items())},
+        }
+
+    def _notify_metrics(self, _):
+        self.notify_signals([Signal(self.metrics_snapshot())], 'metrics')
+
+    def _record_request(self, host, path, started, success=True):
+        """ Record the latency of a request for path, or of a batch of
+        requests if path is None
+        """
+        self.metrics.increment('requests')
+        if not success:
+            self.metrics.increment('failures')
+        if path is None:
+            name = '{} batch'.format(host)
+        else:
+            name = '{} {}'.format(host, '/'.join(str(part) for part in path))
+        elapsed = perf_counter() - started
+        self.metrics.record(name, elapsed)
+        limiter = self._limiter(host)
+        if limiter is not None and success:
+            # a batch takes more than one round trip
+            limiter.completed(
+                self._round_trip(host, elapsed) if path is not None
+                else None)
+
+    def _round_trip(self, host, elapsed):
+        """ The round trip of the request to host just made, timed by the
+        driver so that waiting for the rate limiter, the session or retries
+        is left out. Asynchronous requests are not throttled or retried,
+        elapsed is used for them.
+        """
+        cnxn = self.cnxns.get(host)
+        if cnxn is None or self._asynchronous():
+            return elapsed
+        return cnxn.round_trip()
+
+    def _process_lane(self, host, signals):
+        """ Process signals for one host
+
+        Returns a list with an outgoing signal, or None if the request
+        failed, for each incoming signal.
+        """
+        if not self._ensure_connected(host):
+            return [None] * len(signals)
+        if self._batch():
+            return self._process_batch(host, signals)
+        outgoing_signals = []
+        for index, signal in enumerate(signals):
+            if self.cnxns.get(host) is None:
+                # the connection failed, drop the rest of the signals
+                # instead of reconnecting for each one
+                self._fast_fail(host, len(signals) - index)
+                outgoing_signals.extend([None] * (len(signals) - index))
+                break
+            outgoing_signals.append(self._process_signal(host, signal))
+        return outgoing_signals
+
+    async def _process_lane_async(self, host, signals):
+        """ Process signals for one host with pipelined requests """
+        if self.cnxns.get(host) is None:
+            return [None] * len(signals)
+        if self._batch():
+            await self._throttle_async(host)
+            return await self._process_batch_async(host, signals)
+        return await asyncio.gather(*[
+            self._process_signal_throttled(host, signal)
+            for signal in signals])
+
+    async def _process_signal_throttled(self, host, signal):
+        await self._throttle_async(host)
+        return await self._process_signal_async(host, signal)
+
+    def _ensure_connected(self, host, reconnect=True):
+        """ Connect to host if needed, False if that fails or the host is
+        down and not due to be retried
+        """
+        if self.cnxns.get(host) is not None:
+            return True
+        state = self._state(host)
+        if not state.attempt():
+            self._fast_fail(host)
+            return False
+        try:
+            if reconnect:
+                msg = 'Not connected to {}, reconnecting...'.format(host)
+                self.logger.warning(msg)
+                self.metrics.increment('reconnects')
+            self._connect(host)
+        except Exception:
+            delay = state.failed()
+            msg = 'Unable to connect to {}'.format(host)
+            if delay:
+                msg += ', retrying in {:.1f} seconds'.format(delay)
+            self.logger.exception(msg)
+            return False
+        state.succeeded()
+        return True
+
+    def _transport_failed(self, host):
+        """ Discard the connection to host after a request failed with a
+        transport error, the next reconnect is immediate but further
+        failures back off
+        """
+        if self.cnxns.get(host) is not None:
+            self._disconnect(host, discard=True)
+            self._state(host).failed()
+        self._slow_down(host)
+
+    def _fast_fail(self, host, count=1):
+        self.metrics.increment('fast_failures', count)
+        msg = 'Not connected to {}, dropped {} signals'
+        self.logger.debug(msg.format(host, count))
+
+    def _state(self, host):
+        state = self._states.get(host)
+        if state is None:
+            with self._cnxns_lock:
+                state = self._states.setdefault(host, ConnectionState())
+        return state
+
+    def _limiter(self, host):
+        """ The rate limiter of host, or None if requests are not limited
+        """
+        if self.rate_limit() <= 0:
+            return None
+        limiter = self._limiters.get(host)
+        if limiter is None:
+            limiter = self._limiters[host] = rate_limiters.get(
+                host, self.port(), self.rate_limit())
+        return limiter
+
+    def _slow_down(self, host):
+        """ Cut the rate of requests to host after a transport failure """
+        limiter = self._limiter(host)
+        if limiter is not None:
+            limiter.failed()
+
+    def _throttle(self, host):
+        """ Wait until a request to host may be sent """
+        limiter = self._limiter(host)
+        if limiter is not None:
+            limiter.acquire(self.priority(), self)
+
+    async def _throttle_async(self, host):
+        if self._limiter(host) is not None:
+            await asyncio.get_event_loop().run_in_executor(
+                self._executor, self._throttle, host)
+
+    def _process_signal(self, host, signal):
+        raise NotImplementedError()
+
+    def _process_batch(self, host, signals):
+        raise NotImplementedError()
+
+    async def _process_signal_async(self, host, signal):
+        raise NotImplementedError()
+
+    async def _process_batch_async(self, host, signals):
+        raise NotImplementedError()
+
+    def _create_driver(self):
+        raise NotImplementedError()
+
+    def _asynchronous(self):
+        """ Whether requests are made with the asynchronous driver, which
+        is not used by worker processes
+        """
+        return self.asynchronous() and not self._worker_processes()
+
+    def _worker_processes(self):
+        """ The number of worker processes owning the sessions, 0 if they
+        are made in the block's process
+        """
+        return self.worker_processes()
+
+    def _batch(self):
+        """ Whether each lane's requests are made in one batch """
+        return self.batch()
+
+    def _driver_kind(self):
+        """ Sessions are only shared by blocks with the same kind of
+        driver
+        """
+        return 'CIP'
+
+    def _connect(self, host):
+        # each instance of CIPDriver can open connection to only 1 host
+        # subsequent calls to open() are quietly ignored, and close()
+        # does not take any args, so there is one connection per host
+        # sessions are borrowed from a pool shared by all blocks
+        with self._cnxns_lock:
+            if self.cnxns.get(host) is not None:
+                return
+            # asynchronous sessions always pipeline
+            window = 1 if self._asynchronous() else self.pipeline_window()
+            factory = self._create_driver
+            kind = self._driver_kind()
+            if self._workers is not None:
+                # the session is owned by the worker process of its host
+                workers, driver_kind = self._workers, kind
+
+                def factory():
+                    return RemoteDriver(workers, driver_kind, window)
+                kind = (kind, workers.processes)
+            cnxn = connection_pool.checkout(
+                factory, host, self.port(), self.connected(),
+                self.sessions(), self._asynchronous(), window, kind)
+            self.cnxns[host] = cnxn
+        if self.connected() and not cnxn.open_connection():
+            msg = 'Unable to open a connection to {}, using unconnected ' \
+                'messaging: {}'
+            self.logger.warning(msg.format(host, cnxn.get_status()))
+
+    def _disconnect(self, host, discard=False):
+        with self._cnxns_lock:
+            cnxn = self.cnxns.pop(host, None)
+        if cnxn is not None:
+            connection_pool.checkin(cnxn, discard)
+
+    def _get_path(self, signal):
+        return self._path_getter(signal)
+
+    @staticmethod
+    def _failed(value):
+        """ Whether a request failed, its value is False or the
+        ServiceError it failed with
+        """
+        return value is False or isinstance(value, ServiceError)
+
+    @staticmethod
+    def _compile_path(holder):
+        """ Return a function of a signal returning the path of an
+        ObjectPath
+
+        Parts of the path that are not signal expressions are evaluated
+        once, the others once per signal. The driver memoizes the encoded
+        path by its values.
+        """
+        props = (holder.class_id, holder.instance_num, holder.attribute_num)
+        if not any(is_expression(prop) for prop in props):
+            path = make_path(*[prop() for prop in props])
+            # a copy for each signal, outgoing signals may be modified
+            return lambda signal: list(path)
+        values = [None if is_expression(prop) else prop() for prop in props]
+        expressions = [
+            (index, prop) for index, prop in enumerate(props)
+            if is_expression(prop)]
+
+        def get_path(signal):
+            path = list(values)
+            for index, prop in expressions:
+                path[index] = prop(signal)
+            return make_path(*path)
+        return get_path
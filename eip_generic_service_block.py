@@ -0,0 +1,233 @@
+from enum import Enum
+from functools import partial
+from time import perf_counter
+
+from .async_cip_driver import AsyncCIPDriver
+from .cip_driver import CIPDriver, GET_ATTRIBUTE_ALL, ServiceError, \
+    multi_status
+from .eip_base import EIPBase
+from nio.properties import BoolProperty, IntProperty, Property, \
+    SelectProperty, VersionProperty
+
+
+class Transfer(Enum):
+    SINGLE = 'SINGLE'
+    FRAGMENTED = 'FRAGMENTED'
+    FILE = 'FILE'
+
+
+class EIPGenericService(EIPBase):
+    """ Send any CIP service, such as Get_Attribute_All or a vendor
+    specific service, to an object path and output the reply data
+    """
+
+    service = IntProperty(
+        title='Service Code', default=GET_ATTRIBUTE_ALL, order=2)
+    data = Property(title='Request Data', default='{{ b"" }}', order=3)
+    transfer = SelectProperty(
+        Transfer, title='Transfer', default=Transfer.SINGLE, order=4,
+        advanced=True)
+    stream = BoolProperty(
+        title='Stream Transfers', default=False, order=5, advanced=True)
+    version = VersionProperty('0.1.0')
+
+    def _process_signal(self, host, signal):
+        if self.transfer() is not Transfer.SINGLE:
+            return self._process_transfer(host, signal)
+        path = self._get_path(signal)
+        service = self.service(signal)
+        data = self.data(signal)
+        started = perf_counter()
+        try:
+            value = self.execute_with_retry(
+                self._make_request, host, service, path, data)
+        except Exception:
+            value = False
+            self._transport_failed(host)
+            msg = 'Service {:#04x} failed, host: {}, path: {}'
+            self.logger.exception(msg.format(service, host, path))
+        self._record_request(host, path, started, not self._failed(value))
+        return self._handle_reply(host, signal, service, path, value)
+
+    async def _process_signal_async(self, host, signal):
+        path = self._get_path(signal)
+        service = self.service(signal)
+        data = self.data(signal)
+        started = perf_counter()
+        try:
+            value = await self.cnxns[host].async_generic_service(
+                service, *path, data=data)
+        except ServiceError as e:
+            # the request failed, other pipelined requests are unaffected
+            value = e
+        except Exception:
+            value = False
+            self._transport_failed(host)
+            msg = 'Service {:#04x} failed, host: {}, path: {}'
+            self.logger.exception(msg.format(service, host, path))
+        self._record_request(host, path, started, not self._failed(value))
+        return self._handle_reply(host, signal, service, path, value)
+
+    def _handle_reply(self, host, signal, service, path, value):
+        if not self._failed(value):
+            new_signal_dict = {}
+            new_signal_dict['host'] = host
+            new_signal_dict['path'] = path
+            new_signal_dict['service'] = service
+            new_signal_dict['value'] = value
+            return self.get_output_signal(new_signal_dict, signal)
+        if isinstance(value, ServiceError):
+            msg = 'Service {:#04x} failed, {}, host: {}, path: {}'
+            msg = msg.format(service, multi_status(value.status), host, path)
+        elif self.cnxns.get(host) is None:
+            msg = 'Connection to {} failed.'.format(host)
+        else:
+            msg = 'Service {:#04x} failed, host: {}, path: {}'
+            msg = msg.format(service, host, path)
+        self.logger.error(msg)
+
+    def _process_batch(self, host, signals):
+        items = [
+            (self.service(signal), self._get_path(signal), self.data(signal))
+            for signal in signals]
+        started = perf_counter()
+        try:
+            values, statuses = self.execute_with_retry(
+                self._make_multi_request, host, items)
+        except Exception:
+            self._record_request(host, None, started, False)
+            self._transport_failed(host)
+            msg = 'Multiple Service Packet failed, host: {}'
+            self.logger.exception(msg.format(host))
+            return [None] * len(signals)
+        self._record_request(host, None, started)
+        return self._handle_batch_reply(
+            host, signals, items, values, statuses)
+
+    async def _process_batch_async(self, host, signals):
+        items = [
+            (self.service(signal), self._get_path(signal), self.data(signal))
+            for signal in signals]
+        started = perf_counter()
+        try:
+            values, statuses = \
+                await self.cnxns[host].async_generic_service_multi(items)
+        except Exception:
+            self._record_request(host, None, started, False)
+            self._transport_failed(host)
+            msg = 'Multiple Service Packet failed, host: {}'
+            self.logger.exception(msg.format(host))
+            return [None] * len(signals)
+        self._record_request(host, None, started)
+        return self._handle_batch_reply(
+            host, signals, items, values, statuses)
+
+    def _handle_batch_reply(self, host, signals, items, values, statuses):
+        outgoing_signals = []
+        for signal, (service, path, _), value, status in \
+                zip(signals, items, values, statuses):
+            if value is False:
+                msg = 'Service {:#04x} failed, {}, host: {}, path: {}'
+                self.logger.error(msg.format(service, status, host, path))
+                outgoing_signals.append(None)
+                continue
+            new_signal_dict = {}
+            new_signal_dict['host'] = host
+            new_signal_dict['path'] = path
+            new_signal_dict['service'] = service
+            new_signal_dict['value'] = value
+            new_signal = self.get_output_signal(new_signal_dict, signal)
+            outgoing_signals.append(new_signal)
+        return outgoing_signals
+
+    def _process_transfer(self, host, signal):
+        """ Read a fragmented reply or a file, and output it as one
+        signal, or with stream as a signal per fragment when it arrives
+        """
+        path = self._get_path(signal)
+        service = self.service(signal)
+        data = self.data(signal)
+        started = perf_counter()
+        try:
+            if not self.stream():
+                value = self.execute_with_retry(
+                    self._make_transfer, host, service, path, data,
+                    throttle=False)
+            else:
+                # fragments are notified as they arrive, so the transfer is
+                # not retried, one fragment is held to mark the last one
+                offset = 0
+                previous = None
+                for fragment in self._transfer(host, service, path, data):
+                    if previous is not None:
+                        self._notify_fragment(
+                            host, signal, service, path, offset, previous)
+                        offset += len(previous)
+                    previous = fragment
+                self._notify_fragment(
+                    host, signal, service, path, offset, previous, True)
+                value = None
+        except ServiceError as e:
+            value = e
+        except Exception:
+            value = False
+            self._transport_failed(host)
+            msg = 'Transfer with service {:#04x} failed, host: {}, path: {}'
+            self.logger.exception(msg.format(service, host, path))
+        self._record_request(host, path, started, not self._failed(value))
+        if value is not None:
+            return self._handle_reply(host, signal, service, path, value)
+
+    def _notify_fragment(self, host, signal, service, path, offset, value,
+                         last=False):
+        new_signal_dict = {}
+        new_signal_dict['host'] = host
+        new_signal_dict['path'] = path
+        new_signal_dict['service'] = service
+        new_signal_dict['offset'] = offset
+        new_signal_dict['value'] = value
+        new_signal_dict['last'] = last
+        self.notify_signals([self.get_output_signal(new_signal_dict, signal)])
+
+    def _transfer(self, host, service, path, data):
+        # each fragment is a request that waits for the rate limiter
+        before_request = partial(self._throttle, host)
+        if self.transfer() is Transfer.FILE:
+            return self.cnxns[host].upload_file(
+                path[1], before_request=before_request)
+        return self.cnxns[host].read_fragmented(
+            service, *path, data=data, before_request=before_request)
+
+    def _make_transfer(self, host, service, path, data):
+        return b''.join(self._transfer(host, service, path, data))
+
+    def _asynchronous(self):
+        # transfers are a sequence of blocking requests
+        return super()._asynchronous() and \
+            self.transfer() is Transfer.SINGLE
+
+    def _worker_processes(self):
+        # transfers stay in the block's process, a worker would send back
+        # a streamed transfer whole and could not throttle its fragments
+        if self.transfer() is not Transfer.SINGLE:
+            return 0
+        return super()._worker_processes()
+
+    def _batch(self):
+        return self.batch() and self.transfer() is Transfer.SINGLE
+
+    def _create_driver(self):
+        if self._asynchronous():
+            return AsyncCIPDriver()
+        return CIPDriver(self.pipeline_window())
+
+    def _make_request(self, host, service, path, data):
+        try:
+            return self.cnxns[host].generic_service(
+                service, *path, data=data, raise_errors=True)
+        except ServiceError as e:
+            # the target failed the request, it is not retried
+            return e
+
+    def _make_multi_request(self, host, items):
+        return self.cnxns[host].generic_service_multi(items)
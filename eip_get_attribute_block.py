@@ -1,98 +1,345 @@
-from .cip_driver import CIPDriver
-from nio import Block
-from nio.block.mixins import EnrichSignals, Retry
-from nio.properties import IntProperty, ObjectProperty, Property, \
-    PropertyHolder, StringProperty, VersionProperty
+from time import perf_counter
 
+from .async_cip_driver import AsyncCIPDriver
+from .change_filter import ChangeFilter
+from .cip_driver import CIPDriver, ServiceError, multi_status
+from .cip_types import DataType, compile_decoder, data_size
+from .eip_base import EIPBase, ObjectPath, is_expression, make_path
+from .poll_scheduler import PollScheduler
+from .read_cache import read_cache
+from nio import Signal
+from nio.command import command
+from nio.properties import BoolProperty, FloatProperty, ListProperty, \
+    ObjectProperty, PropertyHolder, SelectProperty, StringProperty, \
+    TimeDeltaProperty, VersionProperty
 
-class ObjectPath(PropertyHolder):
 
-    class_id = IntProperty(title='Class ID', default=1, order=0)
-    instance_num = IntProperty(title='Instance', default=1, order=1)
-    attribute_num = Property(
-        title='Attribute', default=None, allow_none=True, order=2)
+class TypedObjectPath(ObjectPath):
 
+    data_type = SelectProperty(
+        DataType, title='Data Type', default=DataType.RAW, order=3)
+    is_array = BoolProperty(title='Array', default=False, order=4)
+    layout = StringProperty(
+        title='Struct Layout', default='', allow_none=True, order=5)
 
-class EIPGetAttribute(EnrichSignals, Retry, Block):
 
-    host = StringProperty(title='Hostname', default='localhost', order=0)
-    path = ObjectProperty(ObjectPath, title='CIP Object Path',  order=1)
+class PollPath(TypedObjectPath):
+
+    interval = TimeDeltaProperty(
+        title='Interval', default={'seconds': 1}, order=6)
+
+
+class ReportByException(PropertyHolder):
+
+    enabled = BoolProperty(title='Enabled', default=False, order=0)
+    deadband = FloatProperty(title='Deadband', default=0, order=1)
+    heartbeat = TimeDeltaProperty(
+        title='Heartbeat', default=None, allow_none=True, order=2)
+
+
+class ReadCacheOptions(PropertyHolder):
+
+    enabled = BoolProperty(title='Enabled', default=False, order=0)
+    ttl = TimeDeltaProperty(
+        title='Time to Live', default={'milliseconds': 50}, order=1)
+
+
+@command('cache_stats')
+@command('filter_stats')
+@command('poll_stats')
+class EIPGetAttribute(EIPBase):
+
+    path = ObjectProperty(TypedObjectPath, title='CIP Object Path', order=1)
+    polls = ListProperty(
+        PollPath, title='Polled Paths', default=[], advanced=True, order=20)
+    report_by_exception = ObjectProperty(
+        ReportByException, title='Report by Exception', advanced=True,
+        order=21)
+    read_cache = ObjectProperty(
+        ReadCacheOptions, title='Read Cache', advanced=True, order=22)
+    attribute_lists = BoolProperty(
+        title='Attribute Lists', default=False, advanced=True, order=23)
     version = VersionProperty('0.2.1')
 
     def __init__(self):
         super().__init__()
-        self.cnxn = None
+        self._decode = None
+        self._size = None
+        self._scheduler = None
+        self._filter = None
+        # values in the read cache are only shared by reads with these
+        self._read_options = None
 
-    def before_retry(self, *args, **kwargs):
-        self._disconnect()
-        self._connect()
+    def validate(self, ignore_none=False):
+        # called by configure before the block connects
+        super().validate(ignore_none)
+        if self.polls() and is_expression(self.host):
+            # polls are made without a signal to evaluate the host with
+            raise ValueError(
+                'Polled Paths need a Hostname that is not an expression')
 
     def configure(self, context):
         super().configure(context)
+        self._decode = compile_decoder(
+            self.path().data_type(),
+            self.path().is_array(),
+            self.path().layout())
+        self._size = data_size(
+            self.path().data_type(),
+            self.path().is_array(),
+            self.path().layout())
+        self._read_options = (
+            self.connected(),
+            self.path().data_type(),
+            self.path().is_array(),
+            self.path().layout())
+        if self.report_by_exception().enabled():
+            heartbeat = self.report_by_exception().heartbeat()
+            if heartbeat is not None:
+                heartbeat = heartbeat.total_seconds()
+            self._filter = ChangeFilter(
+                self.report_by_exception().deadband(), heartbeat)
+        polls = []
+        for poll in self.polls():
+            path = make_path(
+                poll.class_id(), poll.instance_num(), poll.attribute_num())
+            decode = compile_decoder(
+                poll.data_type(), poll.is_array(), poll.layout())
+            size = data_size(poll.data_type(), poll.is_array(), poll.layout())
+            polls.append(
+                (poll.interval().total_seconds(), (path, decode, size)))
+        if polls:
+            self._scheduler = PollScheduler(
+                self._poll, polls, logger=self.logger)
+
+    def start(self):
+        super().start()
+        if self._scheduler is not None:
+            self._scheduler.start()
+
+    def stop(self):
+        if self._scheduler is not None:
+            self._scheduler.stop()
+        super().stop()
+
+    def poll_stats(self):
+        """ Ticks, overruns and jitter of the polled paths """
+        if self._scheduler is None:
+            return {}
+        return self._scheduler.stats()
+
+    def filter_stats(self):
+        """ Reported and suppressed values with Report by Exception """
+        if self._filter is None:
+            return {}
+        return self._filter.stats()
+
+    def cache_stats(self):
+        """ Hits, coalesced reads and misses of the read cache shared by
+        every block
+        """
+        return read_cache.stats()
+
+    def _poll(self, polls):
+        """ Read the polled paths that are due and notify a signal list """
+        host = self.host()
+        if not self._ensure_connected(host):
+            return
+        paths = [path for path, _, _ in polls]
+        sizes = [size for _, _, size in polls]
+        started = perf_counter()
         try:
-            self._connect()
+            values, statuses = self.execute_with_retry(
+                self._make_multi_request, host, paths, sizes)
         except Exception:
-            self.cnxn = None
-            msg = 'Unable to connect to {}'.format(self.host())
-            self.logger.exception(msg)
+            self._record_request(host, None, started, False)
+            self._transport_failed(host)
+            msg = 'get_attribute_multi failed, host: {}'
+            self.logger.exception(msg.format(host))
+            return
+        self._record_request(host, None, started)
+        outgoing_signals = self._handle_batch_reply(
+            host, [Signal() for _ in polls], paths, values, statuses,
+            [decode for _, decode, _ in polls])
+        outgoing_signals = [
+            signal for signal in outgoing_signals if signal is not None]
+        if outgoing_signals:
+            self.notify_signals(outgoing_signals)
 
-    def process_signals(self, signals):
-        host = self.host()
-        outgoing_signals = []
-        if self.cnxn is None:
+    def _process_signal(self, host, signal):
+        path = self._get_path(signal)
+        started = perf_counter()
+        shared = False
+        try:
+            value, shared = self._read(host, path, signal)
+        except Exception:
+            value = False
+            self._transport_failed(host)
+            msg = 'get_attribute_single failed, host: {}, path: {}'
+            self.logger.exception(msg.format(host, path))
+        if shared:
+            # no request was sent
+            self.metrics.increment('cache_hits')
+        else:
+            self._record_request(
+                host, path, started, not self._failed(value))
+        return self._handle_reply(host, signal, path, value)
+
+    def _read(self, host, path, signal):
+        """ Return (value, shared), shared is True if the value was read
+        by another request through the read cache
+        """
+        options = self.read_cache()
+        if not options.enabled():
+            return self.execute_with_retry(
+                self._make_request, host, path), False
+        return read_cache.read(
+            host, self.port(), path, options.ttl(signal).total_seconds(),
+            lambda: self.execute_with_retry(self._make_request, host, path),
+            self._read_options)
+
+    async def _process_signal_async(self, host, signal):
+        path = self._get_path(signal)
+        started = perf_counter()
+        try:
+            value = await self.cnxns[host].async_get_attribute_single(*path)
+        except ServiceError as e:
+            # the request failed, other pipelined requests are unaffected
+            value = e
+        except Exception:
+            value = False
+            self._transport_failed(host)
+            msg = 'get_attribute_single failed, host: {}, path: {}'
+            self.logger.exception(msg.format(host, path))
+        self._record_request(host, path, started, not self._failed(value))
+        return self._handle_reply(host, signal, path, value)
+
+    def _handle_reply(self, host, signal, path, value):
+        if not self._failed(value):
             try:
-                msg = 'Not connected to {}, reconnecting...'.format(host)
-                self.logger.warning(msg)
-                self._connect()
+                value = self._decode_value(value, self._decode)
             except Exception:
-                self.cnxn = None
-                msg = 'Unable to connect to {}'.format(host)
-                self.logger.exception(msg)
+                msg = 'Unable to decode {}, host: {}, path: {}'
+                self.logger.exception(msg.format(value, host, path))
+                return
+            if not self._report(host, path, value):
                 return
-        for signal in signals:
-            path = [
-                self.path().class_id(signal), self.path().instance_num(signal)]
-            if self.path().attribute_num(signal) is not None:
-                path.append(int(self.path().attribute_num(signal)))
+            new_signal_dict = {}
+            new_signal_dict['host'] = host
+            new_signal_dict['path'] = path
+            new_signal_dict['value'] = value
+            return self.get_output_signal(new_signal_dict, signal)
+        if isinstance(value, ServiceError):
+            msg = 'get_attribute_single failed, {}, host: {}, path: {}'
+            msg = msg.format(multi_status(value.status), host, path)
+        elif self.cnxns.get(host) is None:
+            msg = 'Connection to {} failed.'.format(host)
+        else:
+            msg = 'get_attribute_single failed, host: {}, path: {}'
+            msg = msg.format(host, path)
+        self.logger.error(msg)
+
+    def _process_batch(self, host, signals):
+        paths = [self._get_path(signal) for signal in signals]
+        started = perf_counter()
+        try:
+            values, statuses = self.execute_with_retry(
+                self._make_multi_request, host, paths,
+                [self._size] * len(paths))
+        except Exception:
+            self._record_request(host, None, started, False)
+            self._transport_failed(host)
+            msg = 'get_attribute_multi failed, host: {}'
+            self.logger.exception(msg.format(host))
+            return [None] * len(signals)
+        self._record_request(host, None, started)
+        return self._handle_batch_reply(
+            host, signals, paths, values, statuses)
+
+    async def _process_batch_async(self, host, signals):
+        paths = [self._get_path(signal) for signal in signals]
+        started = perf_counter()
+        try:
+            values, statuses = \
+                await self.cnxns[host].async_get_attribute_multi(
+                    paths, self._sizes([self._size] * len(paths)),
+                    self.attribute_lists())
+        except Exception:
+            self._record_request(host, None, started, False)
+            self._transport_failed(host)
+            msg = 'get_attribute_multi failed, host: {}'
+            self.logger.exception(msg.format(host))
+            return [None] * len(signals)
+        self._record_request(host, None, started)
+        return self._handle_batch_reply(
+            host, signals, paths, values, statuses)
+
+    def _handle_batch_reply(self, host, signals, paths, values, statuses,
+                            decoders=None):
+        if decoders is None:
+            decoders = [self._decode] * len(signals)
+        outgoing_signals = []
+        for signal, path, value, status, decode in \
+                zip(signals, paths, values, statuses, decoders):
+            if value is False:
+                msg = 'get_attribute_single failed, {}, host: {}, path: {}'
+                self.logger.error(msg.format(status, host, path))
+                outgoing_signals.append(None)
+                continue
             try:
-                value = self.execute_with_retry(self._make_request, path)
+                value = self._decode_value(value, decode)
             except Exception:
-                value = False
-                self.cnxn = None
-                msg = 'get_attribute_single failed, host: {}, path: {}'
-                self.logger.exception(msg.format(host, path))
-            if value:
-                new_signal_dict = {}
-                new_signal_dict['host'] = host
-                new_signal_dict['path'] = path
-                new_signal_dict['value'] = value
-                new_signal = self.get_output_signal(new_signal_dict, signal)
-                outgoing_signals.append(new_signal)
-            else:
-                if self.cnxn is None:
-                    msg = 'Connection to {} failed.'.format(host)
-                else:
-                    status = self.cnxn.get_status()
-                    msg = 'get_attribute_single failed, {}, host: {}, path: {}'
-                    msg = msg.format(status, host, path)
-                self.logger.error(msg)
-        self.notify_signals(outgoing_signals)
+                msg = 'Unable to decode {}, host: {}, path: {}'
+                self.logger.exception(msg.format(value, host, path))
+                outgoing_signals.append(None)
+                continue
+            if not self._report(host, path, value):
+                outgoing_signals.append(None)
+                continue
+            new_signal_dict = {}
+            new_signal_dict['host'] = host
+            new_signal_dict['path'] = path
+            new_signal_dict['value'] = value
+            new_signal = self.get_output_signal(new_signal_dict, signal)
+            outgoing_signals.append(new_signal)
+        return outgoing_signals
 
-    def stop(self):
-        self._disconnect()
-        super().stop()
+    def _decode_value(self, value, decode):
+        if decode is None:
+            return value
+        return decode(value)
+
+    def _report(self, host, path, value):
+        """ False if the value is suppressed by Report by Exception """
+        if self._filter is None:
+            return True
+        return self._filter.report((host, tuple(path)), value)
 
-    def _connect(self):
-        # each instance of CIPDriver can open connection to only 1 host
-        # subsequent calls to open() are quietly ignored, and close()
-        # does not take any args, so one host per block instance for now
-        self.cnxn = CIPDriver()
-        self.cnxn.open(self.host())
+    def _create_driver(self):
+        if self._asynchronous():
+            return AsyncCIPDriver()
+        return CIPDriver(self.pipeline_window())
+
+    def _make_request(self, host, path):
+        try:
+            return self.cnxns[host].get_attribute_single(
+                *path, raise_errors=True)
+        except ServiceError as e:
+            # the target failed the request, it is not retried
+            return e
 
-    def _disconnect(self):
-        if self.cnxn is not None:
-            self.cnxn.close()
-            self.cnxn = None
+    def _make_multi_request(self, host, paths, sizes):
+        sizes = self._sizes(sizes)
+        if sizes is None:
+            return self.cnxns[host].get_attribute_multi(paths)
+        if self.attribute_lists():
+            return self.cnxns[host].get_attribute_multi(
+                paths, sizes=sizes, lists=True)
+        return self.cnxns[host].get_attribute_multi(paths, sizes=sizes)
 
-    def _make_request(self, path):
-        return self.cnxn.get_attribute_single(*path)
+    @staticmethod
+    def _sizes(sizes):
+        """ sizes, if the size of any attribute is known """
+        if all(size is None for size in sizes):
+            return None
+        return sizes
@@ -0,0 +1,196 @@
+from threading import Event, Lock, Thread
+from time import monotonic
+
+from .cip_driver import CIPDriver, INPUT_ONLY_CONNECTION_POINT, \
+    build_io_path
+from .cip_types import DataType, compile_decoder
+from .connection_pool import DEFAULT_PORT, connection_pool
+from .implicit_io import IO_PORT, build_io_packet, get_io_listener
+from nio import Block, Signal
+from nio.properties import BoolProperty, FloatProperty, IntProperty, \
+    ObjectProperty, PropertyHolder, SelectProperty, StringProperty, \
+    VersionProperty
+
+
+# the connection times out after 8 times the packet interval
+TIMEOUT_MULTIPLIER = 1
+TIMEOUT_PACKETS = 4 << TIMEOUT_MULTIPLIER
+# seconds to wait for the first packet of a new connection, at least
+INITIAL_TIMEOUT = 10.0
+# seconds to wait before opening a connection again
+RECONNECT_INTERVAL = 1.0
+
+
+class Assembly(PropertyHolder):
+
+    input_instance = IntProperty(title='Input Instance', default=100, order=0)
+    input_size = IntProperty(title='Input Size (bytes)', default=32, order=1)
+    output_instance = IntProperty(
+        title='Output Instance', default=INPUT_ONLY_CONNECTION_POINT,
+        order=2)
+    config_instance = IntProperty(
+        title='Configuration Instance', default=1, order=3)
+    data_type = SelectProperty(
+        DataType, title='Data Type', default=DataType.RAW, order=4)
+    is_array = BoolProperty(title='Array', default=False, order=5)
+    layout = StringProperty(
+        title='Struct Layout', default='', allow_none=True, order=6)
+
+
+class EIPImplicitIO(Block):
+    """ Consume the cyclic input data of a class 1 I/O connection
+
+    An input only connection is opened when the block starts and every
+    packet the target produces is received by the IOListener shared by all
+    blocks. The block's own thread sends the heartbeat packets that keep
+    the connection open, and opens it again if the target stops producing.
+    """
+
+    host = StringProperty(title='Hostname', default='localhost', order=0)
+    assembly = ObjectProperty(Assembly, title='Assembly', order=1)
+    rpi = FloatProperty(
+        title='Requested Packet Interval (ms)', default=10, order=2)
+    decimation = IntProperty(title='Decimation', default=1, order=3)
+    on_change = BoolProperty(title='Only Changes', default=False, order=4)
+    port = IntProperty(
+        title='Port', default=DEFAULT_PORT, advanced=True, order=10)
+    io_port = IntProperty(
+        title='I/O Port', default=IO_PORT, advanced=True, order=11)
+    version = VersionProperty('0.1.0')
+
+    def __init__(self):
+        super().__init__()
+        self.cnxn = None
+        self._decode = None
+        self._listener = None
+        self._connection = None
+        self._connection_path = None
+        self._connection_lock = Lock()
+        self._stop_event = Event()
+        self._thread = None
+        self._last_received = 0
+        self._packets = 0
+        self._last_data = None
+
+    def configure(self, context):
+        super().configure(context)
+        self._decode = compile_decoder(
+            self.assembly().data_type(),
+            self.assembly().is_array(),
+            self.assembly().layout())
+        self._connection_path = build_io_path(
+            self.assembly().config_instance(),
+            self.assembly().output_instance(),
+            self.assembly().input_instance())
+        self._listener = get_io_listener(self.io_port())
+
+    def start(self):
+        super().start()
+        self._stop_event.clear()
+        self._thread = Thread(
+            target=self._run, name='EIPImplicitIO', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._close()
+        super().stop()
+
+    def _run(self):
+        """ Keep the connection open and send its heartbeats """
+        sequence = 0
+        while not self._stop_event.is_set():
+            if self._connection is None and not self._open():
+                self._stop_event.wait(RECONNECT_INTERVAL)
+                continue
+            connection = self._connection
+            o_t_interval = connection.o_t_api / 1e6
+            timeout = TIMEOUT_PACKETS * connection.t_o_api / 1e6
+            if not self._packets:
+                timeout = max(timeout, INITIAL_TIMEOUT)
+            if monotonic() - self._last_received > timeout:
+                msg = 'I/O connection to {} timed out, reconnecting...'
+                self.logger.warning(msg.format(self.host()))
+                self._close()
+                continue
+            sequence = (sequence + 1) & 0xFFFF
+            try:
+                self._listener.send(
+                    build_io_packet(connection.o_t_cid, sequence, sequence),
+                    (self.host(), self.io_port()))
+            except OSError:
+                msg = 'Unable to send a heartbeat to {}'
+                self.logger.exception(msg.format(self.host()))
+            self._stop_event.wait(o_t_interval)
+
+    def _open(self):
+        host = self.host()
+        try:
+            self.cnxn = connection_pool.checkout(CIPDriver, host, self.port())
+            connection = self.cnxn.open_io_connection(
+                self._connection_path, int(self.rpi() * 1000),
+                self.assembly().input_size(),
+                timeout_multiplier=TIMEOUT_MULTIPLIER)
+        except Exception:
+            msg = 'Unable to connect to {}'.format(host)
+            self.logger.exception(msg)
+            self._release(discard=True)
+            return False
+        if not connection:
+            msg = 'Unable to open an I/O connection to {}: {}'
+            self.logger.error(msg.format(host, self.cnxn.get_status()))
+            self._release()
+            return False
+        self._packets = 0
+        self._last_data = None
+        self._last_received = monotonic()
+        with self._connection_lock:
+            self._connection = connection
+        self._listener.register(connection.t_o_cid, self._receive_packet)
+        return True
+
+    def _close(self):
+        with self._connection_lock:
+            connection = self._connection
+            self._connection = None
+        if connection is not None:
+            self._listener.unregister(connection.t_o_cid)
+            try:
+                self.cnxn.close_io_connection(
+                    connection.serial, self._connection_path)
+            except Exception:
+                # the session is already broken
+                pass
+        self._release()
+
+    def _release(self, discard=False):
+        if self.cnxn is not None:
+            connection_pool.checkin(self.cnxn, discard)
+            self.cnxn = None
+
+    def _receive_packet(self, encap_sequence, sequence, data):
+        """ Called by the IOListener with a view of each packet's data """
+        self._last_received = monotonic()
+        self._packets += 1
+        if self._packets % max(self.decimation(), 1):
+            return
+        if self.on_change():
+            if data == self._last_data:
+                return
+            self._last_data = bytes(data)
+        value = bytes(data)
+        if self._decode is not None:
+            try:
+                value = self._decode(value)
+            except Exception:
+                msg = 'Unable to decode {} from {}'
+                self.logger.exception(msg.format(value, self.host()))
+                return
+        self.notify_signals([Signal({
+            'host': self.host(),
+            'sequence': sequence,
+            'value': value,
+        })])
@@ -0,0 +1,75 @@
+import ipaddress
+from time import perf_counter
+
+from .connection_pool import DEFAULT_PORT
+from .discovery import discover
+from nio import Block
+from nio.block.mixins import EnrichSignals
+from nio.command import command
+from nio.properties import IntProperty, StringProperty, TimeDeltaProperty, \
+    VersionProperty
+
+
+@command('discover')
+class EIPListIdentity(EnrichSignals, Block):
+    """ Discover EtherNet/IP devices with ListIdentity
+
+    One request is broadcast, or sent to every host of a network at once,
+    and every reply within the timeout is collected into one inventory
+    signal.
+    """
+
+    address = StringProperty(
+        title='Address', default='255.255.255.255', order=0)
+    timeout = TimeDeltaProperty(
+        title='Timeout', default={'seconds': 1}, order=1)
+    port = IntProperty(
+        title='Port', default=DEFAULT_PORT, advanced=True, order=10)
+    version = VersionProperty('0.1.0')
+
+    def process_signals(self, signals):
+        outgoing_signals = []
+        for signal in signals:
+            inventory = self._inventory(
+                self.address(signal), self.timeout(signal))
+            if inventory is not None:
+                outgoing_signals.append(
+                    self.get_output_signal(inventory, signal))
+        if outgoing_signals:
+            self.notify_signals(outgoing_signals)
+
+    def discover(self):
+        """ The inventory of the configured address """
+        return self._inventory(self.address(), self.timeout())
+
+    def _inventory(self, address, timeout):
+        started = perf_counter()
+        try:
+            identities = discover(
+                address, self.port(), timeout.total_seconds())
+        except Exception:
+            msg = 'ListIdentity failed, address: {}'
+            self.logger.exception(msg.format(address))
+            return None
+        identities = sorted(
+            identities, key=lambda identity: ipaddress.ip_address(identity.ip))
+        devices = [{
+            'ip': identity.ip,
+            'port': identity.port,
+            'vendor': identity.vendor,
+            'device_type': identity.device_type,
+            'product_code': identity.product_code,
+            'revision': '{}.{:03d}'.format(*identity.revision),
+            'serial': '{:08x}'.format(identity.serial),
+            'product_name': identity.product_name,
+            'status': identity.status,
+            'state': identity.state,
+        } for identity in identities]
+        self.logger.debug('Discovered {} devices at {}'.format(
+            len(devices), address))
+        return {
+            'address': address,
+            'devices': devices,
+            'count': len(devices),
+            'elapsed': perf_counter() - started,
+        }
@@ -0,0 +1,154 @@
+from time import perf_counter
+
+from .cip_driver import ServiceError, multi_status
+from .cip_types import compile_decoder
+from .eip_base import EIPBase
+from .logix_driver import LogixDriver, STRUCTURE_TYPE, TYPE_CODES, \
+    decode_structure
+from nio.command import command
+from nio.properties import BoolProperty, IntProperty, StringProperty, \
+    VersionProperty
+
+
+@command('refresh_symbols')
+@command('symbol_stats')
+class EIPReadTag(EIPBase):
+    """ Read Logix controller tags by name
+
+    Controller scope tags are addressed by their symbol instance, from a
+    cache of each controller's symbol table shared by the blocks using
+    the same session.
+    """
+
+    tag = StringProperty(title='Tag', default='', order=2)
+    elements = IntProperty(title='Elements', default=1, order=3)
+    decode = BoolProperty(title='Decode Values', default=True, order=4)
+    version = VersionProperty('0.1.0')
+
+    def __init__(self):
+        super().__init__()
+        # (type code, is array) -> decoder
+        self._decoders = {}
+
+    def symbol_stats(self):
+        """ Symbols and templates cached for each host """
+        return {host: cnxn.symbols.stats()
+                for host, cnxn in list(self.cnxns.items())}
+
+    def refresh_symbols(self):
+        """ Clear the cached symbols, such as after a program download """
+        for cnxn in list(self.cnxns.values()):
+            cnxn.invalidate_symbols()
+        return self.symbol_stats()
+
+    def _process_signal(self, host, signal):
+        tag = self.tag(signal)
+        count = self.elements(signal)
+        started = perf_counter()
+        try:
+            value = self.execute_with_retry(
+                self._make_request, host, tag, count)
+        except Exception:
+            value = False
+            self._transport_failed(host)
+            msg = 'Read Tag failed, host: {}, tag: {}'
+            self.logger.exception(msg.format(host, tag))
+        self._record_request(host, [tag], started, not self._failed(value))
+        if not self._failed(value):
+            return self._handle_value(host, signal, tag, count, value)
+        if isinstance(value, ServiceError):
+            msg = 'Read Tag failed, {}, host: {}, tag: {}'
+            msg = msg.format(multi_status(value.status), host, tag)
+        elif self.cnxns.get(host) is None:
+            msg = 'Connection to {} failed.'.format(host)
+        else:
+            msg = 'Read Tag failed, host: {}, tag: {}'.format(host, tag)
+        self.logger.error(msg)
+
+    def _process_batch(self, host, signals):
+        tags = [(self.tag(signal), self.elements(signal))
+                for signal in signals]
+        started = perf_counter()
+        try:
+            values, statuses = self.execute_with_retry(
+                self._make_multi_request, host, tags)
+        except Exception:
+            self._record_request(host, None, started, False)
+            self._transport_failed(host)
+            msg = 'Read Tag batch failed, host: {}'
+            self.logger.exception(msg.format(host))
+            return [None] * len(signals)
+        self._record_request(host, None, started)
+        outgoing_signals = []
+        for signal, (tag, count), value, status in \
+                zip(signals, tags, values, statuses):
+            if value is False:
+                msg = 'Read Tag failed, {}, host: {}, tag: {}'
+                self.logger.error(msg.format(status, host, tag))
+                outgoing_signals.append(None)
+                continue
+            outgoing_signals.append(
+                self._handle_value(host, signal, tag, count, value))
+        return outgoing_signals
+
+    def _handle_value(self, host, signal, tag, count, value):
+        try:
+            data_type, decoded = self._decode_value(host, tag, count, value)
+        except Exception:
+            msg = 'Unable to decode {}, host: {}, tag: {}'
+            self.logger.exception(msg.format(value.data, host, tag))
+            return
+        new_signal_dict = {}
+        new_signal_dict['host'] = host
+        new_signal_dict['tag'] = tag
+        new_signal_dict['type'] = data_type
+        new_signal_dict['value'] = decoded
+        return self.get_output_signal(new_signal_dict, signal)
+
+    def _decode_value(self, host, tag, count, value):
+        """ Return the name of the tag's data type and its value, decoded
+        if it is atomic or a controller scope structure
+        """
+        if value.type == STRUCTURE_TYPE:
+            template = self.cnxns[host].tag_template(tag)
+            if template is None:
+                # a member or program scope structure, not decoded
+                return 'STRUCT', value.data
+            if not self.decode():
+                return template.name, value.data
+            if count == 1:
+                return template.name, decode_structure(
+                    template, value.data)
+            return template.name, [
+                decode_structure(template, value.data[offset:])
+                for offset in range(0, len(value.data), template.size)]
+        data_type = TYPE_CODES.get(value.type)
+        if data_type is None:
+            return '{:#06x}'.format(value.type), value.data
+        if not self.decode():
+            return data_type.value, value.data
+        key = (data_type, count > 1)
+        decode = self._decoders.get(key)
+        if decode is None:
+            decode = self._decoders[key] = compile_decoder(*key)
+        return data_type.value, decode(value.data)
+
+    def _asynchronous(self):
+        # tag requests are made with the blocking driver
+        return False
+
+    def _driver_kind(self):
+        return 'Logix'
+
+    def _create_driver(self):
+        return LogixDriver(self.pipeline_window())
+
+    def _make_request(self, host, tag, count):
+        try:
+            return self.cnxns[host].read_tag(tag, count, raise_errors=True)
+        except ServiceError as e:
+            # the controller failed the request, it is not retried
+            return e
+
+    def _make_multi_request(self, host, tags):
+        return self.cnxns[host].read_tags(tags)
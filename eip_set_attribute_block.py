@@ -1,105 +1,242 @@
-from .cip_driver import CIPDriver
-from nio import Block
-from nio.block.mixins import EnrichSignals, Retry
-from nio.properties import IntProperty, ObjectProperty, Property, \
-    PropertyHolder, StringProperty, VersionProperty
+from collections import OrderedDict
+from time import perf_counter
 
+from .async_cip_driver import AsyncCIPDriver
+from .cip_driver import CIPDriver, ServiceError, multi_status
+from .eip_base import EIPBase
+from .rate_limiter import Priority
+from .read_cache import read_cache
+from .write_queue import OverflowPolicy, WriteQueue
+from nio.command import command
+from nio.properties import BoolProperty, IntProperty, ObjectProperty, \
+    Property, PropertyHolder, SelectProperty, TimeDeltaProperty, \
+    VersionProperty
 
-class ObjectPath(PropertyHolder):
 
-    class_id = IntProperty(title='Class ID', default=1, order=0)
-    instance_num = IntProperty(title='Instance', default=1, order=1)
-    attribute_num = Property(
-        title='Attribute', default=None, allow_none=True, order=2)
+class WriteQueueOptions(PropertyHolder):
 
+    enabled = BoolProperty(title='Enabled', default=False, order=0)
+    max_size = IntProperty(title='Max Size', default=1000, order=1)
+    flush_interval = TimeDeltaProperty(
+        title='Flush Interval', default={'milliseconds': 100}, order=2)
+    flush_size = IntProperty(title='Flush Size', default=100, order=3)
+    overflow = SelectProperty(
+        OverflowPolicy, title='When Full', default=OverflowPolicy.BLOCK,
+        order=4)
 
-class EIPSetAttribute(EnrichSignals, Retry, Block):
 
-    host = StringProperty(title='Hostname', default='localhost', order=0)
-    path = ObjectProperty(ObjectPath, title='CIP Object Path',  order=1)
+@command('queue_stats')
+class EIPSetAttribute(EIPBase):
+
     value = Property(
         title='Value(s) to Write', default='{{ bytes([0, 0]) }}', order=2)
+    write_queue = ObjectProperty(
+        WriteQueueOptions, title='Write Queue', advanced=True, order=20)
+    priority = SelectProperty(
+        Priority, title='Priority', default=Priority.WRITE, advanced=True,
+        order=31)
     version = VersionProperty('0.2.1')
 
     def __init__(self):
         super().__init__()
-        self.cnxn = None
-
-    def before_retry(self, *args, **kwargs):
-        self._disconnect()
-        self._connect()
+        self._queue = None
 
     def configure(self, context):
         super().configure(context)
-        try:
-            self._connect()
-        except Exception:
-            self.cnxn = None
-            msg = 'Unable to connect to {}'.format(self.host())
-            self.logger.exception(msg)
+        options = self.write_queue()
+        if options.enabled():
+            self._queue = WriteQueue(
+                self._flush,
+                options.max_size(),
+                options.flush_interval().total_seconds(),
+                options.flush_size(),
+                options.overflow(),
+                logger=self.logger)
+
+    def start(self):
+        super().start()
+        if self._queue is not None:
+            self._queue.start()
+
+    def stop(self):
+        if self._queue is not None:
+            # the last queued writes are flushed before disconnecting
+            self._queue.stop()
+        super().stop()
 
     def process_signals(self, signals):
-        host = self.host()
-        outgoing_signals = []
-        if self.cnxn is None:
-            try:
-                msg = 'Not connected to {}, reconnecting...'.format(host)
-                self.logger.warning(msg)
-                self._connect()
-            except Exception:
-                self.cnxn = None
-                msg = 'Unable to connect to {}'.format(host)
-                self.logger.exception(msg)
-                return
+        if self._queue is None:
+            return super().process_signals(signals)
         for signal in signals:
-            path = [
-                self.path().class_id(signal), self.path().instance_num(signal)]
-            if self.path().attribute_num(signal) != None:
-                path.append(int(self.path().attribute_num(signal)))
+            host = self.host(signal)
+            path = self._get_path(signal)
             write_value = self.value(signal)
-            try:
-                value = self.execute_with_retry(
-                    self._make_request, write_value, path)
-            except Exception:
-                value = False
-                self.cnxn = None
-                msg = 'set_attribute_single failed, host: {}, path: {}'
-                self.logger.exception(msg.format(host, path))
-            if value:
-                new_signal_dict = {}
-                new_signal_dict['host'] = host
-                new_signal_dict['path'] = path
-                new_signal_dict['value'] = write_value
-                new_signal = self.get_output_signal(new_signal_dict, signal)
-                outgoing_signals.append(new_signal)
-            else:
-                if self.cnxn is None:
-                    msg = 'Connection to {} failed.'.format(host)
-                else:
-                    status = self.cnxn.get_status()
-                    msg = (
-                        'set_attribute_single failed: {}\n'
-                        'host: {}, path: {}, value: {}')
-                    msg = msg.format(status, host, path, write_value)
-                self.logger.error(msg)
-        self.notify_signals(outgoing_signals)
+            if not self._queue.put(
+                    (host, tuple(path)), (host, signal, write_value, path)):
+                msg = 'Write queue is full, dropped write, host: {}, ' \
+                    'path: {}, value: {}'
+                self.logger.warning(msg.format(host, path, write_value))
 
-    def stop(self):
-        self._disconnect()
-        super().stop()
+    def queue_stats(self):
+        """ Queued, coalesced, dropped and flushed writes """
+        if self._queue is None:
+            return {}
+        return self._queue.stats()
+
+    def _flush(self, queued):
+        """ Write the latest queued value of each host and path in one
+        batch per host and notify the writes that succeeded
+        """
+        lanes = OrderedDict()
+        for host, signal, write_value, path in queued:
+            lane = lanes.setdefault(host, ([], []))
+            lane[0].append(signal)
+            lane[1].append((write_value, path))
+        outgoing_signals = []
+        for host, (signals, items) in lanes.items():
+            if not self._ensure_connected(host):
+                continue
+            outgoing_signals.extend(
+                signal for signal in self._write_batch(host, signals, items)
+                if signal is not None)
+        if outgoing_signals:
+            self.notify_signals(outgoing_signals)
+
+    def _process_signal(self, host, signal):
+        path = self._get_path(signal)
+        write_value = self.value(signal)
+        started = perf_counter()
+        try:
+            value = self.execute_with_retry(
+                self._make_request, host, write_value, path)
+        except Exception:
+            value = False
+            self._transport_failed(host)
+            msg = 'set_attribute_single failed, host: {}, path: {}'
+            self.logger.exception(msg.format(host, path))
+        self._invalidate(host, [path])
+        self._record_request(host, path, started, not self._failed(value))
+        return self._handle_reply(host, signal, path, write_value, value)
+
+    async def _process_signal_async(self, host, signal):
+        path = self._get_path(signal)
+        write_value = self.value(signal)
+        started = perf_counter()
+        try:
+            value = await self.cnxns[host].async_set_attribute_single(
+                write_value, *path)
+        except ServiceError as e:
+            # the request failed, other pipelined requests are unaffected
+            value = e
+        except Exception:
+            value = False
+            self._transport_failed(host)
+            msg = 'set_attribute_single failed, host: {}, path: {}'
+            self.logger.exception(msg.format(host, path))
+        self._invalidate(host, [path])
+        self._record_request(host, path, started, not self._failed(value))
+        return self._handle_reply(host, signal, path, write_value, value)
 
-    def _connect(self):
-        # each instance of CIPDriver can open connection to only 1 host
-        # subsequent calls to open() are quietly ignored, and close()
-        # does not take any args, so one host per block instance for now
-        self.cnxn = CIPDriver()
-        self.cnxn.open(self.host())
+    def _handle_reply(self, host, signal, path, write_value, value):
+        if not self._failed(value):
+            new_signal_dict = {}
+            new_signal_dict['host'] = host
+            new_signal_dict['path'] = path
+            new_signal_dict['value'] = write_value
+            return self.get_output_signal(new_signal_dict, signal)
+        if isinstance(value, ServiceError):
+            msg = (
+                'set_attribute_single failed: {}\n'
+                'host: {}, path: {}, value: {}')
+            msg = msg.format(
+                multi_status(value.status), host, path, write_value)
+        elif self.cnxns.get(host) is None:
+            msg = 'Connection to {} failed.'.format(host)
+        else:
+            msg = 'set_attribute_single failed, host: {}, path: {}, ' \
+                'value: {}'.format(host, path, write_value)
+        self.logger.error(msg)
 
-    def _disconnect(self):
-        if self.cnxn is not None:
-            self.cnxn.close()
-            self.cnxn = None
+    def _process_batch(self, host, signals):
+        items = [
+            (self.value(signal), self._get_path(signal))
+            for signal in signals]
+        return self._write_batch(host, signals, items)
 
-    def _make_request(self, value, path):
-        return self.cnxn.set_attribute_single(value, *path)
+    def _write_batch(self, host, signals, items):
+        started = perf_counter()
+        try:
+            results, statuses = self.execute_with_retry(
+                self._make_multi_request, host, items)
+        except Exception:
+            self._invalidate(host, [path for _, path in items])
+            self._record_request(host, None, started, False)
+            self._transport_failed(host)
+            msg = 'set_attribute_multi failed, host: {}'
+            self.logger.exception(msg.format(host))
+            return [None] * len(signals)
+        self._record_request(host, None, started)
+        return self._handle_batch_reply(
+            host, signals, items, results, statuses)
+
+    async def _process_batch_async(self, host, signals):
+        items = [
+            (self.value(signal), self._get_path(signal))
+            for signal in signals]
+        started = perf_counter()
+        try:
+            results, statuses = \
+                await self.cnxns[host].async_set_attribute_multi(items)
+        except Exception:
+            self._invalidate(host, [path for _, path in items])
+            self._record_request(host, None, started, False)
+            self._transport_failed(host)
+            msg = 'set_attribute_multi failed, host: {}'
+            self.logger.exception(msg.format(host))
+            return [None] * len(signals)
+        self._record_request(host, None, started)
+        return self._handle_batch_reply(
+            host, signals, items, results, statuses)
+
+    def _handle_batch_reply(self, host, signals, items, results, statuses):
+        self._invalidate(host, [path for _, path in items])
+        outgoing_signals = []
+        for signal, (write_value, path), result, status in \
+                zip(signals, items, results, statuses):
+            if not result:
+                msg = (
+                    'set_attribute_single failed: {}\n'
+                    'host: {}, path: {}, value: {}')
+                self.logger.error(msg.format(status, host, path, write_value))
+                outgoing_signals.append(None)
+                continue
+            new_signal_dict = {}
+            new_signal_dict['host'] = host
+            new_signal_dict['path'] = path
+            new_signal_dict['value'] = write_value
+            new_signal = self.get_output_signal(new_signal_dict, signal)
+            outgoing_signals.append(new_signal)
+        return outgoing_signals
+
+    def _create_driver(self):
+        if self._asynchronous():
+            return AsyncCIPDriver()
+        return CIPDriver(self.pipeline_window())
+
+    def _invalidate(self, host, paths):
+        """ Forget cached reads of the paths written, even if the writes
+        failed they may have changed the values
+        """
+        for path in paths:
+            read_cache.invalidate(host, self.port(), path)
+
+    def _make_request(self, host, value, path):
+        try:
+            return self.cnxns[host].set_attribute_single(
+                value, *path, raise_errors=True)
+        except ServiceError as e:
+            # the target failed the request, it is not retried
+            return e
 
+    def _make_multi_request(self, host, items):
+        return self.cnxns[host].set_attribute_multi(items)
@@ -0,0 +1,144 @@
+from time import perf_counter
+
+from .cip_driver import ServiceError, multi_status
+from .cip_types import DataType
+from .eip_base import EIPBase
+from .logix_driver import LogixDriver, STRUCTURE_TYPE, TYPE_NAMES
+from .rate_limiter import Priority
+from nio.properties import IntProperty, Property, SelectProperty, \
+    StringProperty, VersionProperty
+
+
+class EIPWriteTag(EIPBase):
+    """ Write Logix controller tags by name, see EIPReadTag """
+
+    tag = StringProperty(title='Tag', default='', order=2)
+    elements = IntProperty(title='Elements', default=1, order=3)
+    data_type = SelectProperty(
+        DataType, title='Data Type', default=DataType.DINT, order=4)
+    value = Property(
+        title='Value(s) to Write', default='{{ bytes(4) }}', order=5)
+    priority = SelectProperty(
+        Priority, title='Priority', default=Priority.WRITE, advanced=True,
+        order=31)
+    version = VersionProperty('0.1.0')
+
+    def configure(self, context):
+        super().configure(context)
+        data_type = self.data_type()
+        if data_type not in TYPE_NAMES and data_type is not DataType.STRUCT:
+            raise ValueError(
+                '{} is not a Logix data type'.format(data_type.value))
+
+    def _process_signal(self, host, signal):
+        tag = self.tag(signal)
+        count = self.elements(signal)
+        write_value = self.value(signal)
+        started = perf_counter()
+        try:
+            result = self.execute_with_retry(
+                self._make_request, host, tag, write_value, count)
+        except Exception:
+            result = False
+            self._transport_failed(host)
+            msg = 'Write Tag failed, host: {}, tag: {}'
+            self.logger.exception(msg.format(host, tag))
+        self._record_request(host, [tag], started, not self._failed(result))
+        if not self._failed(result):
+            return self._output(host, signal, tag, write_value)
+        if isinstance(result, ServiceError):
+            msg = 'Write Tag failed: {}\nhost: {}, tag: {}, value: {}'
+            msg = msg.format(
+                multi_status(result.status), host, tag, write_value)
+        elif self.cnxns.get(host) is None:
+            msg = 'Connection to {} failed.'.format(host)
+        else:
+            msg = 'Write Tag failed, host: {}, tag: {}, value: {}'
+            msg = msg.format(host, tag, write_value)
+        self.logger.error(msg)
+
+    def _process_batch(self, host, signals):
+        items = [
+            (self.tag(signal), self.value(signal), self.elements(signal))
+            for signal in signals]
+        started = perf_counter()
+        try:
+            results, statuses = self.execute_with_retry(
+                self._make_multi_request, host, items)
+        except Exception:
+            self._record_request(host, None, started, False)
+            self._transport_failed(host)
+            msg = 'Write Tag batch failed, host: {}'
+            self.logger.exception(msg.format(host))
+            return [None] * len(signals)
+        self._record_request(host, None, started)
+        outgoing_signals = []
+        for signal, (tag, write_value, _), result, status in \
+                zip(signals, items, results, statuses):
+            if result is None:
+                outgoing_signals.append(None)
+                continue
+            if not result:
+                msg = 'Write Tag failed: {}\nhost: {}, tag: {}, value: {}'
+                self.logger.error(msg.format(status, host, tag, write_value))
+                outgoing_signals.append(None)
+                continue
+            outgoing_signals.append(
+                self._output(host, signal, tag, write_value))
+        return outgoing_signals
+
+    def _output(self, host, signal, tag, write_value):
+        new_signal_dict = {}
+        new_signal_dict['host'] = host
+        new_signal_dict['tag'] = tag
+        new_signal_dict['value'] = write_value
+        return self.get_output_signal(new_signal_dict, signal)
+
+    def _data_type(self, host, tag):
+        """ Return (type code, structure handle or None) to write tag, or
+        None if it can not be written as a structure
+        """
+        data_type = self.data_type()
+        if data_type is not DataType.STRUCT:
+            return TYPE_NAMES[data_type], None
+        template = self.cnxns[host].tag_template(tag)
+        if template is None:
+            msg = 'STRUCT values can only be written to controller scope ' \
+                'structure tags, host: {}, tag: {}'
+            self.logger.error(msg.format(host, tag))
+            return None
+        return STRUCTURE_TYPE, template.handle
+
+    def _asynchronous(self):
+        # tag requests are made with the blocking driver
+        return False
+
+    def _driver_kind(self):
+        return 'Logix'
+
+    def _create_driver(self):
+        return LogixDriver(self.pipeline_window())
+
+    def _make_request(self, host, tag, value, count):
+        data_type = self._data_type(host, tag)
+        if data_type is None:
+            return False
+        try:
+            return self.cnxns[host].write_tag(
+                tag, data_type[0], value, count, data_type[1],
+                raise_errors=True)
+        except ServiceError as e:
+            # the controller failed the request, it is not retried
+            return e
+
+    def _make_multi_request(self, host, items):
+        data_types = [self._data_type(host, tag) for tag, _, _ in items]
+        results, statuses = self.cnxns[host].write_tags([
+            (tag, data_type[0], value, count, data_type[1])
+            for (tag, value, count), data_type in zip(items, data_types)
+            if data_type is not None])
+        results, statuses = iter(results), iter(statuses)
+        # None for each tag that was skipped, and its status
+        skipped = [data_type is None for data_type in data_types]
+        return [None if skip else next(results) for skip in skipped], \
+            [None if skip else next(statuses) for skip in skipped]
@@ -0,0 +1,131 @@
+import logging
+import socket
+import struct
+from threading import Lock, Thread
+
+
+IO_PORT = 2222
+# common packet format of an I/O packet: item count, the sequenced address
+# item with the connection ID and encapsulation sequence number, and the
+# connected data item whose data starts with the 16 bit sequence count
+IO_HEADER = struct.Struct('<HHHIIHHH')
+SEQUENCED_ADDRESS_ITEM = 0x8002
+CONNECTED_DATA_ITEM = 0xB1
+# largest UDP datagram
+IO_BUFFER_SIZE = 0x10000
+# seconds between checks for the listener being stopped
+IO_POLL_INTERVAL = 0.5
+
+logger = logging.getLogger(__name__)
+
+
+def build_io_packet(cid, encap_sequence, sequence, data=b''):
+    """ Build an I/O packet for the connection cid """
+    return IO_HEADER.pack(
+        2, SEQUENCED_ADDRESS_ITEM, 8, cid, encap_sequence,
+        CONNECTED_DATA_ITEM, len(data) + 2, sequence) + bytes(data)
+
+
+def parse_io_packet(packet):
+    """ Return (connection ID, encapsulation sequence number, sequence
+    count, data) of an I/O packet, or None if it is not one
+
+    data is a view of packet.
+    """
+    if len(packet) < IO_HEADER.size:
+        return None
+    count, address_type, _, cid, encap_sequence, data_type, length, \
+        sequence = IO_HEADER.unpack_from(packet)
+    if count != 2 or address_type != SEQUENCED_ADDRESS_ITEM or \
+            data_type != CONNECTED_DATA_ITEM:
+        return None
+    end = IO_HEADER.size + length - 2
+    return cid, encap_sequence, sequence, \
+        memoryview(packet)[IO_HEADER.size:end]
+
+
+class IOListener(object):
+    """ Receives class 1 I/O packets for every connection in the process
+
+    One UDP socket is bound to the port for all connections. Packets are
+    received into a single buffer on the listener's thread and the data of
+    each is passed to the callback of its connection as a memoryview, only
+    valid until the callback returns. The socket is closed when the last
+    connection is unregistered.
+    """
+
+    def __init__(self, port=IO_PORT):
+        self.port = port
+        self._lock = Lock()
+        # T->O connection ID -> callback(encap sequence, sequence, data)
+        self._callbacks = {}
+        self._sock = None
+        self._thread = None
+
+    def register(self, cid, callback):
+        with self._lock:
+            if self._sock is None:
+                self._open()
+            self._callbacks[cid] = callback
+
+    def unregister(self, cid):
+        with self._lock:
+            self._callbacks.pop(cid, None)
+            if not self._callbacks and self._sock is not None:
+                # the receiver thread closes the socket
+                self._sock = None
+                self._thread = None
+
+    def send(self, packet, address):
+        with self._lock:
+            sock = self._sock
+        if sock is not None:
+            sock.sendto(packet, address)
+
+    def _open(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('', self.port))
+        sock.settimeout(IO_POLL_INTERVAL)
+        self._sock = sock
+        self._thread = Thread(
+            target=self._receive, args=(sock,), name='IOListener',
+            daemon=True)
+        self._thread.start()
+
+    def _receive(self, sock):
+        buffer = bytearray(IO_BUFFER_SIZE)
+        view = memoryview(buffer)
+        try:
+            while self._sock is sock:
+                try:
+                    count, _ = sock.recvfrom_into(buffer)
+                except socket.timeout:
+                    continue
+                except OSError:
+                    break
+                packet = parse_io_packet(view[:count])
+                if packet is None:
+                    continue
+                cid, encap_sequence, sequence, data = packet
+                callback = self._callbacks.get(cid)
+                if callback is None:
+                    continue
+                try:
+                    callback(encap_sequence, sequence, data)
+                except Exception:
+                    logger.exception('I/O packet callback failed')
+        finally:
+            sock.close()
+
+
+_listeners = {}
+_listeners_lock = Lock()
+
+
+def get_io_listener(port=IO_PORT):
+    """ The IOListener shared by all connections receiving on port """
+    with _listeners_lock:
+        if port not in _listeners:
+            _listeners[port] = IOListener(port)
+        return _listeners[port]
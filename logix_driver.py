@@ -0,0 +1,484 @@
+import re
+import struct
+from collections import OrderedDict, namedtuple
+
+from pycomm.cip.cip_base import DataError
+
+from .cip_driver import CIPDriver, PARTIAL_TRANSFER, ServiceError, \
+    build_request, encode_path, locked, multi_status
+from .cip_types import DataType, FORMATS, compile_decoder, data_size
+
+
+READ_TAG = 0x4C
+WRITE_TAG = 0x4D
+READ_TAG_FRAGMENTED = 0x52
+GET_INSTANCE_ATTRIBUTE_LIST = 0x55
+READ_TEMPLATE = 0x4C
+SYMBOL_CLASS = 0x6B
+TEMPLATE_CLASS = 0x6C
+ANSI_SYMBOLIC_SEGMENT = 0x91
+# general statuses of a request to a path that does not exist, a cached
+# symbol instance that fails with these is stale
+PATH_ERRORS = (0x04, 0x05)
+# Symbol Object attributes fetched for each symbol: name and type
+SYMBOL_ATTRIBUTES = (1, 2)
+# bits of a symbol or structure member type, a structure's type holds
+# its Template Object instance, otherwise the atomic type code
+STRUCTURE_BIT = 0x8000
+SYSTEM_BIT = 0x1000
+TEMPLATE_MASK = 0x0FFF
+ATOMIC_MASK = 0x00FF
+# data type of a structure in Read Tag replies, followed by its handle
+STRUCTURE_TYPE = 0x02A0
+# Template Object attributes: definition size in words, structure size
+# in bytes, member count and structure handle
+TEMPLATE_ATTRIBUTES = (4, 5, 2, 1)
+TEMPLATE_SIZES = (4, 4, 2, 2)
+# the template definition read is this many bytes shorter than its size
+TEMPLATE_OVERHEAD = 23
+# Logix atomic type codes
+TYPE_CODES = OrderedDict([
+    (0xC1, DataType.BOOL),
+    (0xC2, DataType.SINT),
+    (0xC3, DataType.INT),
+    (0xC4, DataType.DINT),
+    (0xC5, DataType.LINT),
+    (0xC6, DataType.USINT),
+    (0xC7, DataType.UINT),
+    (0xC8, DataType.UDINT),
+    (0xC9, DataType.ULINT),
+    (0xCA, DataType.REAL),
+    (0xCB, DataType.LREAL),
+])
+TYPE_NAMES = {data_type: code for code, data_type in TYPE_CODES.items()}
+
+_TAG_PART = re.compile(r'([^.\[\]]+)(?:\[(\d+(?:,\d+)*)\])?(?:\.|$)')
+
+Symbol = namedtuple('Symbol', ['name', 'instance', 'type'])
+Member = namedtuple('Member', ['name', 'type', 'offset', 'info'])
+Template = namedtuple('Template', ['handle', 'name', 'size', 'members'])
+# data type code, structure handle or None, and the data of a tag
+TagData = namedtuple('TagData', ['type', 'handle', 'data'])
+
+
+def parse_tag(tag):
+    """ Split a tag name into the (name, indexes) of each of its parts,
+    such as 'Tag[1,2].Member' into [('Tag', (1, 2)), ('Member', ())]
+    """
+    parts = []
+    position = 0
+    tag = tag.replace(' ', '')
+    while position < len(tag):
+        match = _TAG_PART.match(tag, position)
+        if match is None:
+            raise ValueError('Invalid tag name: {}'.format(tag))
+        name, indexes = match.groups()
+        parts.append((name, tuple(
+            int(index) for index in indexes.split(',')) if indexes else ()))
+        position = match.end()
+    if not parts:
+        raise ValueError('Invalid tag name: {}'.format(tag))
+    return parts
+
+
+def element_segment(index):
+    if index <= 0xFF:
+        return bytes([0x28, index])
+    if index <= 0xFFFF:
+        return bytes([0x29, 0x00]) + struct.pack('<H', index)
+    return bytes([0x2A, 0x00]) + struct.pack('<I', index)
+
+
+def encode_tag_path(parts, instance=None):
+    """ The EPATH of a parsed tag name, starting with the Symbol Object
+    instance of its first part if it is known
+    """
+    path = bytearray()
+    for position, (name, indexes) in enumerate(parts):
+        if position == 0 and instance is not None:
+            path += encode_path(SYMBOL_CLASS, instance)
+        else:
+            encoded = name.encode('ascii')
+            path += bytes([ANSI_SYMBOLIC_SEGMENT, len(encoded)]) + encoded
+            if len(encoded) % 2:
+                path.append(0)
+        for index in indexes:
+            path += element_segment(index)
+    return bytes(path)
+
+
+def parse_symbols(data):
+    """ Symbols in the reply data of a Get_Instance_Attribute_List """
+    symbols = []
+    offset = 0
+    try:
+        while offset < len(data):
+            instance, length = struct.unpack_from('<IH', data, offset)
+            offset += 6
+            name = bytes(data[offset:offset + length]).decode('ascii')
+            offset += length
+            symbol_type, = struct.unpack_from('<H', data, offset)
+            offset += 2
+            symbols.append(Symbol(name, instance, symbol_type))
+    except (struct.error, UnicodeDecodeError) as e:
+        raise DataError('Invalid symbol list: {}'.format(e))
+    return symbols
+
+
+def parse_tag_reply(reply):
+    """ Return (data type, structure handle or None, data) of a Read Tag
+    reply
+    """
+    data_type, = struct.unpack_from('<H', reply)
+    if data_type == STRUCTURE_TYPE:
+        return data_type, struct.unpack_from('<H', reply, 2)[0], reply[4:]
+    return data_type, None, reply[2:]
+
+
+def build_write_tag(data_type, handle, data, count=1):
+    """ Request data of a Write Tag """
+    if data_type == STRUCTURE_TYPE:
+        header = struct.pack('<HHH', data_type, handle, count)
+    else:
+        header = struct.pack('<HH', data_type, count)
+    return header + bytes(data)
+
+
+def parse_template(handle, size, member_count, data):
+    """ Template of a structure from its definition, which holds the
+    info, type and offset of each member followed by the structure's
+    name and each member's name, null terminated
+    """
+    try:
+        members = [
+            struct.unpack_from('<HHI', data, index * 8)
+            for index in range(member_count)]
+        names = bytes(data[member_count * 8:]).split(b'\x00')
+        name = names[0].split(b';')[0].decode('ascii')
+        return Template(handle, name, size, [
+            Member(member_name.decode('ascii'), member_type, offset, info)
+            for (info, member_type, offset), member_name in
+            zip(members, names[1:member_count + 1])])
+    except (struct.error, UnicodeDecodeError) as e:
+        raise DataError('Invalid template definition: {}'.format(e))
+
+
+def decode_structure(template, data):
+    """ Decode the data of a structure to an ordered dict of its members
+
+    Atomic members and arrays of them are decoded, BOOL members are the
+    bit of their host member given by their info. Nested structures and
+    BOOL arrays are left as bytes. Hidden members are not included.
+    """
+    offsets = sorted(set(
+        [member.offset for member in template.members] + [template.size]))
+    values = OrderedDict()
+    for member in template.members:
+        if member.name.startswith(('ZZZZZZZZZZ', '__')):
+            # hosts of BOOL members
+            continue
+        data_type = TYPE_CODES.get(member.type & ATOMIC_MASK)
+        is_array = member.type & 0x6000 != 0
+        if member.type & STRUCTURE_BIT or data_type is None or \
+                (is_array and data_type is DataType.BOOL):
+            end = offsets[offsets.index(member.offset) + 1]
+            values[member.name] = bytes(data[member.offset:end])
+        elif data_type is DataType.BOOL:
+            values[member.name] = bool(
+                data[member.offset] >> member.info & 1)
+        elif is_array:
+            size = data_size(data_type) * member.info
+            values[member.name] = compile_decoder(data_type, True)(
+                data[member.offset:member.offset + size])
+        else:
+            values[member.name] = struct.unpack_from(
+                '<' + FORMATS[data_type], data, member.offset)[0]
+    return values
+
+
+class SymbolCache(object):
+    """ Controller scope symbols by lower case name and templates by
+    instance, with the encoded path of each tag looked up
+
+    Symbols are added a page at a time from Get_Instance_Attribute_List
+    replies, starting at next_instance, until the table is complete.
+    """
+
+    def __init__(self):
+        self.invalidations = 0
+        self._clear()
+
+    def invalidate(self):
+        self.invalidations += 1
+        self._clear()
+
+    def _clear(self):
+        self.symbols = {}
+        self.templates = {}
+        # tag -> (path, expected data type or None)
+        self.paths = {}
+        self.next_instance = 0
+        self.complete = False
+        self.pages = 0
+
+    def add_page(self, symbols, more):
+        for symbol in symbols:
+            if ':' in symbol.name or symbol.name.startswith('__') or \
+                    symbol.type & SYSTEM_BIT:
+                # programs, routines and system symbols
+                continue
+            self.symbols[symbol.name.lower()] = symbol
+        if symbols:
+            self.next_instance = symbols[-1].instance + 1
+        self.complete = not more
+        self.pages += 1
+
+    def stats(self):
+        return {
+            'symbols': len(self.symbols),
+            'templates': len(self.templates),
+            'pages': self.pages,
+            'complete': self.complete,
+            'invalidations': self.invalidations,
+        }
+
+
+class LogixDriver(CIPDriver):
+    """ CIPDriver with Logix tag reads and writes
+
+    Controller scope tags are addressed by their Symbol Object instance,
+    looked up in a cache of the controller's symbol table that is fetched
+    a page at a time until the tag is found. Program scope tags, and tags
+    not in the table, use ANSI symbolic segments. A cached instance that
+    no longer exists, or replies with a different data type, means the
+    program changed, the cache is cleared and the request is retried once.
+    """
+
+    def __init__(self, window=1):
+        super(LogixDriver, self).__init__(window)
+        self.symbols = SymbolCache()
+
+    @locked
+    def read_tag(self, tag, count=1, raise_errors=False):
+        """ Read count elements of a tag with Read Tag Fragmented
+
+        Returns TagData, or False if the controller fails the request, see
+        get_attribute_single for raise_errors.
+        """
+        fragments = []
+        try:
+            for fragment in self.read_tag_fragmented(tag, count):
+                fragments.append(fragment.data)
+        except ServiceError:
+            if raise_errors:
+                raise
+            return False
+        return TagData(fragment.type, fragment.handle, b''.join(fragments))
+
+    def read_tag_fragmented(self, tag, count=1):
+        """ Yield the TagData of each fragment of a tag read with Read Tag
+        Fragmented when it is received
+
+        Raises ServiceError if the controller fails a request.
+        """
+        offset = 0
+        while True:
+            status, reply = self._tag_request(
+                READ_TAG_FRAGMENTED, tag, struct.pack('<HI', count, offset))
+            fragment = TagData(*parse_tag_reply(reply))
+            yield fragment
+            if status != PARTIAL_TRANSFER:
+                return
+            if not fragment.data:
+                raise DataError('Partial transfer without data')
+            offset += len(fragment.data)
+
+    @locked
+    def read_tags(self, tags):
+        """ Read many tags with Read Tag in Multiple Service Packets
+
+        tags is a list of (tag, count). Returns (values, statuses), a list
+        with the TagData of each tag, in order, or False for each one that
+        failed, and the status of each. Each tag must fit in one packet.
+        """
+        replies = self._tag_services([
+            (READ_TAG, tag, struct.pack('<H', count))
+            for tag, count in tags])
+        return [TagData(*parse_tag_reply(data)) if status == 0 else False
+                for status, data in replies], \
+            [multi_status(status) for status, _ in replies]
+
+    @locked
+    def write_tag(self, tag, data_type, data, count=1, handle=None,
+                  raise_errors=False):
+        """ Write count elements of a tag with Write Tag, True on success
+
+        data_type is a Logix type code, or STRUCTURE_TYPE with the
+        structure's handle. See get_attribute_single for raise_errors.
+        """
+        try:
+            self._tag_request(
+                WRITE_TAG, tag,
+                build_write_tag(data_type, handle, data, count))
+        except ServiceError:
+            if raise_errors:
+                raise
+            return False
+        return True
+
+    @locked
+    def write_tags(self, items):
+        """ Write many tags with Write Tag in Multiple Service Packets
+
+        items is a list of (tag, data type, data, count, handle). Returns
+        (results, statuses), a list with True for each tag that was
+        written, in order, or False for each one that failed, and the
+        status of each.
+        """
+        replies = self._tag_services([
+            (WRITE_TAG, tag,
+             build_write_tag(data_type, handle, data, count))
+            for tag, data_type, data, count, handle in items])
+        return [status == 0 for status, _ in replies], \
+            [multi_status(status) for status, _ in replies]
+
+    @locked
+    def get_template(self, instance):
+        """ The Template of the structure type of a Template Object
+        instance, cached until the symbols are invalidated
+        """
+        template = self.symbols.templates.get(instance)
+        if template is None:
+            template = self._read_template(instance)
+            self.symbols.templates[instance] = template
+        return template
+
+    @locked
+    def tag_template(self, tag):
+        """ The Template of a controller scope structure tag, or None if
+        the tag is not one, such as a member or an atomic tag
+        """
+        parts = parse_tag(tag)
+        if len(parts) > 1:
+            return None
+        symbol = self._symbol(parts[0][0])
+        if symbol is None or not symbol.type & STRUCTURE_BIT:
+            return None
+        return self.get_template(symbol.type & TEMPLATE_MASK)
+
+    @locked
+    def invalidate_symbols(self):
+        self.symbols.invalidate()
+
+    @locked
+    def _tag_request(self, service, tag, data):
+        """ Return (general status, reply data) of a request to a tag,
+        retried once with fresh symbols if its cached instance is stale
+        """
+        path, expected = self._tag_path(tag)
+        try:
+            status, reply = self._send_fragment(
+                build_request(service, path, data))
+            if not self._stale(service, expected, status, reply):
+                return status, reply
+        except ServiceError as e:
+            if expected is None or e.status not in PATH_ERRORS:
+                raise
+        self.symbols.invalidate()
+        path, _ = self._tag_path(tag)
+        return self._send_fragment(build_request(service, path, data))
+
+    def _tag_services(self, items):
+        """ Send (service, tag, data) items in Multiple Service Packets and
+        return the (general status, data) of each, retried once with fresh
+        symbols if any cached instance is stale
+        """
+        for attempt in range(2):
+            paths = [self._tag_path(tag) for _, tag, _ in items]
+            replies = self._send_services([
+                build_request(service, path, data)
+                for (service, _, data), (path, _) in zip(items, paths)])
+            stale = any(
+                self._stale(service, expected, status, data)
+                or expected is not None and status in PATH_ERRORS
+                for (service, _, _), (_, expected), (status, data) in
+                zip(items, paths, replies))
+            if not stale or attempt:
+                break
+            self.symbols.invalidate()
+        return replies
+
+    @staticmethod
+    def _stale(service, expected, status, reply):
+        """ True if a read of a cached symbol replied with another type """
+        if service not in (READ_TAG, READ_TAG_FRAGMENTED) or \
+                expected is None or status not in (0, PARTIAL_TRANSFER):
+            return False
+        return len(reply) >= 2 and \
+            struct.unpack_from('<H', reply)[0] != expected
+
+    def _tag_path(self, tag):
+        """ Return (encoded path, expected data type) of a tag, the type
+        is None unless the path starts with a cached symbol instance
+        """
+        entry = self.symbols.paths.get(tag)
+        if entry is None:
+            parts = parse_tag(tag)
+            symbol = self._symbol(parts[0][0])
+            if symbol is None:
+                entry = (encode_tag_path(parts), None)
+            else:
+                expected = None
+                if len(parts) == 1:
+                    expected = STRUCTURE_TYPE \
+                        if symbol.type & STRUCTURE_BIT \
+                        else symbol.type & ATOMIC_MASK
+                entry = (encode_tag_path(parts, symbol.instance), expected)
+            self.symbols.paths[tag] = entry
+        return entry
+
+    def _symbol(self, name):
+        """ The cached symbol of a controller scope tag, fetching pages of
+        the symbol table until it is found, or None
+        """
+        if ':' in name:
+            # program scope tags are not in the controller's table
+            return None
+        name = name.lower()
+        while True:
+            symbol = self.symbols.symbols.get(name)
+            if symbol is not None or self.symbols.complete:
+                return symbol
+            status, data = self._send_fragment(build_request(
+                GET_INSTANCE_ATTRIBUTE_LIST,
+                encode_path(SYMBOL_CLASS, self.symbols.next_instance),
+                struct.pack('<{}H'.format(len(SYMBOL_ATTRIBUTES) + 1),
+                            len(SYMBOL_ATTRIBUTES), *SYMBOL_ATTRIBUTES)))
+            symbols = parse_symbols(data)
+            more = status == PARTIAL_TRANSFER
+            if more and not symbols:
+                raise DataError('Partial symbol list without symbols')
+            self.symbols.add_page(symbols, more)
+
+    def _read_template(self, instance):
+        values, statuses = self.get_attribute_list(
+            TEMPLATE_CLASS, instance, TEMPLATE_ATTRIBUTES, TEMPLATE_SIZES)
+        if False in values:
+            raise ServiceError('Unable to read template {}, {}'.format(
+                instance, statuses[values.index(False)][1]))
+        words, size = [struct.unpack('<I', value)[0] for value in values[:2]]
+        member_count, handle = [
+            struct.unpack('<H', value)[0] for value in values[2:]]
+        length = words * 4 - TEMPLATE_OVERHEAD
+        definition = bytearray()
+        while len(definition) < length:
+            status, reply = self._send_fragment(build_request(
+                READ_TEMPLATE, encode_path(TEMPLATE_CLASS, instance),
+                struct.pack('<IH', len(definition),
+                            length - len(definition))))
+            definition += reply
+            if status != PARTIAL_TRANSFER:
+                break
+            if not reply:
+                raise DataError('Partial transfer without data')
+        return parse_template(handle, size, member_count, definition)
@@ -0,0 +1,134 @@
+from bisect import bisect_left
+from collections import Counter, OrderedDict
+from threading import Lock
+from time import monotonic
+
+
+# upper bounds of the latency histogram buckets, in milliseconds
+BUCKETS_MS = (
+    0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+# seconds of samples kept by each histogram, in SLOTS parts
+WINDOW = 60.0
+SLOTS = 6
+# histograms kept by name, such as one per host and path, the least
+# recently recorded are dropped first
+MAX_HISTOGRAMS = 1024
+
+
+class Histogram(object):
+    """ Latency histogram of the samples in the last window seconds
+
+    The window is kept in slots that are dropped as they age out, so the
+    window rolls in steps of window / slots seconds. Not thread safe, see
+    Metrics.
+    """
+
+    def __init__(self, window=WINDOW, slots=SLOTS):
+        self.slot_seconds = window / slots
+        # [slot number, bucket counts, count, total seconds, max seconds]
+        self._slots = []
+        self._max_slots = slots
+
+    def record(self, seconds):
+        slot = self._slot(int(monotonic() / self.slot_seconds))
+        slot[1][bisect_left(BUCKETS_MS, seconds * 1000)] += 1
+        slot[2] += 1
+        slot[3] += seconds
+        slot[4] = max(slot[4], seconds)
+
+    def snapshot(self):
+        self._expire(int(monotonic() / self.slot_seconds))
+        buckets = [0] * (len(BUCKETS_MS) + 1)
+        count = 0
+        total = 0.0
+        maximum = 0.0
+        for _, slot_buckets, slot_count, slot_total, slot_max in self._slots:
+            buckets = [a + b for a, b in zip(buckets, slot_buckets)]
+            count += slot_count
+            total += slot_total
+            maximum = max(maximum, slot_max)
+        return {
+            'count': count,
+            'mean_ms': total / count * 1000 if count else 0.0,
+            'max_ms': maximum * 1000,
+            'p50_ms': self._percentile(buckets, count, 0.5, maximum),
+            'p99_ms': self._percentile(buckets, count, 0.99, maximum),
+            'buckets': {
+                str(bound): bucket_count for bound, bucket_count in
+                zip(BUCKETS_MS + ('inf',), buckets) if bucket_count},
+        }
+
+    def _slot(self, number):
+        self._expire(number)
+        if not self._slots or self._slots[-1][0] != number:
+            self._slots.append(
+                [number, [0] * (len(BUCKETS_MS) + 1), 0, 0.0, 0.0])
+        return self._slots[-1]
+
+    def _expire(self, number):
+        while self._slots and self._slots[0][0] <= number - self._max_slots:
+            self._slots.pop(0)
+
+    @staticmethod
+    def _percentile(buckets, count, fraction, maximum):
+        """ The upper bound of the bucket holding the percentile, at most
+        the largest sample
+        """
+        if not count:
+            return 0.0
+        rank = fraction * count
+        seen = 0
+        for bound, bucket_count in zip(BUCKETS_MS, buckets):
+            seen += bucket_count
+            if seen >= rank:
+                return min(bound, maximum * 1000)
+        return maximum * 1000
+
+
+class Metrics(object):
+    """ Thread safe counters and rolling latency histograms
+
+    At most max_histograms names are kept, so names made from signal
+    values do not grow without bound.
+    """
+
+    def __init__(self, window=WINDOW, max_histograms=MAX_HISTOGRAMS):
+        self.window = window
+        self.max_histograms = max_histograms
+        self._lock = Lock()
+        self._counters = Counter()
+        self._statuses = Counter()
+        # name -> Histogram, least recently recorded first
+        self._histograms = OrderedDict()
+
+    def increment(self, name, count=1):
+        with self._lock:
+            self._counters[name] += count
+
+    def status(self, status):
+        """ Count a CIP general status code """
+        with self._lock:
+            self._statuses[status] += 1
+
+    def record(self, name, seconds):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram(self.window)
+                while len(self._histograms) > self.max_histograms:
+                    self._histograms.popitem(last=False)
+            else:
+                self._histograms.move_to_end(name)
+            histogram.record(seconds)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'counters': dict(self._counters),
+                'statuses': {
+                    '0x{:02x}'.format(status): count
+                    for status, count in sorted(self._statuses.items())},
+                'latency': {
+                    name: histogram.snapshot()
+                    for name, histogram in sorted(self._histograms.items())},
+            }
@@ -0,0 +1,94 @@
+from threading import Event, Lock, Thread
+from time import monotonic
+
+
+class PollScheduler(object):
+    """ Calls target with a list of the items due at each tick
+
+    Each item is polled every interval seconds, items due within coalesce
+    seconds of each other are passed to target together in the order they
+    were given. target is called from the scheduler's own thread. If target
+    takes longer than an item's interval the missed ticks are skipped and
+    counted as overruns.
+    """
+
+    def __init__(self, target, items, coalesce=0.001, logger=None):
+        """ items is a list of (interval in seconds, item) pairs """
+        self.target = target
+        self.intervals = [max(interval, 0.001) for interval, _ in items]
+        self.items = [item for _, item in items]
+        self.coalesce = coalesce
+        self.logger = logger
+        self._stop_event = Event()
+        self._thread = None
+        self._stats_lock = Lock()
+        self._reset_stats()
+
+    def start(self):
+        self._stop_event.clear()
+        self._thread = Thread(
+            target=self._run, name='PollScheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def stats(self):
+        """ Ticks, overruns and jitter in seconds since the last start """
+        with self._stats_lock:
+            ticks = self._ticks
+            return {
+                'ticks': ticks,
+                'overruns': self._overruns,
+                'jitter_last': self._jitter_last,
+                'jitter_max': self._jitter_max,
+                'jitter_mean': self._jitter_total / ticks if ticks else 0.0,
+            }
+
+    def _reset_stats(self):
+        with self._stats_lock:
+            self._ticks = 0
+            self._overruns = 0
+            self._jitter_last = 0.0
+            self._jitter_max = 0.0
+            self._jitter_total = 0.0
+
+    def _run(self):
+        self._reset_stats()
+        start = monotonic()
+        due = [start] * len(self.items)
+        while due and not self._stop_event.is_set():
+            next_due = min(due)
+            delay = next_due - monotonic()
+            if delay > 0 and self._stop_event.wait(delay):
+                break
+            now = monotonic()
+            indexes = [
+                index for index, time in enumerate(due)
+                if time <= now + self.coalesce]
+            self._record_tick(now - next_due)
+            try:
+                self.target([self.items[index] for index in indexes])
+            except Exception:
+                if self.logger is not None:
+                    self.logger.exception('Poll failed')
+            finished = monotonic()
+            for index in indexes:
+                interval = self.intervals[index]
+                due[index] += interval
+                if due[index] <= finished:
+                    # skip the ticks missed while polling
+                    missed = int((finished - due[index]) // interval) + 1
+                    due[index] += missed * interval
+                    with self._stats_lock:
+                        self._overruns += missed
+
+    def _record_tick(self, jitter):
+        with self._stats_lock:
+            self._ticks += 1
+            self._jitter_last = jitter
+            self._jitter_max = max(self._jitter_max, jitter)
+            self._jitter_total += jitter
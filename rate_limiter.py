@@ -0,0 +1,187 @@
+from collections import OrderedDict, deque
+from enum import Enum
+from threading import Condition, Lock
+from time import monotonic
+
+
+# requests that may be sent at once after a host has been idle
+BURST = 4
+# the rate never falls below this fraction of the limit
+MIN_RATE_FRACTION = 0.05
+# fraction of the limit added to the rate after each request that did not
+# queue at the device
+INCREASE = 0.05
+# factor the rate is cut by when replies slow down, and after a timeout
+# or other transport failure, at most once per smoothed round trip
+DECREASE = 0.8
+BACKOFF = 0.5
+# replies slower than this many times the fastest recent round trip mean
+# requests are queuing at the device
+RTT_TOLERANCE = 2.0
+# weight of each round trip in the smoothed round trip
+RTT_GAIN = 0.125
+# seconds the fastest round trip is remembered, so that a device that
+# became slower for good is not limited forever
+MIN_RTT_WINDOW = 10.0
+
+
+class Priority(Enum):
+    """ Requests waiting for the same host are sent in this order """
+    ALARM = 'alarm'
+    WRITE = 'write'
+    READ = 'read'
+    TREND = 'trend'
+
+
+class RateLimiter(object):
+    """ Token bucket limiting the rate of requests to one host
+
+    The rate starts at the limit and adapts to the host: it is cut when
+    the smoothed round trip grows well past the fastest recent round trip,
+    or when a request times out, and grows back additively while replies
+    are fast. Waiting requests are granted by priority, and requests of the
+    same priority from different owners, such as blocks, take turns.
+    """
+
+    def __init__(self, limit, burst=BURST):
+        self.limit = limit
+        self.rate = limit
+        self.burst = burst
+        self._tokens = float(burst)
+        self._refilled = monotonic()
+        self._condition = Condition()
+        # priority -> OrderedDict of owner -> deque of waiting tickets, the
+        # first owner is next
+        self._waiting = OrderedDict(
+            (priority, OrderedDict()) for priority in Priority)
+        self._srtt = None
+        self._min_rtt = None
+        self._min_rtt_at = 0.0
+        self._decreased_at = 0.0
+        self.granted = 0
+        self.waited = 0.0
+        self.decreases = 0
+
+    def acquire(self, priority=Priority.READ, owner=None):
+        """ Wait until a request may be sent """
+        ticket = object()
+        started = monotonic()
+        with self._condition:
+            tickets = self._waiting[priority].setdefault(owner, deque())
+            tickets.append(ticket)
+            while True:
+                self._refill()
+                if self._next() is ticket:
+                    if self._tokens >= 1:
+                        break
+                    self._condition.wait((1 - self._tokens) / self.rate)
+                else:
+                    # woken when the requests ahead are granted
+                    self._condition.wait(1 / self.rate)
+            tickets.popleft()
+            owners = self._waiting[priority]
+            if tickets:
+                owners.move_to_end(owner)
+            else:
+                del owners[owner]
+            self._tokens -= 1
+            self.granted += 1
+            self.waited += monotonic() - started
+            self._condition.notify_all()
+
+    def completed(self, rtt=None):
+        """ Record a reply, with its round trip in seconds if it was a
+        single request
+        """
+        with self._condition:
+            now = monotonic()
+            if rtt is not None:
+                if self._srtt is None:
+                    self._srtt = rtt
+                else:
+                    self._srtt += (rtt - self._srtt) * RTT_GAIN
+                if self._min_rtt is None or rtt <= self._min_rtt or \
+                        now - self._min_rtt_at > MIN_RTT_WINDOW:
+                    self._min_rtt = rtt
+                    self._min_rtt_at = now
+                if self._srtt > self._min_rtt * RTT_TOLERANCE:
+                    self._decrease(DECREASE, now)
+                    return
+            self._set_rate(self.rate + self.limit * INCREASE)
+
+    def failed(self):
+        """ Record a timeout or other transport failure """
+        with self._condition:
+            self._decrease(BACKOFF, monotonic())
+
+    def restrict(self, limit):
+        """ Lower the limit, a higher limit is ignored """
+        with self._condition:
+            if limit < self.limit:
+                self.limit = limit
+                self._set_rate(self.rate)
+
+    def stats(self):
+        with self._condition:
+            return {
+                'limit': self.limit,
+                'rate': self.rate,
+                'srtt_ms': (self._srtt or 0.0) * 1000,
+                'min_rtt_ms': (self._min_rtt or 0.0) * 1000,
+                'granted': self.granted,
+                'waiting': sum(
+                    len(tickets) for owners in self._waiting.values()
+                    for tickets in owners.values()),
+                'mean_wait_ms':
+                    self.waited / self.granted * 1000 if self.granted
+                    else 0.0,
+                'decreases': self.decreases,
+            }
+
+    def _next(self):
+        for owners in self._waiting.values():
+            if owners:
+                return next(iter(owners.values()))[0]
+
+    def _refill(self):
+        now = monotonic()
+        self._tokens = min(
+            self._tokens + (now - self._refilled) * self.rate, self.burst)
+        self._refilled = now
+
+    def _decrease(self, factor, now):
+        # once per round trip, the replies already in flight were sent at
+        # the old rate
+        if now - self._decreased_at < (self._srtt or 0.0):
+            return
+        self._decreased_at = now
+        self.decreases += 1
+        self._set_rate(self.rate * factor)
+
+    def _set_rate(self, rate):
+        self._refill()
+        self.rate = min(max(rate, self.limit * MIN_RATE_FRACTION), self.limit)
+
+
+class RateLimiters(object):
+    """ Process-wide rate limiters, one per host and port shared by every
+    block limiting requests to it, limited to the lowest limit of those
+    blocks
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        # (host, port) -> RateLimiter
+        self._limiters = {}
+
+    def get(self, host, port, limit):
+        with self._lock:
+            limiter = self._limiters.get((host, port))
+            if limiter is None:
+                limiter = self._limiters[(host, port)] = RateLimiter(limit)
+            else:
+                limiter.restrict(limit)
+            return limiter
+
+
+rate_limiters = RateLimiters()
@@ -0,0 +1,126 @@
+from collections import OrderedDict
+from concurrent.futures import Future
+from threading import Lock
+from time import monotonic
+
+
+# attribute paths kept, the least recently read are evicted first
+MAX_ENTRIES = 4096
+# the result of a read in flight that failed
+FAILED = object()
+
+
+class ReadCache(object):
+    """ Attribute values read in the last few milliseconds, shared by every
+    block reading the same host
+
+    Values are kept for the TTL of the read that fetched them, and only
+    shared by reads with the same options, such as the data type. A read
+    of a path that is already being read waits for that read instead of
+    sending another request, and sends its own if that read fails. Writing
+    a path invalidates it, and a read in flight during the write is not
+    kept.
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._lock = Lock()
+        # (host, port, path) -> {options: (expiry, value)}, least recently
+        # read first
+        self._entries = OrderedDict()
+        # (host, port, path, options) -> Future of the read in flight
+        self._reads = {}
+        self.hits = 0
+        self.coalesced = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    def read(self, host, port, path, ttl, read, options=()):
+        """ Return (value, shared), the value of path read with the same
+        options within ttl seconds or by a read in flight, or else returned
+        by read()
+
+        shared is False if read() was called. Failed reads, that raise or
+        return False or an exception, are neither kept nor shared, the
+        reads waiting for them call read() instead.
+        """
+        path_key = (host, port, tuple(path))
+        key = path_key + (options,)
+        with self._lock:
+            values = self._entries.get(path_key)
+            entry = values.get(options) if values is not None else None
+            if entry is not None:
+                if entry[0] > monotonic():
+                    self._entries.move_to_end(path_key)
+                    self.hits += 1
+                    return entry[1], True
+                del values[options]
+                if not values:
+                    del self._entries[path_key]
+            future = self._reads.get(key)
+            if future is None:
+                future = self._reads[key] = Future()
+                self.misses += 1
+                waiting = False
+            else:
+                self.coalesced += 1
+                waiting = True
+        if waiting:
+            value = future.result()
+            if value is FAILED:
+                return read(), False
+            return value, True
+        try:
+            value = read()
+        except Exception:
+            with self._lock:
+                if self._reads.get(key) is future:
+                    del self._reads[key]
+            future.set_result(FAILED)
+            raise
+        failed = value is False or isinstance(value, Exception)
+        with self._lock:
+            if self._reads.get(key) is future:
+                del self._reads[key]
+                if not failed and ttl > 0:
+                    self._entries.setdefault(path_key, {})[options] = \
+                        (monotonic() + ttl, value)
+                    self._entries.move_to_end(path_key)
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+                        self.evictions += 1
+        future.set_result(FAILED if failed else value)
+        return value, False
+
+    def invalidate(self, host, port, path):
+        """ Forget path and its instance, with any options, such as after
+        writing it
+        """
+        keys = [(host, port, tuple(path))]
+        if len(path) > 2:
+            # read with Get_Attribute_All
+            keys.append((host, port, tuple(path[:2])))
+        with self._lock:
+            for key in keys:
+                if self._entries.pop(key, None) is not None:
+                    self.invalidations += 1
+            # reads in flight started before the write, they are returned
+            # to their waiters but not kept
+            for key in [key for key in self._reads if key[:3] in keys]:
+                del self._reads[key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'in_flight': len(self._reads),
+                'hits': self.hits,
+                'coalesced': self.coalesced,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'evictions': self.evictions,
+            }
+
+
+read_cache = ReadCache()
@@ -0,0 +1,622 @@
+import socket
+import socketserver
+import struct
+from collections import OrderedDict
+from itertools import count
+from queue import Empty, Queue
+from threading import Event, Lock, Thread
+from time import monotonic, sleep
+
+from .cip_driver import ATTRIBUTE_LIST_ERROR, CONNECTED_LENGTH_OFFSET, \
+    FILE_CLASS, FORWARD_CLOSE_SERVICE, FORWARD_OPEN_SERVICE, \
+    GET_ATTRIBUTE_ALL, GET_ATTRIBUTE_LIST, GET_ATTRIBUTE_SINGLE, \
+    INITIATE_UPLOAD, LARGE_FORWARD_OPEN_SERVICE, MULTIPLE_SERVICE_PACKET, \
+    SEND_RR_DATA, SEND_UNIT_DATA, SET_ATTRIBUTE_SINGLE, TRANSPORT_CLASS_1, \
+    UNCONNECTED_LENGTH_OFFSET, UNCONNECTED_PACKET_SIZE, UPLOAD_TRANSFER
+from .discovery import BUFFER_SIZE, Identity, LIST_IDENTITY, \
+    build_identity_item
+from .implicit_io import IO_PORT, build_io_packet
+from .logix_driver import ANSI_SYMBOLIC_SEGMENT, \
+    GET_INSTANCE_ATTRIBUTE_LIST, PARTIAL_TRANSFER, READ_TAG, \
+    READ_TAG_FRAGMENTED, SYMBOL_CLASS, TYPE_CODES, WRITE_TAG
+from .cip_types import data_size
+
+
+# encapsulation header: command, length, session handle, status,
+# sender context and options
+HEADER = struct.Struct('<HHII8sI')
+HEADER_SIZE = HEADER.size
+NOP = 0x00
+REGISTER_SESSION = 0x65
+UNREGISTER_SESSION = 0x66
+# encapsulation status of an unsupported command
+INVALID_COMMAND = 0x01
+# general status codes
+SUCCESS = 0x00
+CONNECTION_FAILURE = 0x01
+PATH_DESTINATION_UNKNOWN = 0x05
+SERVICE_NOT_SUPPORTED = 0x08
+EMBEDDED_SERVICE_ERROR = 0x1E
+ATTRIBUTE_NOT_SUPPORTED = 0x14
+OBJECT_STATE_CONFLICT = 0x0C
+REPLY_DATA_TOO_LARGE = 0x11
+INVALID_PARAMETER = 0x20
+# symbol type bit of a one dimensional array
+ARRAY_BIT = 0x2000
+# most tag data in one Read Tag Fragmented reply
+FRAGMENT_SIZE = 400
+# Upload_Transfer packet types
+FIRST_PACKET = 0
+MIDDLE_PACKET = 1
+LAST_PACKET = 2
+FIRST_AND_LAST_PACKET = 3
+# the simulator's Identity object, its IP address and port are those it
+# listens on
+IDENTITY = Identity(
+    None, None, vendor=1, device_type=0x0C, product_code=1, revision=(1, 1),
+    status=0, serial=0x12345678, product_name='EIPSimulator', state=3)
+# seconds between checks for the simulator being stopped
+IDENTITY_POLL_INTERVAL = 0.1
+# Assembly object data attribute
+ASSEMBLY_CLASS = 0x04
+ASSEMBLY_DATA = 0x03
+
+
+def parse_request(request):
+    """ Return (service, (class, instance, attribute), request data) of a
+    Message Router request, parts of the path that are missing are None
+    """
+    service = request[0]
+    size = request[1] * 2
+    segments = parse_path(request[2:2 + size])
+    path = (segments.get(0x20), segments.get(0x24), segments.get(0x30))
+    return service, path, request[2 + size:]
+
+
+def parse_path(path):
+    """ Return a dict of the 8 bit segment type of each logical segment in
+    path to its value, later segments of a type replace earlier ones
+    """
+    segments = {}
+    points = []
+    symbols = []
+    index = 0
+    while index < len(path):
+        segment = path[index]
+        if segment == ANSI_SYMBOLIC_SEGMENT:
+            length = path[index + 1]
+            symbols.append(
+                bytes(path[index + 2:index + 2 + length]).decode('ascii'))
+            index += 2 + length + length % 2
+            continue
+        if segment < 0x20:
+            # a port segment to route through a backplane
+            index += 2
+            continue
+        if segment & 0x03 == 0x00:
+            value = path[index + 1]
+            index += 2
+        elif segment & 0x03 == 0x01:
+            value = struct.unpack_from('<H', path, index + 2)[0]
+            index += 4
+        else:
+            value = struct.unpack_from('<I', path, index + 2)[0]
+            index += 6
+        segment &= 0xFC
+        if segment == 0x2C:
+            points.append(value)
+        segments[segment] = value
+    segments['points'] = points
+    segments['symbols'] = symbols
+    return segments
+
+
+def build_reply(service, status=SUCCESS, data=b''):
+    return bytes([service | 0x80, 0, status, 0]) + bytes(data)
+
+
+class IOProducer(object):
+    """ Produces the data of an input assembly on a class 1 connection """
+
+    def __init__(self, simulator, cid, address, rpi, key):
+        self.simulator = simulator
+        self.cid = cid
+        self.address = address
+        self.rpi = rpi
+        self.key = key
+        self._stop_event = Event()
+        self._thread = Thread(
+            target=self._run, name='IOProducer', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _run(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sequence = 0
+        try:
+            while not self._stop_event.wait(self.rpi):
+                sequence = (sequence + 1) & 0xFFFF
+                data = self.simulator.attributes.get(self.key, b'')
+                sock.sendto(
+                    build_io_packet(self.cid, sequence, sequence, data),
+                    self.address)
+        finally:
+            sock.close()
+
+
+class EIPSimulator(socketserver.ThreadingTCPServer):
+    """ An in-process EtherNet/IP adapter for tests and benchmarks
+
+    Supports sessions, unconnected messages with SendRRData, class 3
+    connected messages with SendUnitData, Get_Attribute_Single,
+    Get_Attribute_List, Get_Attribute_All, Set_Attribute_Single and
+    Multiple Service Packet requests for the values in attributes, keyed
+    by (class, instance, attribute). Files maps File Object instances to
+    their contents, uploaded with Initiate_Upload and Upload_Transfer.
+    Tags maps Logix controller scope tag names to (type code, data),
+    read and written by symbolic or Symbol Object instance paths with an
+    optional element index. services maps other service codes to a
+    function of (path, request data) returning (status, reply data).
+    Replies larger than an unconnected message, or than the size of the
+    class 3 connection they are sent on, fail with Reply Data Too Large.
+    Class 1 I/O connections produce the data attribute of the input
+    assembly to io_port of the originator every RPI. ListIdentity
+    requests, over TCP or UDP to the same port, are answered with
+    identity. Every reply is delayed by latency seconds, if out_of_order
+    is True the replies in flight together are sent in reverse order. The
+    simulator listens on an ephemeral port of 127.0.0.1 by default.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0,
+                 attributes=None, io_port=IO_PORT, services=None,
+                 files=None, tags=None, identity=IDENTITY,
+                 out_of_order=False):
+        super().__init__((host, port), SimulatorHandler)
+        self.latency = latency
+        self.out_of_order = out_of_order
+        self.identity = identity._replace(
+            ip=identity.ip or self.server_address[0],
+            port=identity.port or self.port)
+        self.list_identity_requests = 0
+        # answers ListIdentity over UDP
+        self._udp = None
+        self._stopped = Event()
+        self.attributes = dict(attributes or {})
+        self.services = dict(services or {})
+        self.files = dict(files or {})
+        # File Object instance -> [transfer size, next transfer number,
+        # offset] of its upload
+        self._uploads = {}
+        self.tags = OrderedDict(tags or {})
+        # symbols listed in each Get_Instance_Attribute_List reply
+        self.symbol_page_size = 100
+        self.io_port = io_port
+        self.requests = 0
+        self._lock = Lock()
+        self._sessions = count(1)
+        self._connection_ids = count(0x10000)
+        # O->T connection ID of class 3 connections -> (connection serial
+        # number, vendor, originator serial, largest reply)
+        self._connections = {}
+        # connection serial number -> IOProducer of class 1 connections
+        self._producers = {}
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self._thread = Thread(
+            target=self.serve_forever, name='EIPSimulator', daemon=True)
+        self._thread.start()
+        self._udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._udp.bind(self.server_address)
+        self._udp.settimeout(IDENTITY_POLL_INTERVAL)
+        Thread(target=self._serve_identity, name='EIPSimulatorIdentity',
+               daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self.shutdown()
+        self.server_close()
+        with self._lock:
+            for producer in self._producers.values():
+                producer.stop()
+            self._producers.clear()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def identity_reply(self):
+        """ The encapsulated data of a ListIdentity reply """
+        with self._lock:
+            self.list_identity_requests += 1
+        return build_identity_item(self.identity)
+
+    def _serve_identity(self):
+        sock = self._udp
+        while not self._stopped.is_set():
+            try:
+                request, originator = sock.recvfrom(BUFFER_SIZE)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if len(request) < HEADER_SIZE:
+                continue
+            command, _, _, _, context, _ = HEADER.unpack_from(request)
+            if command != LIST_IDENTITY:
+                continue
+            data = self.identity_reply()
+            if self.latency:
+                sleep(self.latency)
+            sock.sendto(HEADER.pack(
+                LIST_IDENTITY, len(data), 0, SUCCESS, context, 0) + data,
+                originator)
+        sock.close()
+
+    def next_session(self):
+        with self._lock:
+            return next(self._sessions)
+
+    def service(self, request, originator):
+        """ Return the Message Router reply to a request """
+        with self._lock:
+            self.requests += 1
+        if request[0] in (READ_TAG, READ_TAG_FRAGMENTED, WRITE_TAG,
+                          GET_INSTANCE_ATTRIBUTE_LIST):
+            reply = self._tag_service(request)
+            if reply is not None:
+                return reply
+        service, path, data = parse_request(request)
+        if service == GET_ATTRIBUTE_SINGLE:
+            value = self.attributes.get(path)
+            if value is None:
+                return build_reply(service, ATTRIBUTE_NOT_SUPPORTED)
+            return build_reply(service, data=value)
+        if service == GET_ATTRIBUTE_LIST:
+            return self._get_attribute_list(path, data)
+        if service == GET_ATTRIBUTE_ALL:
+            values = [
+                value for (clss, inst, _), value in
+                sorted(self.attributes.items()) if (clss, inst) == path[:2]]
+            if not values:
+                return build_reply(service, PATH_DESTINATION_UNKNOWN)
+            return build_reply(service, data=b''.join(values))
+        if service == SET_ATTRIBUTE_SINGLE:
+            self.attributes[path] = bytes(data)
+            return build_reply(service)
+        if service == MULTIPLE_SERVICE_PACKET:
+            return self._multiple_service(data, originator)
+        if service in (FORWARD_OPEN_SERVICE, LARGE_FORWARD_OPEN_SERVICE):
+            return self._forward_open(service, data, originator)
+        if service == FORWARD_CLOSE_SERVICE:
+            return self._forward_close(data)
+        if path[0] == FILE_CLASS and \
+                service in (INITIATE_UPLOAD, UPLOAD_TRANSFER):
+            return self._upload(service, path[1], data)
+        if service in self.services:
+            status, reply = self.services[service](path, data)
+            return build_reply(service, status, reply)
+        return build_reply(service, SERVICE_NOT_SUPPORTED)
+
+    def _get_attribute_list(self, path, data):
+        number = struct.unpack_from('<H', data)[0]
+        attributes = struct.unpack_from('<{}H'.format(number), data, 2)
+        status = SUCCESS
+        reply = [struct.pack('<H', number)]
+        for attribute in attributes:
+            value = self.attributes.get(path[:2] + (attribute,))
+            if value is None:
+                status = ATTRIBUTE_LIST_ERROR
+                reply.append(struct.pack(
+                    '<HH', attribute, ATTRIBUTE_NOT_SUPPORTED))
+            else:
+                reply.append(struct.pack('<HH', attribute, SUCCESS) + value)
+        return build_reply(GET_ATTRIBUTE_LIST, status, b''.join(reply))
+
+    def _symbols(self):
+        """ (instance, name, (type code, data)) of each tag, instances
+        are not contiguous
+        """
+        return [(position * 2 + 1, name, value)
+                for position, (name, value) in enumerate(self.tags.items())]
+
+    def _tag_service(self, request):
+        """ The reply to a tag service, or None if the request is not
+        for a tag
+        """
+        service = request[0]
+        size = request[1] * 2
+        segments = parse_path(request[2:2 + size])
+        data = request[2 + size:]
+        if segments.get(0x20) != SYMBOL_CLASS and not segments['symbols']:
+            return None
+        if service == GET_INSTANCE_ATTRIBUTE_LIST:
+            return self._list_symbols(segments.get(0x24, 0))
+        symbols = self._symbols()
+        if segments['symbols']:
+            name = segments['symbols'][0].lower()
+            found = [
+                symbol for symbol in symbols if symbol[1].lower() == name]
+        else:
+            found = [symbol for symbol in symbols
+                     if symbol[0] == segments.get(0x24)]
+        if not found or len(segments['symbols']) > 1:
+            return build_reply(service, PATH_DESTINATION_UNKNOWN)
+        _, name, (type_code, value) = found[0]
+        element = data_size(TYPE_CODES[type_code])
+        start = segments.get(0x28, 0) * element
+        count = struct.unpack_from(
+            '<H', data, 2 if service == WRITE_TAG else 0)[0]
+        end = start + count * element
+        if end > len(value):
+            return build_reply(service, INVALID_PARAMETER)
+        if service == WRITE_TAG:
+            if struct.unpack_from('<H', data)[0] != type_code or \
+                    len(data) - 4 != end - start:
+                return build_reply(service, INVALID_PARAMETER)
+            self.tags[name] = (
+                type_code, value[:start] + bytes(data[4:]) + value[end:])
+            return build_reply(service)
+        status = SUCCESS
+        if service == READ_TAG_FRAGMENTED:
+            start += struct.unpack_from('<I', data, 2)[0]
+            if end - start > FRAGMENT_SIZE:
+                end = start + FRAGMENT_SIZE
+                status = PARTIAL_TRANSFER
+        return build_reply(
+            service, status, struct.pack('<H', type_code) + value[start:end])
+
+    def _list_symbols(self, start):
+        symbols = [
+            symbol for symbol in self._symbols() if symbol[0] >= start]
+        page = symbols[:self.symbol_page_size]
+        reply = []
+        for instance, name, (type_code, value) in page:
+            symbol_type = type_code
+            if len(value) > data_size(TYPE_CODES[type_code]):
+                symbol_type |= ARRAY_BIT
+            encoded = name.encode('ascii')
+            reply.append(
+                struct.pack('<IH', instance, len(encoded)) + encoded +
+                struct.pack('<H', symbol_type))
+        status = PARTIAL_TRANSFER if len(symbols) > len(page) else SUCCESS
+        return build_reply(
+            GET_INSTANCE_ATTRIBUTE_LIST, status, b''.join(reply))
+
+    def _upload(self, service, instance, data):
+        contents = self.files.get(instance)
+        if contents is None:
+            return build_reply(service, PATH_DESTINATION_UNKNOWN)
+        if service == INITIATE_UPLOAD:
+            transfer_size = data[0]
+            with self._lock:
+                self._uploads[instance] = [transfer_size, 0, 0]
+            return build_reply(service, data=struct.pack(
+                '<IB', len(contents), transfer_size))
+        with self._lock:
+            upload = self._uploads.get(instance)
+            if upload is None or data[0] != upload[1]:
+                return build_reply(service, OBJECT_STATE_CONFLICT)
+            transfer_size, number, offset = upload
+            upload[1] = (number + 1) & 0xFF
+            upload[2] = offset + transfer_size
+        chunk = contents[offset:offset + transfer_size]
+        last = offset + transfer_size >= len(contents)
+        if last:
+            with self._lock:
+                del self._uploads[instance]
+            packet_type = FIRST_AND_LAST_PACKET if offset == 0 \
+                else LAST_PACKET
+            checksum = -sum(contents) & 0xFFFF
+            return build_reply(service, data=bytes([number, packet_type]) +
+                               chunk + struct.pack('<H', checksum))
+        packet_type = FIRST_PACKET if offset == 0 else MIDDLE_PACKET
+        return build_reply(service, data=bytes([number, packet_type]) + chunk)
+
+    def _multiple_service(self, data, originator):
+        number = struct.unpack_from('<H', data)[0]
+        offsets = list(struct.unpack_from('<{}H'.format(number), data, 2))
+        offsets.append(len(data))
+        replies = [
+            self.service(data[start:end], originator)
+            for start, end in zip(offsets, offsets[1:])]
+        offset = 2 + 2 * number
+        reply_offsets = []
+        for reply in replies:
+            reply_offsets.append(offset)
+            offset += len(reply)
+        status = SUCCESS
+        if any(reply[2] != SUCCESS for reply in replies):
+            status = EMBEDDED_SERVICE_ERROR
+        return build_reply(MULTIPLE_SERVICE_PACKET, status, b''.join([
+            struct.pack('<{}H'.format(number + 1), number, *reply_offsets),
+        ] + replies))
+
+    def _forward_open(self, service, data, originator):
+        t_o_cid, serial, vendor, originator_serial = \
+            struct.unpack_from('<4xIHHI', data, 2)
+        params_format = '<IH' if service == FORWARD_OPEN_SERVICE else '<II'
+        params_size = struct.calcsize(params_format)
+        o_t_rpi = struct.unpack_from(params_format, data, 22)[0]
+        t_o_rpi, t_o_params = struct.unpack_from(
+            params_format, data, 22 + params_size)
+        # the connection size includes the 2 byte sequence count
+        size_mask = 0x1FF if service == FORWARD_OPEN_SERVICE else 0xFFFF
+        reply_size = (t_o_params & size_mask) - 2
+        offset = 22 + 2 * params_size
+        transport = data[offset]
+        path = parse_path(data[offset + 2:offset + 2 + data[offset + 1] * 2])
+        with self._lock:
+            o_t_cid = next(self._connection_ids)
+            if transport == TRANSPORT_CLASS_1:
+                points = path['points']
+                if path.get(0x20) != ASSEMBLY_CLASS or len(points) != 2:
+                    return build_reply(service, CONNECTION_FAILURE)
+                key = (ASSEMBLY_CLASS, points[1], ASSEMBLY_DATA)
+                producer = IOProducer(
+                    self, t_o_cid, (originator, self.io_port),
+                    t_o_rpi / 1e6, key)
+                self._producers[serial] = producer
+                producer.start()
+            else:
+                self._connections[o_t_cid] = (
+                    serial, vendor, originator_serial, reply_size)
+        return build_reply(service, data=struct.pack(
+            '<IIHHIIIBB', o_t_cid, t_o_cid, serial, vendor,
+            originator_serial, o_t_rpi, t_o_rpi, 0, 0))
+
+    def _forward_close(self, data):
+        serial, vendor, originator_serial = \
+            struct.unpack_from('<HHI', data, 2)
+        with self._lock:
+            producer = self._producers.pop(serial, None)
+            for cid, connection in list(self._connections.items()):
+                if connection[:3] == (serial, vendor, originator_serial):
+                    del self._connections[cid]
+        if producer is not None:
+            producer.stop()
+        return build_reply(FORWARD_CLOSE_SERVICE, data=struct.pack(
+            '<HHIBB', serial, vendor, originator_serial, 0, 0))
+
+    def is_connected(self, cid):
+        with self._lock:
+            return cid in self._connections
+
+    def reply_size(self, cid=None):
+        """ The largest Message Router reply on the connection cid, or
+        unconnected if cid is None
+        """
+        if cid is None:
+            return UNCONNECTED_PACKET_SIZE
+        with self._lock:
+            return self._connections[cid][3]
+
+    def limited(self, request, reply, cid=None):
+        """ reply, or Reply Data Too Large if it does not fit """
+        if len(reply) > self.reply_size(cid):
+            return build_reply(request[0], REPLY_DATA_TOO_LARGE)
+        return reply
+
+
+class SimulatorHandler(socketserver.BaseRequestHandler):
+    """ Handles the encapsulated requests of one TCP connection """
+
+    def setup(self):
+        # reply to pipelined requests without waiting for their ACKs
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # replies are delayed like a slow link, requests are still read
+        # while earlier replies are in flight
+        self._replies = None
+        if self.server.latency:
+            self._replies = Queue()
+            Thread(target=self._send_replies, daemon=True).start()
+
+    def finish(self):
+        if self._replies is not None:
+            self._replies.put(None)
+
+    def handle(self):
+        self.session = 0
+        while True:
+            header = self._read(HEADER_SIZE)
+            if header is None:
+                return
+            command, length, session, _, context, _ = \
+                HEADER.unpack(header)
+            data = self._read(length) if length else b''
+            if data is None:
+                return
+            if command == NOP:
+                continue
+            if command == UNREGISTER_SESSION:
+                return
+            if command == REGISTER_SESSION:
+                self.session = self.server.next_session()
+                self._reply(command, context, data)
+            elif command == SEND_RR_DATA:
+                self._send_rr_data(context, data)
+            elif command == SEND_UNIT_DATA:
+                self._send_unit_data(context, data)
+            elif command == LIST_IDENTITY:
+                self._reply(command, context, self.server.identity_reply())
+            else:
+                self._reply(command, context, b'', INVALID_COMMAND)
+
+    def _read(self, length):
+        data = bytearray()
+        while len(data) < length:
+            chunk = self.request.recv(length - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return bytes(data)
+
+    def _reply(self, command, context, data, status=SUCCESS):
+        reply = HEADER.pack(
+            command, len(data), self.session, status, context, 0) + data
+        if self._replies is None:
+            self.request.sendall(reply)
+        else:
+            self._replies.put((monotonic() + self.server.latency, reply))
+
+    def _send_replies(self):
+        while True:
+            items = [self._replies.get()]
+            if self.server.out_of_order:
+                # the replies queued behind the first are sent before it
+                while items[-1] is not None:
+                    try:
+                        items.append(self._replies.get_nowait())
+                    except Empty:
+                        break
+            replies = [item for item in items if item is not None]
+            if replies:
+                sleep(max(replies[-1][0] - monotonic(), 0))
+            try:
+                for _, reply in reversed(replies):
+                    self.request.sendall(reply)
+            except OSError:
+                # the originator closed the connection
+                return
+            if items[-1] is None:
+                return
+
+    def _send_rr_data(self, context, data):
+        # interface handle, timeout, item count, null address item and
+        # the unconnected data item
+        offset = UNCONNECTED_LENGTH_OFFSET - HEADER_SIZE
+        length = struct.unpack_from('<H', data, offset)[0]
+        request = data[offset + 2:offset + 2 + length]
+        reply = self.server.limited(
+            request, self.server.service(request, self.client_address[0]))
+        self._reply(SEND_RR_DATA, context, struct.pack(
+            '<IHHHHHH', 0, 0, 2, 0x00, 0, 0xB2, len(reply)) + reply)
+
+    def _send_unit_data(self, context, data):
+        cid = struct.unpack_from('<I', data, 12)[0]
+        offset = CONNECTED_LENGTH_OFFSET - HEADER_SIZE
+        length = struct.unpack_from('<H', data, offset)[0]
+        sequence = data[offset + 2:offset + 4]
+        request = data[offset + 4:offset + 2 + length]
+        if self.server.is_connected(cid):
+            reply = self.server.limited(request, self.server.service(
+                request, self.client_address[0]), cid)
+        else:
+            reply = build_reply(request[0], CONNECTION_FAILURE)
+        reply = sequence + reply
+        self._reply(SEND_UNIT_DATA, context, struct.pack(
+            '<IHHHHIHH', 0, 0, 2, 0xA1, 4, cid, 0xB1, len(reply)) + reply)
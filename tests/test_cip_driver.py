@@ -0,0 +1,366 @@
+import struct
+from threading import Thread
+from time import perf_counter
+from unittest import TestCase
+from unittest.mock import Mock, patch
+from pycomm.cip.cip_base import CommError, DataError
+from ..async_cip_driver import AsyncCIPDriver
+from ..cip_driver import CIPDriver, CONTEXT_OFFSET, ForwardOpenReply, \
+    GET_ATTRIBUTE_ALL, GET_ATTRIBUTE_SINGLE, PARTIAL_TRANSFER, \
+    SESSION_OFFSET, ServiceError, build_cached_frame, build_io_path, \
+    encode_path, split_multi
+from ..simulator import EIPSimulator
+
+
+class ChunkedSocket(object):
+    """A socket receiving data at most size bytes at a time"""
+
+    def __init__(self, data, size):
+        self.data = data
+        self.size = size
+
+    def recv_into(self, view):
+        count = min(len(view), self.size, len(self.data))
+        view[:count] = self.data[:count]
+        self.data = self.data[count:]
+        return count
+
+
+class TestCIPDriver(TestCase):
+    """Requests are encoded, sent and decoded against a simulated device"""
+
+    def setUp(self):
+        self.simulator = EIPSimulator(
+            attributes={(1, 1, 1): b'\x01\x00', (4, 100, 3): b'\x02'})
+        self.simulator.start()
+
+    def tearDown(self):
+        self.simulator.stop()
+
+    def _open(self, driver):
+        driver['port'] = self.simulator.port
+        self.assertTrue(driver.open('127.0.0.1'))
+        self.addCleanup(driver.close)
+        return driver
+
+    def test_attributes(self):
+        drvr = self._open(CIPDriver())
+        self.assertEqual(drvr.get_attribute_single(1, 1, 1), b'\x01\x00')
+        self.assertTrue(drvr.set_attribute_single(b'\x05', 1, 1, 5))
+        self.assertEqual(self.simulator.attributes[(1, 1, 5)], b'\x05')
+        view = drvr.get_attribute_single(1, 1, 5, copy=False)
+        self.assertIsInstance(view, memoryview)
+        self.assertEqual(view, b'\x05')
+
+    def test_request_cache(self):
+        """Encoded paths and frames are cached and patched when sent"""
+        self.assertEqual(encode_path(1, 1, 1), b'\x20\x01\x24\x01\x30\x01')
+        # paths that differ in any part, or its size, do not collide
+        self.assertEqual(
+            len({encode_path(1, 1), encode_path(1, 1, 1),
+                 encode_path(1, 1, 0), encode_path(1, 257, 1),
+                 encode_path(2, 1, 1)}), 5)
+        self.assertNotEqual(
+            build_cached_frame(GET_ATTRIBUTE_SINGLE, 7, 3, 9),
+            build_cached_frame(GET_ATTRIBUTE_SINGLE, 7, 3, 9, b'\x01' * 4))
+        self.simulator.attributes[(7, 3, 9)] = b'\x09'
+        drvr = self._open(CIPDriver())
+        before = CIPDriver.cache_info()['frames']
+        self.assertEqual(drvr.get_attribute_single(7, 3, 8), False)
+        self.assertEqual(drvr.get_attribute_single(7, 3, 9), b'\x09')
+        self.assertEqual(drvr.get_attribute_single(7, 3, 9), b'\x09')
+        after = CIPDriver.cache_info()['frames']
+        self.assertEqual(after.misses - before.misses, 2)
+        self.assertEqual(after.hits - before.hits, 1)
+        # the cached frame is copied and patched with the session handle
+        # and sender context, a second session sends the same frame
+        frame = build_cached_frame(GET_ATTRIBUTE_SINGLE, 7, 3, 9)
+        other = self._open(CIPDriver())
+        self.assertEqual(other.get_attribute_single(7, 3, 9), b'\x09')
+        for driver in (drvr, other):
+            message = driver._message
+            self.assertEqual(
+                message[SESSION_OFFSET:SESSION_OFFSET + 4],
+                struct.pack('<I', driver._session))
+            self.assertEqual(
+                message[CONTEXT_OFFSET:CONTEXT_OFFSET + 8],
+                driver.attribs['context'])
+            self.assertEqual(
+                message[:SESSION_OFFSET], frame[:SESSION_OFFSET])
+            self.assertEqual(message[24:], frame[24:])
+        self.assertNotEqual(drvr._session, other._session)
+        self.assertEqual(frame[SESSION_OFFSET:CONTEXT_OFFSET + 8], bytes(16))
+
+    def test_receive(self):
+        """Replies are received whole however the socket splits them"""
+        small = struct.pack('<HH', 0x6F, 4) + bytes(20) + b'\x01\x02\x03\x04'
+        large = struct.pack('<HH', 0x6F, 0xFFFF) + bytes(20) + \
+            bytes(range(256)) * 255 + bytes(range(255))
+        drvr = CIPDriver()
+        sock = ChunkedSocket(small + large + small, 7)
+        with patch.object(drvr, '_socket', return_value=sock):
+            # a reply split across recv calls, and the largest reply an
+            # encapsulation header allows, which fills the buffer
+            for reply in (small, large, small):
+                drvr._receive()
+                self.assertEqual(drvr._reply, reply)
+            self.assertEqual(sock.data, b'')
+        # a reply cut short by the target closing the session
+        sock = ChunkedSocket(large[:1000], 4096)
+        with patch.object(drvr, '_socket', return_value=sock):
+            with self.assertRaises(CommError):
+                drvr._receive()
+
+    def test_service_errors(self):
+        """CIP errors fail the request but keep the session"""
+        drvr = self._open(CIPDriver())
+        self.assertFalse(drvr.get_attribute_single(1, 1, 2))
+        self.assertIn('Attribute not supported', drvr.get_status()[1])
+        with self.assertRaises(ServiceError) as context:
+            drvr.get_attribute_single(1, 1, 2, raise_errors=True)
+        self.assertEqual(context.exception.status, 0x14)
+        self.assertEqual(drvr.get_attribute_single(1, 1, 1), b'\x01\x00')
+
+    def test_multiple_service_packet(self):
+        drvr = self._open(CIPDriver())
+        # more requests than fit in one packet
+        paths = [[1, 1, 1], [1, 1, 2]] * 100
+        values, statuses = drvr.get_attribute_multi(paths)
+        self.assertEqual(values, [b'\x01\x00', False] * 100)
+        self.assertEqual(
+            statuses[:2], [(0, ''), (3, 'Attribute not supported')])
+        self.assertGreater(self.simulator.requests, 200)
+
+    def test_reply_sizes(self):
+        """Packets are split so each reply fits too"""
+        requests = [bytes(8)] * 40
+        self.assertEqual(
+            [len(b) for b in split_multi(requests, 504, [4] * 40)], [40])
+        # 38 bytes assumed for each reply of an unknown size
+        self.assertEqual(
+            [len(b) for b in split_multi(requests, 504)], [13, 13, 13, 1])
+        self.assertEqual(
+            [len(b) for b in split_multi(requests, 504, [100] * 40)],
+            [4] * 10)
+        # replies larger than assumed are sent again in smaller packets
+        for attribute in range(1, 21):
+            self.simulator.attributes[(5, 1, attribute)] = bytes(100)
+        drvr = self._open(CIPDriver())
+        paths = [[5, 1, attribute] for attribute in range(1, 21)]
+        self.assertEqual(
+            drvr.get_attribute_multi(paths),
+            ([bytes(100)] * 20, [(0, '')] * 20))
+        # packets of 13 and 7 are halved, then their halves of 6 and 7
+        self.assertEqual(
+            drvr.metrics.snapshot()['statuses'].get('0x11'), 4)
+
+    def test_attribute_lists(self):
+        drvr = self._open(CIPDriver())
+        self.simulator.attributes[(1, 1, 3)] = b'\x03\x00\x00\x00'
+        values, statuses = drvr.get_attribute_list(1, 1, [1, 2, 3], [2, 1, 4])
+        self.assertEqual(values, [b'\x01\x00', False, b'\x03\x00\x00\x00'])
+        self.assertEqual(statuses[1][0], 3)
+        requests = self.simulator.requests
+        # attributes of one instance with known sizes are listed
+        values, _ = drvr.get_attribute_multi(
+            [[1, 1, 1], [4, 100, 3], [1, 1, 3], [1, 1, 2]],
+            sizes=[2, 1, 4, None], lists=True)
+        self.assertEqual(
+            values, [b'\x01\x00', b'\x02', b'\x03\x00\x00\x00', False])
+        # a packet with a list and two single requests
+        self.assertEqual(self.simulator.requests - requests, 4)
+        # only the attribute that is not the size expected fails, the
+        # attributes after it are read again on their own
+        self.simulator.attributes[(1, 1, 4)] = b'\x04\x00'
+        values, statuses = drvr.get_attribute_multi(
+            [[1, 1, 1], [1, 1, 3], [1, 1, 4]], sizes=[2, 2, 2], lists=True)
+        self.assertEqual(values, [b'\x01\x00', False, b'\x04\x00'])
+        self.assertEqual(statuses[1], (3, 'Invalid reply received'))
+        self.assertEqual(
+            drvr.get_attribute_list(1, 1, [1, 3, 4], [2, 2, 2])[0],
+            [b'\x01\x00', False, b'\x04\x00'])
+        # lists of several instances whose replies only fit apart
+        for inst in range(2, 5):
+            for attribute in range(1, 31):
+                self.simulator.attributes[(1, inst, attribute)] = bytes(4)
+        paths = [[1, inst, attribute]
+                 for inst in range(2, 5) for attribute in range(1, 31)]
+        self.assertEqual(
+            drvr.get_attribute_multi(paths, sizes=[4] * 90, lists=True)[0],
+            [bytes(4)] * 90)
+        self.assertNotIn('0x11', drvr.metrics.snapshot()['statuses'])
+
+    def test_generic_service(self):
+        self.simulator.services[0x4B] = \
+            lambda path, data: (0, bytes(reversed(data)))
+        drvr = self._open(CIPDriver())
+        self.assertEqual(
+            drvr.generic_service(GET_ATTRIBUTE_ALL, 4, 100), b'\x02')
+        self.assertEqual(
+            drvr.generic_service(0x4B, 0x64, 1, data=b'\x01\x02'),
+            b'\x02\x01')
+        self.assertFalse(drvr.generic_service(0x4C, 1, 1))
+        self.assertEqual(
+            drvr.generic_service_multi([
+                (GET_ATTRIBUTE_ALL, [1, 1], b''),
+                (0x4B, [0x64, 1], b'\x05\x06'),
+                (0x4C, [1, 1], b''),
+            ])[0],
+            [b'\x01\x00', b'\x06\x05', False])
+
+    def test_fragmented_reads(self):
+        """Large replies are read in fragments and yielded as they arrive"""
+        blob = bytes(range(256)) * 4
+
+        def read(path, data):
+            offset = struct.unpack_from('<I', data, 1)[0]
+            fragment = blob[offset:offset + data[0]]
+            more = offset + len(fragment) < len(blob)
+            return PARTIAL_TRANSFER if more else 0, fragment
+        self.simulator.services[0x4B] = read
+        self.simulator.files[1] = blob + b'\x07'
+        drvr = self._open(CIPDriver())
+        fragments = list(drvr.read_fragmented(0x4B, 0x64, 1, data=b'\xc8'))
+        self.assertEqual([len(f) for f in fragments], [200] * 5 + [24])
+        self.assertEqual(b''.join(fragments), blob)
+        chunks = list(drvr.upload_file(1, 100))
+        self.assertEqual([len(c) for c in chunks], [100] * 10 + [25])
+        self.assertEqual(b''.join(chunks), blob + b'\x07')
+        self.assertEqual(len(list(drvr.upload_file(1))), 5)
+        # the hook runs before each request, Initiate_Upload included
+        before_request = Mock()
+        list(drvr.read_fragmented(
+            0x4B, 0x64, 1, data=b'\xc8', before_request=before_request))
+        self.assertEqual(before_request.call_count, 6)
+        before_request.reset_mock()
+        list(drvr.upload_file(1, 100, before_request=before_request))
+        self.assertEqual(before_request.call_count, 12)
+        with self.assertRaises(ServiceError):
+            list(drvr.upload_file(2))
+        self.assertEqual(drvr.get_attribute_single(1, 1, 1), b'\x01\x00')
+
+    def test_pipelined_requests(self):
+        """Requests split into several packets are pipelined in a window"""
+        self.simulator.latency = 0.01
+        paths = [[1, 1, 1], [1, 1, 2]] * 150
+        sequential = self._open(CIPDriver())
+        values, statuses = sequential.get_attribute_multi(paths)
+        requests = sequential.metrics.snapshot()['counters']['requests']
+        self.assertGreater(requests, 2)
+        drvr = self._open(CIPDriver(window=4))
+        self.assertEqual(drvr.get_attribute_multi(paths), (values, statuses))
+        self.assertEqual(values, [b'\x01\x00', False] * 150)
+        self.assertEqual(
+            drvr.metrics.snapshot()['counters']['requests'], requests)
+        self.assertEqual(drvr.get_attribute_single(1, 1, 1), b'\x01\x00')
+
+    def test_pipelined_threads(self):
+        """Requests of several threads share the window of a session and
+        get their own replies, whatever order they arrive in"""
+        self.simulator.latency = 0.05
+        self.simulator.out_of_order = True
+        for attr in range(1, 9):
+            self.simulator.attributes[(1, 2, attr)] = bytes([attr])
+        drvr = self._open(CIPDriver(window=8))
+        results = {}
+
+        def read(attr):
+            results[attr] = drvr.get_attribute_single(1, 2, attr)
+
+        def read_multi():
+            results['multi'] = drvr.get_attribute_multi([[1, 1, 1]] * 300)
+
+        threads = [Thread(target=read, args=(attr,)) for attr in range(1, 9)]
+        threads.append(Thread(target=read_multi))
+        started = perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # the requests were outstanding together, not one after another
+        self.assertLess(perf_counter() - started, 0.4)
+        self.assertEqual(
+            results.pop('multi'), ([b'\x01\x00'] * 300, [(0, '')] * 300))
+        self.assertEqual(
+            results, {attr: bytes([attr]) for attr in range(1, 9)})
+        self.assertEqual(drvr._pending, {})
+
+    def test_pipelined_failure(self):
+        """A request failing without a CIP status leaves no replies of the
+        others outstanding on the session"""
+        self.simulator.latency = 0.01
+        self.simulator.out_of_order = True
+        drvr = self._open(CIPDriver(window=4))
+        check_reply = drvr._check_reply
+        checked = []
+
+        def fail_first():
+            checked.append(None)
+            return len(checked) > 1 and check_reply()
+
+        with patch.object(drvr, '_check_reply', side_effect=fail_first), \
+                patch.object(drvr, '_service_failed', return_value=False):
+            with self.assertRaises(DataError):
+                drvr.get_attribute_multi([[1, 1, 1]] * 300)
+        self.assertEqual(drvr._pending, {})
+        self.assertEqual(drvr.get_attribute_single(1, 1, 1), b'\x01\x00')
+
+    def test_connected_messaging(self):
+        drvr = self._open(CIPDriver())
+        self.assertTrue(drvr.open_connection())
+        self.assertEqual(drvr.max_packet_size, 4000)
+        self.assertEqual(drvr.get_attribute_single(1, 1, 1), b'\x01\x00')
+        self.assertEqual(
+            drvr.get_attribute_multi([[1, 1, 1]] * 300)[0],
+            [b'\x01\x00'] * 300)
+
+    def test_reply_limits(self):
+        """Replies must fit in the message they are sent in"""
+        self.simulator.attributes[(1, 1, 9)] = bytes(600)
+        drvr = self._open(CIPDriver())
+        self.assertFalse(drvr.get_attribute_single(1, 1, 9))
+        self.assertIn('Reply data too large', drvr.get_status()[1])
+        self.assertTrue(drvr.open_connection())
+        cid = struct.unpack('<I', drvr._target_cid)[0]
+        self.assertTrue(self.simulator.is_connected(cid))
+        self.assertEqual(drvr.get_attribute_single(1, 1, 9), bytes(600))
+        self.assertTrue(drvr.forward_close())
+        self.assertFalse(self.simulator.is_connected(cid))
+
+    def test_io_connection(self):
+        drvr = self._open(CIPDriver())
+        path = build_io_path(1, 198, 100)
+        reply = drvr.open_io_connection(path, 1000000, 1)
+        self.assertIsInstance(reply, ForwardOpenReply)
+        self.assertEqual(reply.o_t_api, 1000000)
+        self.assertTrue(drvr.close_io_connection(reply.serial, path))
+
+    def test_async_driver(self):
+        drvr = self._open(AsyncCIPDriver())
+        self.assertEqual(drvr.get_attribute_single(1, 1, 1), b'\x01\x00')
+        self.assertTrue(drvr.open_connection())
+        values, statuses = drvr.get_attribute_multi(
+            [[1, 1, 1], [1, 1, 2]] * 200)
+        self.assertEqual(values, [b'\x01\x00', False] * 200)
+        self.assertEqual(statuses[1], (3, 'Attribute not supported'))
+        self.assertEqual(
+            drvr.get_attribute_multi(
+                [[1, 1, 1], [1, 1, 2], [4, 100, 3]], sizes=[2, 2, 1])[0],
+            [b'\x01\x00', False, b'\x02'])
+        self.assertEqual(
+            drvr.generic_service_multi([(GET_ATTRIBUTE_ALL, [4, 100], b'')]),
+            ([b'\x02'], [(0, '')]))
+        self.assertFalse(drvr.get_attribute_single(1, 1, 2))
+        with self.assertRaises(ServiceError):
+            drvr.get_attribute_single(1, 1, 2, raise_errors=True)
+
+    def test_metrics(self):
+        drvr = self._open(CIPDriver())
+        drvr.get_attribute_multi([[1, 1, 1], [1, 1, 2]])
+        snapshot = drvr.metrics.snapshot()
+        # the packet's embedded service error and each service's status
+        self.assertEqual(
+            snapshot['statuses'], {'0x1e': 1, '0x00': 1, '0x14': 1})
+        self.assertEqual(snapshot['counters']['requests'], 1)
+        for name in ('encode', 'rtt', 'decode'):
+            self.assertEqual(snapshot['latency'][name]['count'], 1)
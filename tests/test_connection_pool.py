@@ -0,0 +1,44 @@
+from unittest import TestCase
+from unittest.mock import MagicMock
+from pycomm.cip.cip_base import CommError
+from ..connection_pool import ConnectionPool
+
+
+class TestConnectionPool(TestCase):
+
+    def test_sessions_are_forgotten(self):
+        """A host's lock is dropped with its last session"""
+        pool = ConnectionPool()
+        drivers = [MagicMock(), MagicMock()]
+        first = pool.checkout(lambda: drivers[0], 'plc1')
+        self.assertIs(pool.checkout(lambda: drivers[1], 'plc1'), first)
+        pool.checkin(first)
+        self.assertEqual(len(pool._host_locks), 1)
+        pool.checkin(first)
+        drivers[0].close.assert_called_once_with()
+        self.assertEqual(pool._sessions, {})
+        self.assertEqual(pool._host_locks, {})
+        # a discarded session is retired, and closed by its last borrower
+        second = pool.checkout(lambda: drivers[1], 'plc1')
+        pool.checkout(lambda: drivers[1], 'plc1')
+        pool.checkin(second, discard=True)
+        self.assertEqual(pool._host_locks, {})
+        drivers[1].close.assert_not_called()
+        pool.checkin(second)
+        drivers[1].close.assert_called_once_with()
+        self.assertEqual(pool._retired, [])
+
+    def test_failed_open(self):
+        """A session that fails to open is closed and not shared"""
+        pool = ConnectionPool()
+        failed = MagicMock()
+        failed.open.return_value = False
+        failed.get_status.return_value = (13, 'Session not registered')
+        with self.assertRaises(CommError):
+            pool.checkout(lambda: failed, 'plc1')
+        failed.close.assert_called_once_with()
+        self.assertEqual(pool._sessions, {})
+        self.assertEqual(pool._host_locks, {})
+        driver = MagicMock()
+        self.assertIs(pool.checkout(lambda: driver, 'plc1'), driver)
+        driver.open.assert_called_once_with('plc1')
@@ -0,0 +1,81 @@
+import socket
+from unittest import TestCase
+from unittest.mock import patch
+from ..cip_driver import CONTEXT_OFFSET
+from ..discovery import Identity, build_identity_item, build_list_identity, \
+    discover, parse_identity_reply, targets
+from ..simulator import EIPSimulator, HEADER
+
+
+class SweepSocket(object):
+    """A UDP socket receiving a ListIdentity reply from each of ips"""
+
+    def __init__(self, ips):
+        self.ips = list(ips)
+        self.context = None
+
+    def setsockopt(self, *args):
+        pass
+
+    def settimeout(self, timeout):
+        pass
+
+    def sendto(self, request, address):
+        self.context = request[CONTEXT_OFFSET:CONTEXT_OFFSET + 8]
+
+    def recvfrom(self, size):
+        if not self.ips:
+            raise socket.timeout()
+        ip = self.ips.pop(0)
+        data = build_identity_item(Identity(
+            ip, 44818, 1, 0x0E, 55, (20, 11), 0x60, 1, 'PLC', 3))
+        return HEADER.pack(0x63, len(data), 0, 0, self.context, 0) + data, \
+            (ip, 44818)
+
+    def close(self):
+        pass
+
+
+class TestDiscovery(TestCase):
+
+    def test_identity_reply(self):
+        identity = Identity('10.0.0.5', 44818, 1, 0x0E, 55, (20, 11), 0x60,
+                            0xC0FFEE, '1756-L83E/B', 3)
+        data = build_identity_item(identity)
+        reply = HEADER.pack(0x63, len(data), 0, 0, bytes(8), 0) + data
+        self.assertEqual(parse_identity_reply(reply), identity)
+        # a target that does not know its own address
+        data = build_identity_item(identity._replace(ip='0.0.0.0'))
+        reply = HEADER.pack(0x63, len(data), 0, 0, bytes(8), 0) + data
+        self.assertEqual(parse_identity_reply(reply, '10.0.0.6').ip,
+                         '10.0.0.6')
+        self.assertIsNone(parse_identity_reply(reply[:40]))
+        self.assertIsNone(parse_identity_reply(build_list_identity()))
+
+    def test_targets(self):
+        self.assertEqual(targets('192.168.1.255'), ['192.168.1.255'])
+        self.assertEqual(targets('10.0.0.0/30'), ['10.0.0.1', '10.0.0.2'])
+        self.assertEqual(targets('10.0.0.7/32'), ['10.0.0.7'])
+        with self.assertRaises(ValueError):
+            targets('10.0.0.0/8')
+
+    def test_sweep(self):
+        """Every host of a network is asked at once"""
+        with EIPSimulator() as first, \
+                EIPSimulator('127.0.0.2', first.port) as second:
+            second.identity = second.identity._replace(serial=2)
+            identities = discover('127.0.0.0/29', first.port, 2)
+            self.assertEqual(
+                sorted((identity.ip, identity.serial)
+                       for identity in identities),
+                [('127.0.0.1', 0x12345678), ('127.0.0.2', 2)])
+            self.assertEqual(identities[0].product_name, 'EIPSimulator')
+            self.assertEqual(first.list_identity_requests, 1)
+
+    def test_sweep_other_replies(self):
+        """Replies from addresses outside a sweep do not end it early"""
+        sock = SweepSocket(['10.0.0.9', '10.0.0.1', '10.0.0.1', '10.0.0.2'])
+        with patch.object(socket, 'socket', return_value=sock):
+            identities = discover('10.0.0.0/30', timeout=1)
+        self.assertEqual([identity.ip for identity in identities],
+                         ['10.0.0.9', '10.0.0.1', '10.0.0.2'])
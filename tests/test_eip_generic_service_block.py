@@ -0,0 +1,139 @@
+from unittest.mock import ANY, patch
+from nio import Signal
+from nio.block.terminals import DEFAULT_TERMINAL
+from nio.testing.block_test_case import NIOBlockTestCase
+from ..cip_driver import ServiceError
+from ..eip_generic_service_block import EIPGenericService
+
+
+class TestEIPGenericService(NIOBlockTestCase):
+
+    @patch(EIPGenericService.__module__ + '.CIPDriver')
+    def test_block_expressions(self, mock_driver):
+        """Send a service with request data to the specified path"""
+        drvr = mock_driver.return_value
+        drvr.generic_service.return_value = b'\x01\x02'
+        config = {
+            'host': 'dummyhost',
+            'path': {
+                'class_id': '{{ $class_id }}',
+                'instance_num': 1,
+            },
+            'service': '{{ $service }}',
+            'data': '{{ $data }}',
+        }
+        blk = EIPGenericService()
+        self.configure_block(blk, config)
+        blk.start()
+        blk.process_signals([
+            Signal({'class_id': 0x64, 'service': 0x4B, 'data': b'\x07'})])
+        blk.stop()
+        drvr.generic_service.assert_called_once_with(
+            0x4B, 0x64, 1, data=b'\x07', raise_errors=True)
+        self.assert_last_signal_notified(Signal({
+            'host': 'dummyhost',
+            'path': [0x64, 1],
+            'service': 0x4B,
+            'value': b'\x01\x02'}))
+
+    @patch(EIPGenericService.__module__ + '.CIPDriver')
+    def test_failed_service(self, mock_driver):
+        """A service the target fails is dropped, an empty reply is not"""
+        drvr = mock_driver.return_value
+        drvr.generic_service.side_effect = [
+            ServiceError('Service not supported', 0x08), b'']
+        blk = EIPGenericService()
+        self.configure_block(blk, {})
+        blk.start()
+        blk.process_signals([Signal()] * 2)
+        blk.stop()
+        self.assertEqual(drvr.open.call_count, 1)
+        drvr.get_status.assert_not_called()
+        self.assertEqual(
+            [signal.value
+             for signal in self.notified_signals[DEFAULT_TERMINAL][0]],
+            [b''])
+
+    @patch(EIPGenericService.__module__ + '.CIPDriver')
+    def test_batch_requests(self, mock_driver):
+        """Signal lists are sent in one Multiple Service Packet"""
+        drvr = mock_driver.return_value
+        drvr.generic_service_multi.return_value = (
+            [b'\x01', False], [(0, ''), (3, 'Service not supported')])
+        config = {
+            'batch': True,
+            'service': '{{ $service }}',
+        }
+        blk = EIPGenericService()
+        self.configure_block(blk, config)
+        blk.start()
+        blk.process_signals([Signal({'service': 1}), Signal({'service': 2})])
+        blk.stop()
+        drvr.generic_service_multi.assert_called_once_with(
+            [(1, [1, 1], b''), (2, [1, 1], b'')])
+        self.assertEqual(len(self.notified_signals[DEFAULT_TERMINAL][0]), 1)
+        self.assert_last_signal_notified(Signal({
+            'host': 'localhost', 'path': [1, 1], 'service': 1,
+            'value': b'\x01'}))
+
+    @patch(EIPGenericService.__module__ + '.CIPDriver')
+    def test_transfers(self, mock_driver):
+        """Files are read whole, or streamed as a signal per fragment"""
+        drvr = mock_driver.return_value
+        drvr.upload_file.side_effect = \
+            lambda instance, before_request: iter([b'ab', b'c'])
+        blk = EIPGenericService()
+        self.configure_block(blk, {'transfer': 'FILE'})
+        blk.start()
+        blk.process_signals([Signal()])
+        blk.stop()
+        drvr.upload_file.assert_called_once_with(1, before_request=ANY)
+        self.assert_last_signal_notified(Signal({
+            'host': 'localhost', 'path': [1, 1], 'service': 1,
+            'value': b'abc'}))
+        drvr.read_fragmented.side_effect = \
+            lambda *args, **kwargs: iter([b'ab', b'c'])
+        blk = EIPGenericService()
+        self.configure_block(blk, {
+            'transfer': 'FRAGMENTED', 'stream': True, 'service': 0x52,
+            'asynchronous': True, 'batch': True})
+        blk.start()
+        blk.process_signals([Signal()])
+        blk.stop()
+        drvr.read_fragmented.assert_called_once_with(
+            0x52, 1, 1, data=b'', before_request=ANY)
+        self.assertEqual(
+            [signal.to_dict()
+             for signals in self.notified_signals[DEFAULT_TERMINAL][1:]
+             for signal in signals],
+            [{'host': 'localhost', 'path': [1, 1], 'service': 0x52,
+              'offset': 0, 'value': b'ab', 'last': False},
+             {'host': 'localhost', 'path': [1, 1], 'service': 0x52,
+              'offset': 2, 'value': b'c', 'last': True}])
+
+    @patch(EIPGenericService.__module__ + '.CIPDriver')
+    def test_throttled_transfers(self, mock_driver):
+        """Each fragment of a transfer waits for the rate limiter, and is
+        requested in the block's process with worker processes"""
+        def read_fragmented(*args, data, before_request):
+            for fragment in [b'ab', b'cd', b'e']:
+                before_request()
+                yield fragment
+        mock_driver.return_value.read_fragmented.side_effect = \
+            read_fragmented
+        mock_driver.return_value.round_trip.return_value = 0.001
+        # rate limits are shared by blocks, each run uses its own host
+        for host, stream, notified in [('plc1', False, 1), ('plc2', True, 3)]:
+            blk = EIPGenericService()
+            self.configure_block(blk, {
+                'host': host, 'transfer': 'FRAGMENTED', 'stream': stream,
+                'rate_limit': 1000, 'worker_processes': 2})
+            self.assertIsNone(blk._workers)
+            blk.start()
+            blk.process_signals([Signal()])
+            stats = blk.metrics_snapshot()['rate_limits'][host]
+            blk.stop()
+            self.assertEqual(stats['granted'], 3)
+            self.assertEqual(
+                len(self.notified_signals[DEFAULT_TERMINAL]), notified)
+            self.notified_signals[DEFAULT_TERMINAL].clear()
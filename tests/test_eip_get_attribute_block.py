@@ -1,8 +1,14 @@
-from unittest.mock import patch, Mock
+import asyncio
+from threading import Barrier, Event
+from time import sleep
+from unittest.mock import patch, AsyncMock, MagicMock, Mock
 from nio import Signal
 from nio.block.terminals import DEFAULT_TERMINAL
 from nio.testing.block_test_case import NIOBlockTestCase
+from ..cip_driver import ServiceError
 from ..eip_get_attribute_block import EIPGetAttribute
+from ..eip_set_attribute_block import EIPSetAttribute
+from ..simulator import EIPSimulator
 
 
 class CustomException(Exception):
@@ -32,12 +38,54 @@ class TestEIPGetAttribute(NIOBlockTestCase):
         incoming_signal = Signal({
             'class_id': 8, 'instance_num': 6, 'attribute_num': 7})
         blk.process_signals([incoming_signal])
-        drvr.get_attribute_single.assert_called_once_with(8, 6, 7)
+        drvr.get_attribute_single.assert_called_once_with(
+            8, 6, 7, raise_errors=True)
         blk.stop()
         drvr.close.assert_called_once_with()
         self.assert_last_signal_notified(Signal(
             {'host': 'dummyhost', 'path': [8, 6, 7], 'value': 5309}))
 
+    @patch(EIPGetAttribute.__module__ + '.CIPDriver')
+    def test_static_path(self, mock_driver):
+        """A path without expressions is not evaluated for each signal"""
+        drvr = mock_driver.return_value
+        drvr.get_attribute_single.return_value = 1
+        config = {'path': {'class_id': 4, 'instance_num': 100,
+                           'attribute_num': '3'}}
+        blk = EIPGetAttribute()
+        self.configure_block(blk, config)
+        blk.start()
+        # no property value of the path is evaluated again
+        value_type = type(blk.path().class_id)
+        with patch.object(value_type, '__call__', side_effect=AssertionError):
+            self.assertEqual(blk._get_path(Signal()), [4, 100, 3])
+        blk.process_signals([Signal()] * 2)
+        blk.stop()
+        drvr.get_attribute_single.assert_called_with(
+            4, 100, 3, raise_errors=True)
+        signals = self.notified_signals[DEFAULT_TERMINAL][0]
+        self.assertEqual(signals[0].path, [4, 100, 3])
+        # each signal has its own path
+        self.assertIsNot(signals[0].path, signals[1].path)
+
+    @patch(EIPGetAttribute.__module__ + '.CIPDriver')
+    def test_partial_path_expression(self, mock_driver):
+        """Only the parts of a path that are expressions are evaluated"""
+        drvr = mock_driver.return_value
+        drvr.get_attribute_single.return_value = 1
+        config = {'path': {'class_id': 4,
+                           'instance_num': '{{ $instance_num }}'}}
+        blk = EIPGetAttribute()
+        self.configure_block(blk, config)
+        blk.start()
+        blk.process_signals([
+            Signal({'instance_num': 1}), Signal({'instance_num': 2})])
+        blk.stop()
+        self.assertEqual(
+            [signal.path
+             for signal in self.notified_signals[DEFAULT_TERMINAL][0]],
+            [[4, 1], [4, 2]])
+
     @patch(EIPGetAttribute.__module__ + '.CIPDriver')
     def test_signal_lists(self, mock_driver):
         """Outgoing signal lists have the same length as incoming"""
@@ -72,18 +120,43 @@ class TestEIPGetAttribute(NIOBlockTestCase):
     def test_failure_to_get(self, mock_driver):
         """One of two requests fail but the connection is alive."""
         drvr = mock_driver.return_value
-        drvr.get_attribute_single.side_effect = [False, 255]
-        drvr.get_status.return_value = (1, 'bad things')
+        drvr.get_attribute_single.side_effect = [
+            ServiceError('Attribute not supported', 0x14), 255]
         config = {}
         blk = EIPGetAttribute()
         self.configure_block(blk, config)
         blk.start()
-        blk.process_signals([Signal()] * 2)
+        with patch.object(blk.logger, 'error') as error:
+            blk.process_signals([Signal()] * 2)
         blk.stop()
         self.assertEqual(drvr.get_attribute_single.call_count, 2)
-        self.assertEqual(drvr.get_status.call_count, 1)
+        drvr.get_attribute_single.assert_called_with(1, 1, raise_errors=True)
+        # the status is the request's own, not read from the session
+        self.assertIn('Attribute not supported', error.call_args[0][0])
+        drvr.get_status.assert_not_called()
         self.assert_num_signals_notified(1)
 
+    @patch(EIPGetAttribute.__module__ + '.CIPDriver')
+    def test_metrics(self, mock_driver):
+        """Requests, failures and latency are recorded per host and path"""
+        drvr = mock_driver.return_value
+        drvr.get_attribute_single.side_effect = [False, 255]
+        drvr.metrics.snapshot.return_value = {'counters': {'requests': 2}}
+        blk = EIPGetAttribute()
+        self.configure_block(blk, {'host': 'myhost'})
+        blk.start()
+        blk.process_signals([Signal()] * 2)
+        snapshot = blk.metrics_snapshot()
+        blk.stop()
+        self.assertEqual(
+            snapshot['block']['counters'], {'requests': 2, 'failures': 1})
+        latency = snapshot['block']['latency']['myhost 1/1']
+        self.assertEqual(latency['count'], 2)
+        self.assertGreaterEqual(latency['max_ms'], latency['p50_ms'])
+        self.assertEqual(
+            snapshot['connections'],
+            {'myhost': {'counters': {'requests': 2}}})
+
     @patch(EIPGetAttribute.__module__ + '.CIPDriver')
     def test_connection_fails(self, mock_driver):
         """The block can start even if the initial connection fails."""
@@ -148,6 +221,53 @@ class TestEIPGetAttribute(NIOBlockTestCase):
         self.assertEqual(drvr.get_status.call_count, 0)
         blk.stop()
 
+    @patch(EIPGetAttribute.__module__ + '.CIPDriver')
+    def test_transport_failure_drops_lane(self, mock_driver):
+        """After a transport failure the rest of the signals fail fast"""
+        drvr = mock_driver.return_value
+        drvr.get_attribute_single.side_effect = CustomException
+        blk = EIPGetAttribute()
+        self.configure_block(blk, {'retry_options': {'max_retry': 0}})
+        blk.start()
+        blk.process_signals([Signal()] * 3)
+        self.assertEqual(drvr.get_attribute_single.call_count, 1)
+        self.assertEqual(drvr.open.call_count, 1)
+        self.assertEqual(
+            blk.metrics_snapshot()['block']['counters']['fast_failures'], 2)
+        # the first reconnect is immediate
+        blk.process_signals([Signal()])
+        self.assertEqual(drvr.open.call_count, 2)
+        blk.stop()
+        self.assert_num_signals_notified(0)
+
+    @patch(EIPGetAttribute.__module__ + '.CIPDriver')
+    def test_reconnect_backoff(self, mock_driver):
+        """A host that can not be reached is not retried until it is due"""
+        drvr = mock_driver.return_value
+        drvr.open.side_effect = CustomException
+        blk = EIPGetAttribute()
+        self.configure_block(blk, {})
+        blk.start()
+        blk.process_signals([Signal()])
+        self.assertEqual(drvr.open.call_count, 2)
+        # the host is down, signals are dropped without connecting
+        blk.process_signals([Signal()])
+        blk.process_signals([Signal()])
+        self.assertEqual(drvr.open.call_count, 2)
+        hosts = blk.metrics_snapshot()['hosts']
+        self.assertFalse(hosts['localhost']['up'])
+        self.assertEqual(hosts['localhost']['failures'], 2)
+        self.assertEqual(hosts['localhost']['fast_failed'], 2)
+        self.assertGreater(hosts['localhost']['retry_in'], 0)
+        # once the backoff has passed the host is tried again
+        blk._states['localhost']._retry_at = 0
+        drvr.open.side_effect = None
+        blk.process_signals([Signal()])
+        self.assertEqual(drvr.open.call_count, 3)
+        self.assertTrue(blk.metrics_snapshot()['hosts']['localhost']['up'])
+        blk.stop()
+        self.assert_num_signals_notified(1)
+
     @patch(EIPGetAttribute.__module__ + '.CIPDriver')
     def test_retry_connection_before_retry_request(self, mock_driver):
         """When a request fails, the connection is retried first."""
@@ -175,3 +295,502 @@ class TestEIPGetAttribute(NIOBlockTestCase):
         self.assertEqual(drvr.close.call_count, 3)
         self.assert_last_signal_notified(Signal(
             {'host': 'localhost', 'path': [1, 1], 'value': 42}))
+
+    @patch(EIPGetAttribute.__module__ + '.CIPDriver')
+    def test_batch_requests(self, mock_driver):
+        """Signal lists are read with one Multiple Service Packet request"""
+        drvr = mock_driver.return_value
+        drvr.get_attribute_multi.return_value = (
+            [b'\x01', False, b'\x03'],
+            [(0, ''), (3, 'Attribute not supported'), (0, '')])
+        config = {
+            'batch': True,
+            'path': {
+                'class_id': 1,
+                'instance_num': 1,
+                'attribute_num': '{{ $attribute_num }}',
+            },
+        }
+        blk = EIPGetAttribute()
+        self.configure_block(blk, config)
+        blk.start()
+        blk.process_signals([
+            Signal({'attribute_num': 1}),
+            Signal({'attribute_num': 2}),
+            Signal({'attribute_num': 3}),
+        ])
+        blk.stop()
+        drvr.get_attribute_multi.assert_called_once_with(
+            [[1, 1, 1], [1, 1, 2], [1, 1, 3]])
+        drvr.get_attribute_single.assert_not_called()
+        # the failed request is dropped and order is preserved
+        self.assertEqual(len(self.notified_signals[DEFAULT_TERMINAL]), 1)
+        self.assertEqual(
+            self.notified_signals[DEFAULT_TERMINAL][0][0].to_dict(),
+            {'host': 'localhost', 'path': [1, 1, 1], 'value': b'\x01'})
+        self.assertEqual(
+            self.notified_signals[DEFAULT_TERMINAL][0][1].to_dict(),
+            {'host': 'localhost', 'path': [1, 1, 3], 'value': b'\x03'})
+
+    @patch(EIPGetAttribute.__module__ + '.CIPDriver')
+    def test_batch_attribute_lists(self, mock_driver):
+        """Attributes with a fixed size data type can be read as lists"""
+        drvr = mock_driver.return_value
+        drvr.get_attribute_multi.return_value = (
+            [b'\x01\x00', b'\x02\x00'], [(0, ''), (0, '')])
+        config = {
+            'batch': True,
+            'attribute_lists': True,
+            'path': {
+                'attribute_num': '{{ $attribute_num }}',
+                'data_type': 'UINT',
+            },
+        }
+        blk = EIPGetAttribute()
+        self.configure_block(blk, config)
+        blk.start()
+        blk.process_signals([
+            Signal({'attribute_num': 1}), Signal({'attribute_num': 2})])
+        blk.stop()
+        drvr.get_attribute_multi.assert_called_once_with(
+            [[1, 1, 1], [1, 1, 2]], sizes=[2, 2], lists=True)
+        self.assertEqual(
+            [signal.value
+             for signal in self.notified_signals[DEFAULT_TERMINAL][0]],
+            [1, 2])
+
+    @patch(EIPGetAttribute.__module__ + '.CIPDriver')
+    def test_batch_request_fails(self, mock_driver):
+        """When a batch request raises, reset the connection."""
+        drvr = mock_driver.return_value
+        drvr.get_attribute_multi.side_effect = CustomException
+        config = {
+            'batch': True,
+            'retry_options': {
+                'max_retry': 0,  # do not retry
+            },
+        }
+        blk = EIPGetAttribute()
+        self.configure_block(blk, config)
+        blk.start()
+        blk.process_signals([Signal()] * 2)
+        self.assertIsNone(blk.cnxn)
+        blk.stop()
+        self.assert_num_signals_notified(0)
+
+    @patch(EIPGetAttribute.__module__ + '.CIPDriver')
+    def test_typed_values(self, mock_driver):
+        """Reply data is decoded with the data type of the path"""
+        drvr = mock_driver.return_value
+        drvr.get_attribute_single.side_effect = [
+            b'\x00\x00\x80\x3f\x00\x00\x00\x40', b'\x00']
+        config = {
+            'path': {
+                'data_type': 'REAL',
+                'is_array': True,
+            },
+        }
+        blk = EIPGetAttribute()
+        self.configure_block(blk, config)
+        blk.start()
+        blk.process_signals([Signal(), Signal()])
+        blk.stop()
+        # the reply that can not be decoded is dropped
+        self.assertEqual(len(self.notified_signals[DEFAULT_TERMINAL][0]), 1)
+        self.assert_last_signal_notified(Signal(
+            {'host': 'localhost', 'path': [1, 1], 'value': [1.0, 2.0]}))
+
+    @patch(EIPGetAttribute.__module__ + '.CIPDriver')
+    def test_struct_values(self, mock_driver):
+        """Batched reply data is decoded with a struct layout"""
+        drvr = mock_driver.return_value
+        drvr.get_attribute_multi.return_value = (
+            [b'\x01\x00\xff\xff\xff\xff', b'\x02\x00\x03\x00\x00\x00'],
+            [(0, ''), (0, '')])
+        config = {
+            'batch': True,
+            'path': {
+                'data_type': 'STRUCT',
+                'layout': 'Hi',
+            },
+        }
+        blk = EIPGetAttribute()
+        self.configure_block(blk, config)
+        blk.start()
+        blk.process_signals([Signal(), Signal()])
+        blk.stop()
+        self.assertEqual(
+            [signal.value for signal in
+             self.notified_signals[DEFAULT_TERMINAL][0]],
+            [[1, -1], [2, 3]])
+
+    @patch(EIPGetAttribute.__module__ + '.CIPDriver')
+    def test_polling(self, mock_driver):
+        """Polled paths that are due together are read in one request"""
+        drvr = mock_driver.return_value
+        polled = Event()
+
+        def get_attribute_multi(paths, sizes=None):
+            if len(drvr.get_attribute_multi.call_args_list) >= 3:
+                polled.set()
+            return [bytes([path[2]]) for path in paths], \
+                [(0, '')] * len(paths)
+        drvr.get_attribute_multi.side_effect = get_attribute_multi
+        config = {
+            'polls': [
+                {'attribute_num': 1, 'interval': {'seconds': 0.2}},
+                {'attribute_num': 2, 'interval': {'seconds': 0.1},
+                 'data_type': 'USINT'},
+            ],
+        }
+        blk = EIPGetAttribute()
+        self.configure_block(blk, config)
+        blk.start()
+        self.assertTrue(polled.wait(1))
+        blk.stop()
+        calls = drvr.get_attribute_multi.call_args_list
+        # both paths are due at the first tick, then only the faster one
+        self.assertEqual(calls[0][0][0], [[1, 1, 1], [1, 1, 2]])
+        self.assertEqual(calls[1][0][0], [[1, 1, 2]])
+        self.assertEqual(
+            [signal.to_dict() for signal in
+             self.notified_signals[DEFAULT_TERMINAL][0]],
+            [{'host': 'localhost', 'path': [1, 1, 1], 'value': b'\x01'},
+             {'host': 'localhost', 'path': [1, 1, 2], 'value': 2}])
+        stats = blk.poll_stats()
+        self.assertGreaterEqual(stats['ticks'], 3)
+        self.assertEqual(stats['overruns'], 0)
+
+
+    @patch(EIPGetAttribute.__module__ + '.CIPDriver')
+    def test_polling_host_expression(self, mock_driver):
+        """Polled paths need a host that is not a signal expression"""
+        for host in ('{{ $host }}', 'plc{{ $number }}'):
+            blk = EIPGetAttribute()
+            with self.assertRaises(ValueError):
+                self.configure_block(blk, {
+                    'host': host,
+                    'polls': [{'attribute_num': 1}],
+                })
+            # raised before the block made its executor or connected
+            self.assertIsNone(blk._executor)
+        mock_driver.assert_not_called()
+
+    @patch(EIPGetAttribute.__module__ + '.CIPDriver')
+    def test_report_by_exception(self, mock_driver):
+        """Values within the deadband of the last reported are dropped"""
+        drvr = mock_driver.return_value
+        drvr.get_attribute_single.side_effect = [
+            b'\x0a\x00', b'\x0b\x00', b'\x0d\x00', b'\x0d\x00']
+        config = {
+            'path': {
+                'data_type': 'UINT',
+            },
+            'report_by_exception': {
+                'enabled': True,
+                'deadband': 2,
+            },
+        }
+        blk = EIPGetAttribute()
+        self.configure_block(blk, config)
+        blk.start()
+        for _ in range(4):
+            blk.process_signals([Signal()])
+        blk.stop()
+        self.assertEqual(
+            [signals[0].value for signals in
+             self.notified_signals[DEFAULT_TERMINAL]],
+            [10, 13])
+        self.assertEqual(
+            blk.filter_stats(),
+            {'reported': 2, 'suppressed': 2, 'values': 1})
+
+    @patch(EIPGetAttribute.__module__ + '.CIPDriver')
+    def test_connected_messaging(self, mock_driver):
+        """A class 3 connection is opened after connecting"""
+        drvr = mock_driver.return_value
+        blk = EIPGetAttribute()
+        self.configure_block(blk, {'connected': True})
+        drvr.open.assert_called_once_with('localhost')
+        drvr.open_connection.assert_called_once_with()
+        # a failed Forward_Open falls back to unconnected messaging
+        drvr.open_connection.return_value = False
+        blk.before_retry('localhost')
+        self.assertEqual(drvr.open_connection.call_count, 2)
+        self.assertEqual(blk.cnxn, drvr)
+        blk.stop()
+        self.assertEqual(drvr.close.call_count, 2)
+
+    @patch(EIPGetAttribute.__module__ + '.CIPDriver')
+    def test_unconnected_messaging(self, mock_driver):
+        """By default no class 3 connection is opened"""
+        drvr = mock_driver.return_value
+        blk = EIPGetAttribute()
+        self.configure_block(blk, {})
+        drvr.open_connection.assert_not_called()
+        blk.stop()
+
+    @patch(EIPGetAttribute.__module__ + '.CIPDriver')
+    def test_shared_sessions(self, mock_driver):
+        """Blocks connecting to the same host share a session"""
+        drvr = mock_driver.return_value
+        blk1 = EIPGetAttribute()
+        blk2 = EIPGetAttribute()
+        self.configure_block(blk1, {})
+        self.configure_block(blk2, {})
+        self.assertEqual(mock_driver.call_count, 1)
+        drvr.open.assert_called_once_with('localhost')
+        self.assertEqual(blk1.cnxn, blk2.cnxn)
+        # the session is closed when the last block is done with it
+        blk1.stop()
+        drvr.close.assert_not_called()
+        blk2.stop()
+        drvr.close.assert_called_once_with()
+        # a different port is a different session
+        blk3 = EIPGetAttribute()
+        self.configure_block(blk3, {'port': 2222})
+        blk4 = EIPGetAttribute()
+        self.configure_block(blk4, {})
+        self.assertEqual(mock_driver.call_count, 3)
+        blk3.stop()
+        blk4.stop()
+        # a discarded session is not shared again, but it is only closed
+        # when the other blocks using it are done with it
+        mock_driver.side_effect = [MagicMock(), MagicMock()]
+        blk5 = EIPGetAttribute()
+        blk6 = EIPGetAttribute()
+        self.configure_block(blk5, {})
+        self.configure_block(blk6, {})
+        broken = blk5.cnxn
+        blk5._disconnect('localhost', discard=True)
+        broken.close.assert_not_called()
+        blk5._connect('localhost')
+        self.assertIsNot(blk5.cnxn, broken)
+        blk6._disconnect('localhost', discard=True)
+        broken.close.assert_called_once_with()
+        blk5.stop()
+        blk6.stop()
+
+    @patch(EIPGetAttribute.__module__ + '.CIPDriver')
+    def test_multiple_hosts(self, mock_driver):
+        """Requests to different hosts run concurrently, in signal order"""
+        drivers = {}
+        both_hosts = Event()
+
+        def driver(window=1):
+            drvr = MagicMock()
+            drvr.open.side_effect = \
+                lambda host: drivers.setdefault(host, drvr)
+
+            def get_attribute_single(*path, raise_errors=False):
+                # block until requests to both hosts are in flight
+                if len(drivers) == 2:
+                    both_hosts.set()
+                self.assertTrue(both_hosts.wait(1))
+                return '{}: {}'.format(drvr.open.call_args[0][0], path)
+            drvr.get_attribute_single.side_effect = get_attribute_single
+            return drvr
+        mock_driver.side_effect = driver
+        config = {
+            'host': '{{ $host }}',
+            'path': {'instance_num': '{{ $instance_num }}'},
+        }
+        blk = EIPGetAttribute()
+        self.configure_block(blk, config)
+        # host is an expression, connect when signals arrive
+        self.assertEqual(mock_driver.call_count, 0)
+        blk.start()
+        blk.process_signals([
+            Signal({'host': 'plc1', 'instance_num': 1}),
+            Signal({'host': 'plc2', 'instance_num': 2}),
+            Signal({'host': 'plc1', 'instance_num': 3}),
+        ])
+        self.assertEqual(mock_driver.call_count, 2)
+        self.assertEqual(
+            [signal.value for signal in
+             self.notified_signals[DEFAULT_TERMINAL][0]],
+            ['plc1: (1, 1)', 'plc2: (1, 2)', 'plc1: (1, 3)'])
+        blk.stop()
+        for drvr in drivers.values():
+            drvr.close.assert_called_once_with()
+
+    @patch(EIPGetAttribute.__module__ + '.CIPDriver')
+    def test_stop_ends_retries(self, mock_driver):
+        """A request is not retried once the block stops"""
+        drvr = mock_driver.return_value
+
+        def stop_and_fail(*args, **kwargs):
+            blk.stop()
+            raise CustomException
+        drvr.get_attribute_single.side_effect = stop_and_fail
+        blk = EIPGetAttribute()
+        self.configure_block(blk, {
+            'retry_options': {'max_retry': 5, 'multiplier': 0.01},
+        })
+        blk.start()
+        with self.assertRaises(RuntimeError):
+            blk.execute_with_retry(blk._make_request, 'localhost', [1, 1])
+        self.assertEqual(drvr.get_attribute_single.call_count, 1)
+        self.assertEqual(mock_driver.call_count, 1)
+
+    @patch(EIPGetAttribute.__module__ + '.CIPDriver')
+    def test_retries_per_host(self, mock_driver):
+        """Concurrent lanes each get their own retries"""
+        failing = Barrier(2, timeout=1)
+        # host -> requests to it, by any of its sessions
+        requests = {}
+
+        def driver(window=1):
+            drvr = MagicMock()
+
+            def get_attribute_single(*path, raise_errors=False):
+                host = drvr.open.call_args[0][0]
+                requests[host] = requests.get(host, 0) + 1
+                if requests[host] == 1:
+                    # fail while the other host's first request fails too
+                    failing.wait()
+                    raise CustomException
+                return requests[host]
+            drvr.get_attribute_single.side_effect = get_attribute_single
+            return drvr
+        mock_driver.side_effect = driver
+        config = {
+            'host': '{{ $host }}',
+            'retry_options': {'max_retry': 1, 'multiplier': 0},
+        }
+        blk = EIPGetAttribute()
+        self.configure_block(blk, config)
+        blk.start()
+        blk.process_signals(
+            [Signal({'host': 'plc1'}), Signal({'host': 'plc2'})])
+        blk.stop()
+        self.assertEqual(
+            [signal.value for signal in
+             self.notified_signals[DEFAULT_TERMINAL][0]], [2, 2])
+        self.assertEqual(blk.metrics_snapshot()['block']['counters'].get(
+            'retries'), 2)
+
+    @patch(EIPGetAttribute.__module__ + '.AsyncCIPDriver')
+    @patch(EIPGetAttribute.__module__ + '.CIPDriver')
+    def test_asynchronous_requests(self, mock_driver, mock_async_driver):
+        """Requests are pipelined on the event loop without blocking"""
+        drvr = mock_async_driver.return_value
+
+        async def get_attribute_single(*path):
+            if path[1] == 2:
+                raise ServiceError('Attribute not supported', 0x14)
+            return path[1]
+        drvr.async_get_attribute_single = AsyncMock(
+            side_effect=get_attribute_single)
+        config = {
+            'asynchronous': True,
+            'path': {'instance_num': '{{ $instance_num }}'},
+        }
+        blk = EIPGetAttribute()
+        self.configure_block(blk, config)
+        mock_driver.assert_not_called()
+        blk.start()
+        blk.process_signals([
+            Signal({'instance_num': 1}),
+            Signal({'instance_num': 2}),
+            Signal({'instance_num': 3}),
+        ])
+        for _ in range(100):
+            if self.notified_signals[DEFAULT_TERMINAL]:
+                break
+            sleep(0.01)
+        self.assertEqual(drvr.async_get_attribute_single.call_count, 3)
+        # a failed request does not drop the connection
+        self.assertEqual(blk.cnxn, drvr)
+        self.assertEqual(
+            [signal.value for signal in
+             self.notified_signals[DEFAULT_TERMINAL][0]],
+            [1, 3])
+        blk.stop()
+        drvr.close.assert_called_once_with()
+
+    @patch(EIPGetAttribute.__module__ + '.AsyncCIPDriver')
+    def test_asynchronous_order(self, mock_async_driver):
+        """Asynchronous signal lists are notified in the order they came"""
+        drvr = mock_async_driver.return_value
+
+        async def get_attribute_single(*path):
+            # the first list's reply is the slowest
+            await asyncio.sleep(0.1 if path[1] == 1 else 0)
+            return path[1]
+        drvr.async_get_attribute_single = AsyncMock(
+            side_effect=get_attribute_single)
+        blk = EIPGetAttribute()
+        self.configure_block(blk, {
+            'asynchronous': True,
+            'path': {'instance_num': '{{ $instance_num }}'},
+        })
+        blk.start()
+        for instance in (1, 2, 3):
+            blk.process_signals([Signal({'instance_num': instance})])
+        for _ in range(100):
+            if len(self.notified_signals[DEFAULT_TERMINAL]) == 3:
+                break
+            sleep(0.01)
+        blk.stop()
+        self.assertEqual(
+            [signals[0].value
+             for signals in self.notified_signals[DEFAULT_TERMINAL]],
+            [1, 2, 3])
+
+    @patch(EIPSetAttribute.__module__ + '.CIPDriver')
+    @patch(EIPGetAttribute.__module__ + '.CIPDriver')
+    def test_read_cache(self, mock_driver, mock_set_driver):
+        """Blocks share recent reads until the path is written"""
+        drvr = mock_driver.return_value
+        drvr.get_attribute_single.side_effect = [b'\x01', b'\x02']
+        config = {
+            'host': 'cachedhost',
+            'read_cache': {'enabled': True, 'ttl': {'seconds': 10}},
+        }
+        blocks = [EIPGetAttribute(), EIPGetAttribute()]
+        for blk in blocks:
+            self.configure_block(blk, config)
+            blk.start()
+        writer = EIPSetAttribute()
+        self.configure_block(writer, {'host': 'cachedhost'})
+        writer.start()
+        blocks[0].process_signals([Signal()])
+        blocks[1].process_signals([Signal()])
+        self.assertEqual(drvr.get_attribute_single.call_count, 1)
+        self.assertEqual(
+            blocks[1].metrics_snapshot()['block']['counters'],
+            {'cache_hits': 1})
+        writer.process_signals([Signal()])
+        blocks[1].process_signals([Signal()])
+        self.assertEqual(
+            [signal.value for signals in
+             self.notified_signals[DEFAULT_TERMINAL][:2] + [
+                 self.notified_signals[DEFAULT_TERMINAL][-1]]
+             for signal in signals],
+            [b'\x01', b'\x01', b'\x02'])
+        self.assertEqual(blocks[0].cache_stats()['invalidations'], 1)
+        for blk in blocks + [writer]:
+            blk.stop()
+
+    def test_rate_limit(self):
+        """Waiting for the rate limiter does not count as a slow reply"""
+        with EIPSimulator(attributes={(1, 1, 1): b'\x01'},
+                          latency=0.01) as simulator:
+            blk = EIPGetAttribute()
+            self.configure_block(blk, {
+                'host': '127.0.0.1',
+                'port': simulator.port,
+                'path': {'attribute_num': 1},
+                'rate_limit': 25,
+            })
+            blk.start()
+            blk.process_signals([Signal() for _ in range(20)])
+            stats = blk.metrics_snapshot()['rate_limits']['127.0.0.1']
+            blk.stop()
+        self.assertEqual(
+            len(self.notified_signals[DEFAULT_TERMINAL][0]), 20)
+        self.assertEqual(stats['granted'], 20)
+        self.assertGreater(stats['mean_wait_ms'], 2)
+        self.assertEqual(stats['decreases'], 0)
+        self.assertEqual(stats['rate'], 25)
@@ -0,0 +1,117 @@
+import socket
+from time import sleep
+from unittest.mock import patch
+from nio.block.terminals import DEFAULT_TERMINAL
+from nio.testing.block_test_case import NIOBlockTestCase
+from ..cip_driver import ForwardOpenReply
+from ..eip_implicit_io_block import EIPImplicitIO
+from ..implicit_io import build_io_packet
+
+
+class TestEIPImplicitIO(NIOBlockTestCase):
+
+    def _send(self, port, packets):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for sequence, data in packets:
+            sock.sendto(
+                build_io_packet(0x1234, sequence, sequence, data),
+                ('127.0.0.1', port))
+            sleep(0.01)
+        sock.close()
+
+    def _wait_connected(self, drvr):
+        for _ in range(100):
+            if drvr.open_io_connection.called:
+                break
+            sleep(0.01)
+        # registered with the listener after the connection is open
+        sleep(0.1)
+
+    def _wait_for(self, count):
+        for _ in range(100):
+            if len(self.notified_signals[DEFAULT_TERMINAL]) >= count:
+                return
+            sleep(0.01)
+
+    @patch(EIPImplicitIO.__module__ + '.CIPDriver')
+    def test_cyclic_data(self, mock_driver):
+        """Input data is decoded and notified for every packet"""
+        drvr = mock_driver.return_value
+        drvr.open_io_connection.return_value = ForwardOpenReply(
+            0x5678, 0x1234, 7, 1000000, 1000000)
+        config = {
+            'host': '127.0.0.1',
+            'io_port': 22221,
+            'assembly': {
+                'input_instance': 101,
+                'input_size': 4,
+                'data_type': 'UINT',
+                'is_array': True,
+            },
+            'rpi': 10,
+        }
+        blk = EIPImplicitIO()
+        self.configure_block(blk, config)
+        listener = blk._listener
+        with patch.object(listener, 'send', wraps=listener.send) as send:
+            blk.start()
+            self._wait_connected(drvr)
+            self._send(22221, [
+                (1, b'\x01\x00\x02\x00'), (2, b'\x03\x00\x04\x00')])
+            self._wait_for(2)
+            blk.stop()
+        # heartbeats are sent to the configured I/O port
+        self.assertEqual(send.call_args[0][1], ('127.0.0.1', 22221))
+        drvr.open_io_connection.assert_called_once_with(
+            bytes([0x20, 0x04, 0x24, 0x01, 0x2C, 198, 0x2C, 101]),
+            10000, 4, timeout_multiplier=1)
+        drvr.close_io_connection.assert_called_once_with(
+            7, bytes([0x20, 0x04, 0x24, 0x01, 0x2C, 198, 0x2C, 101]))
+        self.assertEqual(
+            [signals[0].to_dict()
+             for signals in self.notified_signals[DEFAULT_TERMINAL]],
+            [{'host': '127.0.0.1', 'sequence': 1, 'value': [1, 2]},
+             {'host': '127.0.0.1', 'sequence': 2, 'value': [3, 4]}])
+
+    @patch(EIPImplicitIO.__module__ + '.CIPDriver')
+    def test_decimation_and_changes(self, mock_driver):
+        """Only every nth packet is notified, if its data has changed"""
+        drvr = mock_driver.return_value
+        drvr.open_io_connection.return_value = ForwardOpenReply(
+            0x5678, 0x1234, 7, 1000000, 1000000)
+        config = {
+            'host': '127.0.0.1',
+            'io_port': 22222,
+            'decimation': 2,
+            'on_change': True,
+        }
+        blk = EIPImplicitIO()
+        self.configure_block(blk, config)
+        blk.start()
+        self._wait_connected(drvr)
+        self._send(22222, [
+            (1, b'\x01'), (2, b'\x02'), (3, b'\x02'), (4, b'\x02'),
+            (5, b'\x02'), (6, b'\x03')])
+        self._wait_for(2)
+        blk.stop()
+        self.assertEqual(
+            [signals[0].value
+             for signals in self.notified_signals[DEFAULT_TERMINAL]],
+            [b'\x02', b'\x03'])
+
+    @patch(EIPImplicitIO.__module__ + '.CIPDriver')
+    def test_connection_refused(self, mock_driver):
+        """The session is returned if the connection is refused"""
+        drvr = mock_driver.return_value
+        drvr.open_io_connection.return_value = False
+        drvr.get_status.return_value = (3, 'Connection failure')
+        blk = EIPImplicitIO()
+        self.configure_block(blk, {'io_port': 22223})
+        blk.start()
+        for _ in range(100):
+            if drvr.close.called:
+                break
+            sleep(0.01)
+        blk.stop()
+        drvr.close.assert_called_once_with()
+        self.assert_num_signals_notified(0)
@@ -0,0 +1,43 @@
+from nio import Signal
+from nio.block.terminals import DEFAULT_TERMINAL
+from nio.testing.block_test_case import NIOBlockTestCase
+from ..eip_list_identity_block import EIPListIdentity
+from ..simulator import EIPSimulator
+
+
+class TestEIPListIdentity(NIOBlockTestCase):
+
+    def test_inventory(self):
+        """Every device that replies is in one inventory signal"""
+        with EIPSimulator() as simulator:
+            blk = EIPListIdentity()
+            self.configure_block(blk, {
+                'address': '{{ $address }}',
+                'timeout': {'milliseconds': 200},
+                'port': simulator.port,
+            })
+            blk.start()
+            blk.process_signals([Signal({'address': '127.0.0.1'})])
+            blk.stop()
+        inventory = self.notified_signals[DEFAULT_TERMINAL][0][0]
+        self.assertEqual(inventory.address, '127.0.0.1')
+        self.assertEqual(inventory.count, 1)
+        self.assertEqual(inventory.devices, [{
+            'ip': '127.0.0.1',
+            'port': simulator.port,
+            'vendor': 1,
+            'device_type': 0x0C,
+            'product_code': 1,
+            'revision': '1.001',
+            'serial': '12345678',
+            'product_name': 'EIPSimulator',
+            'status': 0,
+            'state': 3,
+        }])
+
+    def test_no_replies(self):
+        blk = EIPListIdentity()
+        self.configure_block(blk, {
+            'address': '127.0.0.1', 'port': 9,
+            'timeout': {'milliseconds': 50}})
+        self.assertEqual(blk.discover()['devices'], [])
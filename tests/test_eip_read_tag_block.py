@@ -0,0 +1,66 @@
+import struct
+from unittest.mock import patch
+from nio import Signal
+from nio.block.terminals import DEFAULT_TERMINAL
+from nio.testing.block_test_case import NIOBlockTestCase
+from ..cip_driver import ServiceError
+from ..eip_read_tag_block import EIPReadTag
+from ..logix_driver import Member, STRUCTURE_TYPE, TagData, Template
+
+
+class TestEIPReadTag(NIOBlockTestCase):
+
+    @patch(EIPReadTag.__module__ + '.LogixDriver')
+    def test_read_tags(self, mock_driver):
+        """Tags are read by name and atomic values are decoded"""
+        drvr = mock_driver.return_value
+        drvr.read_tag.side_effect = [
+            TagData(0xC4, None, struct.pack('<i', -5)),
+            TagData(0xCA, None, struct.pack('<ff', 1.5, 2.5)),
+            ServiceError('Path destination unknown', 0x05),
+        ]
+        blk = EIPReadTag()
+        self.configure_block(blk, {
+            'tag': '{{ $tag }}', 'elements': '{{ $count }}'})
+        blk.start()
+        blk.process_signals([
+            Signal({'tag': 'Speed', 'count': 1}),
+            Signal({'tag': 'Temps', 'count': 2}),
+            Signal({'tag': 'Missing', 'count': 1}),
+        ])
+        blk.stop()
+        self.assertEqual(drvr.read_tag.call_args_list[1][0], ('Temps', 2))
+        self.assertEqual(
+            [signal.to_dict()
+             for signal in self.notified_signals[DEFAULT_TERMINAL][0]],
+            [{'host': 'localhost', 'tag': 'Speed', 'type': 'DINT',
+              'value': -5},
+             {'host': 'localhost', 'tag': 'Temps', 'type': 'REAL',
+              'value': [1.5, 2.5]}])
+
+    @patch(EIPReadTag.__module__ + '.LogixDriver')
+    def test_batch_structures(self, mock_driver):
+        """Batches use Read Tag, structures are decoded by template"""
+        drvr = mock_driver.return_value
+        drvr.read_tags.return_value = ([
+            TagData(STRUCTURE_TYPE, 0x1234, struct.pack('<i', 7)),
+            TagData(STRUCTURE_TYPE, 0x1234, struct.pack('<i', 8)),
+        ], [(0, '')] * 2)
+        drvr.tag_template.side_effect = [
+            Template(0x1234, 'Motor', 4, [Member('Count', 0xC4, 0, 0)]),
+            None,
+        ]
+        blk = EIPReadTag()
+        self.configure_block(blk, {'tag': '{{ $tag }}', 'batch': True})
+        blk.start()
+        blk.process_signals([
+            Signal({'tag': 'Motor'}), Signal({'tag': 'Motor.Inner'})])
+        self.assertEqual(
+            blk.refresh_symbols(), {'localhost': drvr.symbols.stats()})
+        blk.stop()
+        drvr.read_tags.assert_called_once_with(
+            [('Motor', 1), ('Motor.Inner', 1)])
+        drvr.invalidate_symbols.assert_called_once_with()
+        values = [signal.value
+                  for signal in self.notified_signals[DEFAULT_TERMINAL][0]]
+        self.assertEqual(values, [{'Count': 7}, struct.pack('<i', 8)])
@@ -1,8 +1,12 @@
+from time import sleep
 from unittest.mock import patch, Mock
 from nio import Signal
 from nio.block.terminals import DEFAULT_TERMINAL
 from nio.testing.block_test_case import NIOBlockTestCase
+from ..cip_driver import ServiceError
+from ..eip_get_attribute_block import EIPGetAttribute
 from ..eip_set_attribute_block import EIPSetAttribute
+from ..rate_limiter import Priority
 
 
 class CustomException(Exception):
@@ -35,7 +39,7 @@ class TestEIPSetAttribute(NIOBlockTestCase):
             'value': bytes([5, 3, 0, 9])})
         blk.process_signals([incoming_signal])
         drvr.set_attribute_single.assert_called_once_with(
-            bytes([5, 3, 0, 9]), 8, 6, 7)
+            bytes([5, 3, 0, 9]), 8, 6, 7, raise_errors=True)
         blk.stop()
         drvr.close.assert_called_once_with()
         self.assert_last_signal_notified(Signal({
@@ -76,16 +80,18 @@ class TestEIPSetAttribute(NIOBlockTestCase):
     def test_failure_to_set(self, mock_driver):
         """One of two requests fail but the connection is alive."""
         drvr = mock_driver.return_value
-        drvr.set_attribute_single.side_effect = [False, 255]
-        drvr.get_status.return_value = (1, 'bad things')
+        drvr.set_attribute_single.side_effect = [
+            ServiceError('Attribute not settable', 0x0E), 255]
         config = {}
         blk = EIPSetAttribute()
         self.configure_block(blk, config)
         blk.start()
-        blk.process_signals([Signal()] * 2)
+        with patch.object(blk.logger, 'error') as error:
+            blk.process_signals([Signal()] * 2)
         blk.stop()
         self.assertEqual(drvr.set_attribute_single.call_count, 2)
-        self.assertEqual(drvr.get_status.call_count, 1)
+        self.assertIn('Attribute not settable', error.call_args[0][0])
+        drvr.get_status.assert_not_called()
         self.assert_num_signals_notified(1)
 
     @patch(EIPSetAttribute.__module__ + '.CIPDriver')
@@ -203,3 +209,136 @@ class TestEIPSetAttribute(NIOBlockTestCase):
         self.assert_last_signal_notified(Signal(
             {'host': 'localhost', 'path': [1, 1], 'value': b'\x00\x00'}))
 
+    @patch(EIPSetAttribute.__module__ + '.CIPDriver')
+    def test_batch_requests(self, mock_driver):
+        """Signal lists are written with one Multiple Service Packet request"""
+        drvr = mock_driver.return_value
+        drvr.set_attribute_multi.return_value = (
+            [True, False, True],
+            [(0, ''), (3, 'Attribute not settable'), (0, '')])
+        config = {
+            'batch': True,
+            'path': {
+                'class_id': 1,
+                'instance_num': 1,
+                'attribute_num': '{{ $attribute_num }}',
+            },
+            'value': '{{ $value }}',
+        }
+        blk = EIPSetAttribute()
+        self.configure_block(blk, config)
+        blk.start()
+        blk.process_signals([
+            Signal({'attribute_num': 1, 'value': b'\x01'}),
+            Signal({'attribute_num': 2, 'value': b'\x02'}),
+            Signal({'attribute_num': 3, 'value': b'\x03'}),
+        ])
+        blk.stop()
+        drvr.set_attribute_multi.assert_called_once_with([
+            (b'\x01', [1, 1, 1]),
+            (b'\x02', [1, 1, 2]),
+            (b'\x03', [1, 1, 3]),
+        ])
+        drvr.set_attribute_single.assert_not_called()
+        # the failed write is dropped and order is preserved
+        self.assertEqual(len(self.notified_signals[DEFAULT_TERMINAL]), 1)
+        self.assertEqual(
+            self.notified_signals[DEFAULT_TERMINAL][0][0].to_dict(),
+            {'host': 'localhost', 'path': [1, 1, 1], 'value': b'\x01'})
+        self.assertEqual(
+            self.notified_signals[DEFAULT_TERMINAL][0][1].to_dict(),
+            {'host': 'localhost', 'path': [1, 1, 3], 'value': b'\x03'})
+
+    @patch(EIPSetAttribute.__module__ + '.CIPDriver')
+    def test_write_queue_coalesces(self, mock_driver):
+        """Only the last queued value of each path is written"""
+        drvr = mock_driver.return_value
+        drvr.set_attribute_multi.side_effect = \
+            lambda items: ([True] * len(items), [(0, '')] * len(items))
+        config = {
+            'path': {'attribute_num': '{{ $attribute_num }}'},
+            'value': '{{ $value }}',
+            'write_queue': {
+                'enabled': True,
+                'flush_interval': {'seconds': 10},
+            },
+        }
+        blk = EIPSetAttribute()
+        self.configure_block(blk, config)
+        blk.start()
+        blk.process_signals([
+            Signal({'attribute_num': 1, 'value': b'\x01'}),
+            Signal({'attribute_num': 2, 'value': b'\x02'}),
+            Signal({'attribute_num': 1, 'value': b'\x03'}),
+        ])
+        # nothing is written until the queue is flushed
+        drvr.set_attribute_multi.assert_not_called()
+        self.assertEqual(blk.queue_stats()['coalesced'], 1)
+        blk.stop()
+        drvr.set_attribute_multi.assert_called_once_with(
+            [(b'\x03', [1, 1, 1]), (b'\x02', [1, 1, 2])])
+        self.assertEqual(
+            [signal.to_dict()
+             for signal in self.notified_signals[DEFAULT_TERMINAL][0]],
+            [{'host': 'localhost', 'path': [1, 1, 1], 'value': b'\x03'},
+             {'host': 'localhost', 'path': [1, 1, 2], 'value': b'\x02'}])
+
+    @patch(EIPSetAttribute.__module__ + '.CIPDriver')
+    def test_write_queue_full(self, mock_driver):
+        """A full queue is flushed, new writes are dropped if it can not"""
+        drvr = mock_driver.return_value
+        drvr.set_attribute_multi.side_effect = \
+            lambda items: ([True] * len(items), [(0, '')] * len(items))
+        config = {
+            'path': {'attribute_num': '{{ $attribute_num }}'},
+            'write_queue': {
+                'enabled': True,
+                'max_size': 2,
+                'flush_size': 2,
+                'flush_interval': {'seconds': 10},
+                'overflow': 'DROP_NEWEST',
+            },
+        }
+        blk = EIPSetAttribute()
+        self.configure_block(blk, config)
+        blk.start()
+        blk.process_signals([
+            Signal({'attribute_num': attribute}) for attribute in (1, 2)])
+        for _ in range(100):
+            if drvr.set_attribute_multi.called:
+                break
+            sleep(0.01)
+        drvr.set_attribute_multi.assert_called_once_with(
+            [(b'\x00\x00', [1, 1, 1]), (b'\x00\x00', [1, 1, 2])])
+        # block the flush so that the queue fills up
+        blk._queue.flush_size = 3
+        blk.process_signals([
+            Signal({'attribute_num': attribute}) for attribute in (3, 4, 5)])
+        self.assertEqual(blk.queue_stats()['dropped'], 1)
+        self.assertEqual(blk.queue_stats()['size'], 2)
+        blk.stop()
+        self.assertEqual(drvr.set_attribute_multi.call_count, 2)
+
+    @patch(EIPGetAttribute.__module__ + '.CIPDriver')
+    @patch(EIPSetAttribute.__module__ + '.CIPDriver')
+    def test_rate_limit(self, mock_driver, mock_get_driver):
+        """Requests to a host share a rate limit, writes go first"""
+        drvr = mock_driver.return_value
+        drvr.set_attribute_single.side_effect = [True, CustomException, True]
+        drvr.round_trip.return_value = 0.001
+        blk = EIPSetAttribute()
+        self.configure_block(blk, {'host': 'limited', 'rate_limit': 1000})
+        reader = EIPGetAttribute()
+        self.configure_block(reader, {'host': 'limited', 'rate_limit': 500})
+        self.assertEqual(blk.priority(), Priority.WRITE)
+        self.assertEqual(reader.priority(), Priority.READ)
+        blk.start()
+        blk.process_signals([Signal(), Signal()])
+        stats = blk.metrics_snapshot()['rate_limits']['limited']
+        blk.stop()
+        self.assertIs(blk._limiter('limited'), reader._limiter('limited'))
+        self.assertEqual(stats['limit'], 500)
+        # the retry waited for a token too
+        self.assertEqual(stats['granted'], 3)
+        # the transport failure halved the rate
+        self.assertLess(stats['rate'], 500)
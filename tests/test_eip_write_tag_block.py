@@ -0,0 +1,45 @@
+from unittest.mock import patch
+from nio import Signal
+from nio.block.terminals import DEFAULT_TERMINAL
+from nio.testing.block_test_case import NIOBlockTestCase
+from ..eip_write_tag_block import EIPWriteTag
+from ..logix_driver import STRUCTURE_TYPE, Template
+
+
+class TestEIPWriteTag(NIOBlockTestCase):
+
+    @patch(EIPWriteTag.__module__ + '.LogixDriver')
+    def test_write_tag(self, mock_driver):
+        """Tags are written with the type code of the Data Type"""
+        drvr = mock_driver.return_value
+        drvr.write_tag.return_value = True
+        blk = EIPWriteTag()
+        self.configure_block(blk, {
+            'tag': 'Speeds', 'elements': 2, 'data_type': 'INT',
+            'value': '{{ $value }}'})
+        blk.start()
+        blk.process_signals([Signal({'value': b'\x01\x00\x02\x00'})])
+        blk.stop()
+        drvr.write_tag.assert_called_once_with(
+            'Speeds', 0xC3, b'\x01\x00\x02\x00', 2, None, raise_errors=True)
+        self.assert_last_signal_notified(Signal({
+            'host': 'localhost', 'tag': 'Speeds',
+            'value': b'\x01\x00\x02\x00'}))
+
+    @patch(EIPWriteTag.__module__ + '.LogixDriver')
+    def test_batch_structures(self, mock_driver):
+        """Structures are written with their template's handle"""
+        drvr = mock_driver.return_value
+        drvr.tag_template.side_effect = [
+            Template(0x1234, 'Motor', 4, []), None, ]
+        drvr.write_tags.return_value = ([True], [(0, '')])
+        blk = EIPWriteTag()
+        self.configure_block(blk, {
+            'tag': '{{ $tag }}', 'data_type': 'STRUCT', 'batch': True})
+        blk.start()
+        blk.process_signals([
+            Signal({'tag': 'Motor'}), Signal({'tag': 'Motor.Inner'})])
+        blk.stop()
+        drvr.write_tags.assert_called_once_with(
+            [('Motor', STRUCTURE_TYPE, bytes(4), 1, 0x1234)])
+        self.assertEqual(len(self.notified_signals[DEFAULT_TERMINAL][0]), 1)
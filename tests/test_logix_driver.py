@@ -0,0 +1,111 @@
+import struct
+from unittest import TestCase
+from ..logix_driver import LogixDriver, Member, Template, decode_structure, \
+    encode_tag_path, parse_tag, parse_template
+from ..simulator import EIPSimulator
+
+
+class TestLogixDriver(TestCase):
+    """Tags are read and written by name against a simulated controller"""
+
+    def setUp(self):
+        self.simulator = EIPSimulator(tags={
+            'Speed': (0xC4, struct.pack('<i', 42)),
+            'Temp': (0xCA, struct.pack('<f', 1.5)),
+            'Big': (0xC3, bytes(range(200)) * 6),
+        })
+        self.simulator.symbol_page_size = 1
+        self.simulator.start()
+        self.driver = LogixDriver()
+        self.driver['port'] = self.simulator.port
+        self.assertTrue(self.driver.open('127.0.0.1'))
+
+    def tearDown(self):
+        self.driver.close()
+        self.simulator.stop()
+
+    def test_tag_paths(self):
+        self.assertEqual(
+            parse_tag('Tag[1, 2].Member'),
+            [('Tag', (1, 2)), ('Member', ())])
+        self.assertEqual(
+            parse_tag('Program:Main.Count'),
+            [('Program:Main', ()), ('Count', ())])
+        with self.assertRaises(ValueError):
+            parse_tag('Tag[x]')
+        self.assertEqual(
+            encode_tag_path(parse_tag('Abc[300].B')),
+            b'\x91\x03Abc\x00\x29\x00\x2c\x01\x91\x01B\x00')
+        self.assertEqual(
+            encode_tag_path(parse_tag('Abc[3]'), 0x10),
+            b'\x20\x6b\x24\x10\x28\x03')
+
+    def test_symbol_cache(self):
+        """Symbols are fetched a page at a time until a tag is found"""
+        self.assertEqual(self.driver.read_tag('speed').data, b'*\x00\x00\x00')
+        self.assertEqual(self.driver.symbols.stats()['pages'], 1)
+        self.driver.read_tag('Temp')
+        self.assertEqual(self.driver.symbols.stats()['pages'], 2)
+        requests = self.simulator.requests
+        self.driver.read_tag('Speed')
+        self.assertEqual(self.simulator.requests, requests + 1)
+        # not a controller scope tag, the whole table is fetched once
+        self.assertFalse(self.driver.read_tag('Missing'))
+        self.assertFalse(self.driver.read_tag('Missing'))
+        self.assertTrue(self.driver.symbols.complete)
+        self.assertEqual(self.driver.symbols.stats()['pages'], 3)
+
+    def test_read_and_write(self):
+        value = self.driver.read_tag('Big', 600)
+        self.assertEqual(value.type, 0xC3)
+        self.assertEqual(value.data, bytes(range(200)) * 6)
+        fragments = list(self.driver.read_tag_fragmented('Big', 600))
+        self.assertEqual(len(fragments), 3)
+        self.assertEqual(self.driver.read_tag('Big[3]', 2).data,
+                         bytes(range(6, 10)))
+        self.assertTrue(
+            self.driver.write_tag('Speed', 0xC4, struct.pack('<i', 7)))
+        self.assertFalse(self.driver.write_tag('Speed', 0xC3, b'\x01\x00'))
+        values, statuses = self.driver.read_tags(
+            [('Speed', 1), ('Missing', 1), ('Temp', 1)])
+        self.assertEqual(
+            [value and value.data for value in values],
+            [struct.pack('<i', 7), False, struct.pack('<f', 1.5)])
+        self.assertEqual([status[0] for status in statuses], [0, 3, 0])
+        self.assertEqual(self.driver.write_tags([
+            ('Temp', 0xCA, struct.pack('<f', 2.5), 1, None),
+            ('Missing', 0xC4, bytes(4), 1, None),
+        ])[0], [True, False])
+        self.assertEqual(self.simulator.tags['Temp'][1],
+                         struct.pack('<f', 2.5))
+
+    def test_program_change(self):
+        """Stale symbol instances are looked up again"""
+        self.driver.read_tags([('Speed', 1), ('Temp', 1)])
+        # a download renumbers the symbols
+        self.simulator.tags = dict(
+            [('New', (0xC2, b'\x01'))] + list(self.simulator.tags.items()))
+        self.assertEqual(self.driver.read_tag('Temp').data,
+                         struct.pack('<f', 1.5))
+        self.assertEqual(self.driver.symbols.invalidations, 1)
+        del self.simulator.tags['New']
+        del self.simulator.tags['Speed']
+        values, _ = self.driver.read_tags([('Temp', 1), ('Big', 1)])
+        self.assertEqual([value.data for value in values],
+                         [struct.pack('<f', 1.5), b'\x00\x01'])
+        self.assertEqual(self.driver.symbols.invalidations, 2)
+
+    def test_templates(self):
+        definition = b''.join([
+            struct.pack('<HHI', 0, 0xC2, 0),  # hidden BOOL host
+            struct.pack('<HHI', 1, 0xC1, 0),  # BOOL, bit 1 of the host
+            struct.pack('<HHI', 2, 0x20C4, 4),  # DINT[2]
+            struct.pack('<HHI', 0, 0x8ABC, 12),  # nested structure
+        ]) + b'Motor;n\x00ZZZZZZZZZZMotor0\x00Run\x00Counts\x00Inner\x00'
+        template = parse_template(0x1234, 16, 4, definition)
+        self.assertEqual(template.name, 'Motor')
+        self.assertEqual(template.members[2], Member('Counts', 0x20C4, 4, 2))
+        data = b'\x02\x00\x00\x00' + struct.pack('<ii', 5, -6) + b'abcd'
+        self.assertEqual(dict(decode_structure(template, data)), {
+            'Run': True, 'Counts': [5, -6], 'Inner': b'abcd'})
+        self.assertIsInstance(template, Template)
@@ -0,0 +1,17 @@
+from unittest import TestCase
+from ..metrics import Metrics
+
+
+class TestMetrics(TestCase):
+
+    def test_histogram_names_are_capped(self):
+        metrics = Metrics(max_histograms=2)
+        metrics.record('plc1 1/1', 0.001)
+        metrics.record('plc2 1/1', 0.002)
+        # recording keeps a name, the least recently recorded is dropped
+        metrics.record('plc1 1/1', 0.003)
+        metrics.record('plc3 1/1', 0.004)
+        latency = metrics.snapshot()['latency']
+        self.assertEqual(sorted(latency), ['plc1 1/1', 'plc3 1/1'])
+        self.assertEqual(latency['plc1 1/1']['count'], 2)
+        self.assertEqual(latency['plc3 1/1']['max_ms'], 4)
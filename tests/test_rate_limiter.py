@@ -0,0 +1,57 @@
+from threading import Thread
+from time import sleep
+from unittest import TestCase
+from ..rate_limiter import MIN_RATE_FRACTION, Priority, RateLimiter
+
+
+class TestRateLimiter(TestCase):
+
+    def test_grant_order(self):
+        """Waiting requests are granted by priority, owners take turns"""
+        limiter = RateLimiter(10, burst=1)
+        limiter.acquire()
+        granted = []
+
+        def acquire(priority, owner):
+            limiter.acquire(priority, owner)
+            granted.append((priority, owner))
+        requests = [
+            (Priority.READ, 'a'), (Priority.READ, 'a'),
+            (Priority.TREND, 'c'), (Priority.READ, 'b'),
+            (Priority.READ, 'b'), (Priority.WRITE, 'a'),
+        ]
+        threads = []
+        for waiting, request in enumerate(requests, 1):
+            threads.append(Thread(target=acquire, args=request))
+            threads[-1].start()
+            while limiter.stats()['waiting'] < waiting:
+                sleep(0.001)
+        for thread in threads:
+            thread.join(2)
+        self.assertEqual(granted, [
+            (Priority.WRITE, 'a'), (Priority.READ, 'a'), (Priority.READ, 'b'),
+            (Priority.READ, 'a'), (Priority.READ, 'b'), (Priority.TREND, 'c'),
+        ])
+        self.assertEqual(limiter.stats()['granted'], 7)
+
+    def test_adaptive_rate(self):
+        """The rate is cut when replies slow down or time out"""
+        limiter = RateLimiter(100)
+        for _ in range(5):
+            limiter.completed(0.001)
+        self.assertEqual(limiter.rate, 100)
+        for _ in range(20):
+            limiter.completed(0.01)
+        self.assertLess(limiter.rate, 100)
+        self.assertGreaterEqual(limiter.stats()['decreases'], 1)
+        limiter = RateLimiter(100)
+        limiter.failed()
+        self.assertEqual(limiter.rate, 50)
+        for _ in range(10):
+            limiter.failed()
+        self.assertEqual(limiter.rate, 100 * MIN_RATE_FRACTION)
+        # batches grow the rate back without a round trip
+        limiter.completed()
+        self.assertEqual(limiter.rate, 10)
+        limiter.restrict(8)
+        self.assertEqual((limiter.limit, limiter.rate), (8, 8))
@@ -0,0 +1,126 @@
+from threading import Event, Thread
+from time import sleep
+from unittest import TestCase
+from ..read_cache import ReadCache
+
+
+class TestReadCache(TestCase):
+
+    def test_ttl_and_eviction(self):
+        cache = ReadCache(max_entries=2)
+        self.assertEqual(
+            cache.read('plc', 1, [1, 1, 1], 10, lambda: b'\x01'),
+            (b'\x01', False))
+        self.assertEqual(
+            cache.read('plc', 1, [1, 1, 1], 10, lambda: b'\x02'),
+            (b'\x01', True))
+        # expired
+        cache.read('plc', 1, [1, 1, 2], 0.01, lambda: b'\x03')
+        sleep(0.02)
+        self.assertEqual(
+            cache.read('plc', 1, [1, 1, 2], 10, lambda: b'\x04'),
+            (b'\x04', False))
+        # failed reads are not kept
+        cache.read('plc', 1, [1, 1, 3], 10, lambda: False)
+        self.assertEqual(
+            cache.read('plc', 1, [1, 1, 3], 10, lambda: b'\x05'),
+            (b'\x05', False))
+        # the least recently read path was evicted
+        self.assertEqual(
+            cache.read('plc', 1, [1, 1, 1], 10, lambda: b'\x06'),
+            (b'\x06', False))
+        self.assertEqual(cache.stats()['evictions'], 2)
+        cache.invalidate('plc', 1, [1, 1, 1])
+        self.assertEqual(
+            cache.read('plc', 1, [1, 1, 1], 10, lambda: b'\x07'),
+            (b'\x07', False))
+        # values are only shared by reads with the same options
+        cache.read('plc', 1, [1, 1, 1], 10, lambda: b'\x08', ('DINT',))
+        self.assertEqual(
+            cache.read('plc', 1, [1, 1, 1], 10, lambda: b'\x09', ('INT',)),
+            (b'\x09', False))
+        self.assertEqual(
+            cache.read('plc', 1, [1, 1, 1], 10, lambda: b'\x0A', ('DINT',)),
+            (b'\x08', True))
+        cache.invalidate('plc', 1, [1, 1, 1])
+        self.assertEqual(
+            cache.read('plc', 1, [1, 1, 1], 10, lambda: b'\x0B', ('INT',)),
+            (b'\x0B', False))
+
+    def test_single_flight(self):
+        """Identical reads in flight share one request"""
+        cache = ReadCache()
+        started = Event()
+        finish = Event()
+        results = []
+
+        def slow_read():
+            started.set()
+            self.assertTrue(finish.wait(1))
+            return b'\x01'
+
+        def read(path, function):
+            results.append(cache.read('plc', 1, path, 10, function))
+        threads = [Thread(target=read, args=([1, 1, 1], slow_read))]
+        threads[0].start()
+        self.assertTrue(started.wait(1))
+        threads.extend(
+            Thread(target=read, args=([1, 1, 1], lambda: b'\x02'))
+            for _ in range(3))
+        for thread in threads[1:]:
+            thread.start()
+        while cache.stats()['coalesced'] < 3:
+            sleep(0.001)
+        # a write during the read, the value read is not kept
+        cache.invalidate('plc', 1, [1, 1, 1])
+        finish.set()
+        for thread in threads:
+            thread.join(1)
+        self.assertEqual(sorted(results), [(b'\x01', False)] +
+                         [(b'\x01', True)] * 3)
+        self.assertEqual(
+            cache.read('plc', 1, [1, 1, 1], 10, lambda: b'\x02'),
+            (b'\x02', False))
+
+    def test_failures_are_not_shared(self):
+        """Reads waiting for a read that fails send their own"""
+        cache = ReadCache()
+        for failure in (OSError('broken'), False):
+            started = Event()
+            finish = Event()
+            results = {}
+
+            def fail():
+                started.set()
+                self.assertTrue(finish.wait(1))
+                if failure is False:
+                    return False
+                raise failure
+
+            def read(function):
+                try:
+                    results[function] = cache.read(
+                        'plc', 1, [1, 1, 1], 10, function)
+                except OSError as e:
+                    results[function] = e
+            threads = [Thread(target=read, args=(fail,))]
+            threads[0].start()
+            self.assertTrue(started.wait(1))
+
+            def own():
+                return b'\x01'
+            threads.append(Thread(target=read, args=(own,)))
+            coalesced = cache.stats()['coalesced']
+            threads[1].start()
+            while cache.stats()['coalesced'] == coalesced:
+                sleep(0.001)
+            finish.set()
+            for thread in threads:
+                thread.join(1)
+            self.assertEqual(results[own], (b'\x01', False))
+            if failure is False:
+                self.assertEqual(results[fail], (False, False))
+            else:
+                self.assertIs(results[fail], failure)
+            self.assertEqual(cache.stats()['in_flight'], 0)
+        self.assertEqual(cache.stats()['entries'], 0)
@@ -0,0 +1,138 @@
+import os
+import signal
+from threading import Thread
+from unittest import TestCase
+from unittest.mock import patch
+from nio import Signal
+from nio.block.terminals import DEFAULT_TERMINAL
+from nio.testing.block_test_case import NIOBlockTestCase
+from pycomm.cip.cip_base import CommError
+from ..cip_driver import ServiceError
+from ..eip_get_attribute_block import EIPGetAttribute
+from ..simulator import EIPSimulator
+from ..worker_pool import RemoteDriver, WorkerPool, worker_pools
+
+
+class TestWorkerPool(TestCase):
+    """Sessions are owned by the worker process of their host"""
+
+    def setUp(self):
+        self.simulator = EIPSimulator(attributes={(1, 1, 1): b'\x01\x00'})
+        self.simulator.start()
+        self.addCleanup(self.simulator.stop)
+        self.pool = WorkerPool(2)
+        self.pool.start()
+        self.addCleanup(self.pool.stop)
+
+    def _open(self, host):
+        driver = RemoteDriver(self.pool)
+        driver['port'] = self.simulator.port
+        self.assertTrue(driver.open(host))
+        self.addCleanup(driver.close)
+        return driver
+
+    def test_shards(self):
+        """Hosts are sharded the same way by every pool"""
+        self.assertEqual(self.pool.shard('127.0.0.1'), 0)
+        self.assertEqual(self.pool.shard('localhost'), 1)
+        self.assertEqual(WorkerPool(1).shard('localhost'), 0)
+
+    def test_remote_calls(self):
+        drivers = [self._open('127.0.0.1'), self._open('localhost')]
+        self.assertEqual([driver.get_attribute_single(1, 1, 1)
+                          for driver in drivers], [b'\x01\x00'] * 2)
+        # memoryviews are returned as bytes
+        self.assertEqual(
+            drivers[0].get_attribute_single(1, 1, 1, copy=False),
+            b'\x01\x00')
+        self.assertFalse(drivers[0].get_attribute_single(1, 1, 2))
+        self.assertIn('Attribute not supported', drivers[0].get_status()[1])
+        self.assertEqual(
+            drivers[1].get_attribute_multi([(1, 1, 1), (1, 1, 2)])[0],
+            [b'\x01\x00', False])
+        # exceptions are raised in the block's process
+        with self.assertRaises(ServiceError) as context:
+            drivers[1].read_fragmented(0x4B, 0x64, 1)
+        self.assertEqual(context.exception.status, 0x08)
+        self.assertIn('0x08', drivers[1].metrics.snapshot()['statuses'])
+
+    def test_worker_exits(self):
+        """Calls to a worker that exits fail and it is started again"""
+        driver = self._open('localhost')
+        # a call to the other worker, waiting for its reply
+        self.simulator.latency = 0.5
+        other = self._open('127.0.0.1')
+        results = []
+        thread = Thread(target=lambda: results.append(
+            other.get_attribute_single(1, 1, 1)))
+        thread.start()
+        process = self.pool._workers[1].process
+        os.kill(process.pid, signal.SIGKILL)
+        process.join(5)
+        with self.assertRaises(CommError):
+            driver.get_attribute_single(1, 1, 1)
+        thread.join()
+        self.assertEqual(results, [b'\x01\x00'])
+        # the session was lost with the worker
+        self.simulator.latency = 0
+        driver = self._open('localhost')
+        self.assertEqual(driver.get_attribute_single(1, 1, 1), b'\x01\x00')
+
+    def test_unpicklable_results(self):
+        """A result that cannot be sent back fails its call at once"""
+        driver = self._open('localhost')
+        # a new driver holds locks, which are not picklable
+        with self.assertRaises(CommError) as context:
+            self.pool.call(1, driver._session, ('__class__',), timeout=5)
+        self.assertIn('pickle', str(context.exception))
+        self.assertEqual(driver.get_attribute_single(1, 1, 1), b'\x01\x00')
+
+    def test_close_after_worker_fails(self):
+        """Closing a session whose worker fails does not raise"""
+        driver = self._open('localhost')
+        with patch.object(RemoteDriver, '_call', side_effect=CommError):
+            driver.close()
+
+    def test_call_timeout(self):
+        """A call the worker does not answer in time fails"""
+        self.simulator.latency = 0.5
+        driver = self._open('localhost')
+        with self.assertRaises(CommError):
+            self.pool.call(1, driver._session, ('get_attribute_single',),
+                           (1, 1, 1), timeout=0.1)
+        self.assertEqual(self.pool._workers[1].pending, {})
+        # the late reply is dropped, later calls get their own
+        self.assertEqual(driver.get_attribute_single(1, 1, 1), b'\x01\x00')
+
+
+class TestWorkerProcesses(NIOBlockTestCase):
+
+    def test_worker_processes(self):
+        """Blocks share worker processes and notify signals in order"""
+        with EIPSimulator(attributes={(1, 1, 1): b'\x01',
+                                      (1, 1, 2): b'\x02'}) as simulator:
+            blocks = [EIPGetAttribute(), EIPGetAttribute()]
+            for blk in blocks:
+                self.configure_block(blk, {
+                    'host': '{{ $host }}',
+                    'path': {'attribute_num': '{{ $attribute }}'},
+                    'port': simulator.port,
+                    'worker_processes': 2,
+                })
+                blk.start()
+            self.assertIs(blocks[0]._workers, blocks[1]._workers)
+            blocks[0].process_signals([
+                Signal({'host': '127.0.0.1', 'attribute': 1}),
+                Signal({'host': 'localhost', 'attribute': 2}),
+                Signal({'host': '127.0.0.1', 'attribute': 2}),
+            ])
+            self.assertEqual(
+                [(signal.host, signal.value) for signal in
+                 self.notified_signals[DEFAULT_TERMINAL][0]],
+                [('127.0.0.1', b'\x01'), ('localhost', b'\x02'),
+                 ('127.0.0.1', b'\x02')])
+            pool = blocks[0]._workers
+            for blk in blocks:
+                blk.stop()
+            self.assertEqual(worker_pools._pools, {})
+            self.assertEqual(pool._workers, [None, None])
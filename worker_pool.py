@@ -0,0 +1,351 @@
+import itertools
+import multiprocessing
+import types
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from multiprocessing.reduction import ForkingPickler
+from threading import Lock, Thread, local
+from time import perf_counter
+
+from pycomm.cip.cip_base import CommError
+
+from .cip_driver import CIPDriver
+from .logix_driver import LogixDriver
+
+
+# driver class of each kind of session made in a worker
+DRIVERS = {
+    'CIP': CIPDriver,
+    'Logix': LogixDriver,
+}
+# requests each worker makes at the same time, to different sessions
+WORKER_THREADS = 32
+# seconds a driver waits for the socket, the default of pycomm's Socket
+DRIVER_TIMEOUT = 5.0
+# driver timeouts a call waits for the worker's reply by default, a call
+# may send several requests
+CALL_TIMEOUTS = 6
+
+
+def worker_main(connection, threads=WORKER_THREADS):
+    """ Run a worker process, making the driver calls received on
+    connection and sending back their results
+
+    Each message is (call ID, session ID, attribute names, args, kwargs),
+    the reply is (call ID, True, result) or (call ID, False, exception).
+    Calls are made concurrently, each session's driver serializes its
+    own requests.
+    """
+    drivers = {}
+    send_lock = Lock()
+
+    def reply(call_id, succeeded, result):
+        try:
+            message = ForkingPickler.dumps((call_id, succeeded, result))
+        except Exception as e:
+            # the caller gets an error instead of waiting for its timeout
+            message = ForkingPickler.dumps(
+                (call_id, False, CommError(repr(e))))
+        with send_lock:
+            connection.send_bytes(message)
+
+    def call(call_id, session, names, args, kwargs):
+        try:
+            if names == ('__create__',):
+                kind, window, attribs = args
+                driver = DRIVERS[kind](window)
+                for key, value in attribs.items():
+                    driver[key] = value
+                drivers[session] = driver
+                result = None
+            elif names == ('__discard__',):
+                drivers.pop(session, None)
+                result = None
+            else:
+                target = drivers.get(session)
+                if target is None:
+                    raise CommError('Session {} is not open'.format(session))
+                for name in names:
+                    target = getattr(target, name)
+                result = target(*args, **kwargs)
+                if isinstance(result, types.GeneratorType):
+                    result = list(result)
+                elif isinstance(result, memoryview):
+                    result = bytes(result)
+            reply(call_id, True, result)
+        except Exception as e:
+            reply(call_id, False, e)
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        while True:
+            try:
+                message = connection.recv()
+            except EOFError:
+                break
+            if message is None:
+                break
+            executor.submit(call, *message)
+    for driver in drivers.values():
+        try:
+            driver.close()
+        except Exception:
+            pass
+
+
+class _Worker(object):
+    """ A worker process, the pipe to it and the calls waiting for its
+    replies
+    """
+
+    def __init__(self, process, connection):
+        self.process = process
+        self.connection = connection
+        # held to send on the connection and to add pending calls
+        self.lock = Lock()
+        # call ID -> Future of its result
+        self.pending = {}
+        # True once the worker's replies are no longer received
+        self.closed = False
+
+    def is_alive(self):
+        return not self.closed and self.process.is_alive()
+
+    def fail_pending(self, exc):
+        """ Fail the calls waiting for a reply, and those made later """
+        with self.lock:
+            self.closed = True
+            pending, self.pending = self.pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(exc)
+
+
+class WorkerPool(object):
+    """ Worker processes that each own the sessions of a stable shard of
+    hosts, so that encoding and decoding requests uses more than one core
+
+    Calls are sent to the worker of a host over a pipe and their results
+    come back on the same pipe, matched by call ID. A worker that exits is
+    started again on the next call to it, its sessions are lost and only
+    its own calls fail.
+    """
+
+    def __init__(self, processes):
+        self.processes = max(processes, 1)
+        self._context = multiprocessing.get_context('spawn')
+        self._lock = Lock()
+        self._call_ids = itertools.count(1)
+        # _Worker of each shard
+        self._workers = [None] * self.processes
+
+    def shard(self, host):
+        """ The worker of a host, the same in every process and run """
+        return zlib.crc32(host.encode()) % self.processes
+
+    def start(self):
+        for shard in range(self.processes):
+            self._start_worker(shard)
+
+    def stop(self):
+        with self._lock:
+            workers = [worker for worker in self._workers if worker]
+            self._workers = [None] * self.processes
+        for worker in workers:
+            try:
+                with worker.lock:
+                    worker.connection.send(None)
+            except (OSError, ValueError):
+                pass
+            worker.process.join(5)
+            if worker.process.is_alive():
+                worker.process.terminate()
+            worker.fail_pending(CommError('Worker pool stopped'))
+            worker.connection.close()
+
+    def call(self, shard, session, names, args=(), kwargs=None,
+             timeout=None):
+        """ Make a driver call in the worker of shard and return its
+        result, or raise its exception
+
+        Raises CommError if the worker has not replied after timeout
+        seconds, DRIVER_TIMEOUT * CALL_TIMEOUTS by default.
+        """
+        if timeout is None:
+            timeout = DRIVER_TIMEOUT * CALL_TIMEOUTS
+        with self._lock:
+            worker = self._workers[shard]
+        if worker is None or not worker.is_alive():
+            worker = self._start_worker(shard)
+        future = Future()
+        call_id = next(self._call_ids)
+        with worker.lock:
+            if worker.closed:
+                raise CommError('Worker process exited')
+            worker.pending[call_id] = future
+            try:
+                worker.connection.send(
+                    (call_id, session, names, args, kwargs or {}))
+            except (OSError, ValueError) as e:
+                worker.pending.pop(call_id, None)
+                raise CommError(e)
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            worker.pending.pop(call_id, None)
+            raise CommError('No reply from worker after {} seconds'.format(
+                timeout))
+
+    def _start_worker(self, shard):
+        with self._lock:
+            worker = self._workers[shard]
+            if worker is not None and worker.is_alive():
+                return worker
+            connection, child = self._context.Pipe()
+            process = self._context.Process(
+                target=worker_main, args=(child,),
+                name='EIPWorker-{}'.format(shard), daemon=True)
+            process.start()
+            child.close()
+            worker = self._workers[shard] = _Worker(process, connection)
+        Thread(target=self._receive, args=(worker,),
+               name='EIPWorkerReader-{}'.format(shard), daemon=True).start()
+        return worker
+
+    def _receive(self, worker):
+        while True:
+            try:
+                call_id, ok, result = worker.connection.recv()
+            except (EOFError, OSError):
+                # the worker exited, its calls will not be answered
+                worker.fail_pending(CommError('Worker process exited'))
+                return
+            future = worker.pending.pop(call_id, None)
+            if future is None:
+                # the call timed out
+                continue
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(result)
+
+
+class RemoteDriver(object):
+    """ A CIPDriver or LogixDriver session in a worker process
+
+    Calls of its methods, and of the methods of its attributes such as
+    metrics.snapshot(), are made in the worker of the host it opens.
+    Generators are returned as lists.
+    """
+
+    _sessions = itertools.count(1)
+
+    def __init__(self, pool, kind='CIP', window=1):
+        self._pool = pool
+        self._kind = kind
+        self._window = window
+        self._attribs = {}
+        self._session = next(self._sessions)
+        self._shard = None
+        # duration of the last call of each thread
+        self._round_trips = local()
+
+    def __getitem__(self, key):
+        return self._attribs[key]
+
+    def __setitem__(self, key, value):
+        self._attribs[key] = value
+
+    def open(self, host):
+        self._shard = self._pool.shard(host)
+        self._call(
+            ('__create__',), (self._kind, self._window, self._attribs))
+        return self._call(('open',), (host,))
+
+    def is_connected(self):
+        try:
+            return self._call(('is_connected',))
+        except CommError:
+            # the session was lost with its worker
+            return False
+
+    def close(self):
+        if self._shard is None:
+            return
+        try:
+            self._call(('close',))
+        except CommError:
+            pass
+        finally:
+            try:
+                self._call(('__discard__',))
+            except CommError:
+                # the worker exited, and the session with it
+                pass
+
+    def round_trip(self):
+        """ Seconds the last call of the calling thread took, including
+        the pipe to the worker, None before its first call
+        """
+        return getattr(self._round_trips, 'last', None)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return _RemoteAttribute(self, (name,))
+
+    def _call(self, names, args=(), kwargs=None):
+        started = perf_counter()
+        result = self._pool.call(self._shard, self._session, names, args,
+                                 kwargs)
+        self._round_trips.last = perf_counter() - started
+        return result
+
+
+class _RemoteAttribute(object):
+
+    def __init__(self, driver, names):
+        self._driver = driver
+        self._names = names
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return _RemoteAttribute(self._driver, self._names + (name,))
+
+    def __call__(self, *args, **kwargs):
+        return self._driver._call(self._names, args, kwargs)
+
+
+class WorkerPools(object):
+    """ Process-wide worker pools, one per number of processes, started
+    by the first block borrowing one and stopped when the last returns it
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        # processes -> [WorkerPool, borrower count]
+        self._pools = {}
+
+    def checkout(self, processes):
+        with self._lock:
+            entry = self._pools.get(processes)
+            if entry is None:
+                pool = WorkerPool(processes)
+                pool.start()
+                entry = self._pools[processes] = [pool, 0]
+            entry[1] += 1
+            return entry[0]
+
+    def checkin(self, pool):
+        with self._lock:
+            entry = self._pools.get(pool.processes)
+            if entry is None or entry[0] is not pool:
+                return
+            entry[1] -= 1
+            if entry[1] > 0:
+                return
+            del self._pools[pool.processes]
+        pool.stop()
+
+
+worker_pools = WorkerPools()
@@ -0,0 +1,115 @@
+from collections import OrderedDict
+from enum import Enum
+from threading import Condition, Thread
+from time import monotonic
+
+
+class OverflowPolicy(Enum):
+    BLOCK = 'BLOCK'
+    DROP_OLDEST = 'DROP_OLDEST'
+    DROP_NEWEST = 'DROP_NEWEST'
+
+
+class WriteQueue(object):
+    """ Bounded queue of writes with last write wins coalescing
+
+    An item put for a key that is already queued replaces it, keeping its
+    place in the queue. target is called from the queue's own thread with
+    a list of the queued items every flush_interval seconds, or as soon as
+    flush_size keys are queued. When max_size keys are queued, a new key
+    waits for room with the BLOCK policy, or the oldest or the new item is
+    dropped.
+    """
+
+    def __init__(self, target, max_size=1000, flush_interval=0.1,
+                 flush_size=100, overflow=OverflowPolicy.BLOCK, logger=None):
+        self.target = target
+        self.max_size = max(max_size, 1)
+        self.flush_interval = flush_interval
+        self.flush_size = max(min(flush_size, self.max_size), 1)
+        self.overflow = OverflowPolicy(overflow)
+        self.logger = logger
+        self._items = OrderedDict()
+        self._condition = Condition()
+        self._stopping = False
+        self._thread = None
+        self._stats = dict.fromkeys(
+            ('queued', 'coalesced', 'dropped', 'blocked', 'flushes',
+             'flushed'), 0)
+
+    def start(self):
+        with self._condition:
+            self._stopping = False
+        self._thread = Thread(
+            target=self._run, name='WriteQueue', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """ Flush the queued items and stop, waiting writers are dropped
+        """
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def put(self, key, item):
+        """ Queue item for key, returns False if it is dropped """
+        with self._condition:
+            self._stats['queued'] += 1
+            if key in self._items:
+                self._items[key] = item
+                self._stats['coalesced'] += 1
+                return True
+            if len(self._items) >= self.max_size:
+                if self.overflow is OverflowPolicy.DROP_NEWEST:
+                    self._stats['dropped'] += 1
+                    return False
+                if self.overflow is OverflowPolicy.DROP_OLDEST:
+                    self._items.popitem(last=False)
+                    self._stats['dropped'] += 1
+                else:
+                    self._stats['blocked'] += 1
+                    self._condition.notify_all()
+                    while len(self._items) >= self.max_size and \
+                            not self._stopping:
+                        self._condition.wait()
+                    if self._stopping:
+                        self._stats['dropped'] += 1
+                        return False
+            self._items[key] = item
+            if len(self._items) >= self.flush_size:
+                self._condition.notify_all()
+            return True
+
+    def stats(self):
+        with self._condition:
+            return dict(self._stats, size=len(self._items))
+
+    def _run(self):
+        while True:
+            with self._condition:
+                flush_at = monotonic() + self.flush_interval
+                while len(self._items) < self.flush_size and \
+                        not self._stopping:
+                    remaining = flush_at - monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                items = list(self._items.values())
+                self._items.clear()
+                stopping = self._stopping
+                if items:
+                    self._stats['flushes'] += 1
+                    self._stats['flushed'] += len(items)
+                # room for blocked writers
+                self._condition.notify_all()
+            if items:
+                try:
+                    self.target(items)
+                except Exception:
+                    if self.logger is not None:
+                        self.logger.exception('Write queue flush failed')
+            if stopping:
+                return